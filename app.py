@@ -9,10 +9,10 @@ import streamlit as st
 from pathlib import Path
 
 # Importações dos módulos locais
-from utils import clean_code_main, to_number_br_main
+from utils import clean_code_main, to_number_br_main, cents_columns_to_reais
 from cfop_analyzer import (
-    load_base_json, analyze_bi_against_base,
-    calculate_analysis_metrics, is_analysis_perfect
+    get_base_index, build_analysis_state, update_analysis_state, analysis_frame,
+    is_analysis_perfect
 )
 from bi_processor import (
     load_bi_strict, bi_excluir_lixo, load_bi_es,
@@ -24,6 +24,8 @@ from razao_processor import (
     calculate_comparison_metrics, is_comparison_perfect,
     filter_servicos_prestados
 )
+from exclusion_rules import load_rules, REGRAS_PADRAO
+from stage_cache import new_run, run_node, node_ran, stats_frame
 from simples_nacional import (
     process_icms_pdf, process_icms_st_pdf, parse_txt_lancamento_valor_desc,
     compare_simples_nacional, calculate_simples_nacional_metrics,
@@ -31,8 +33,8 @@ from simples_nacional import (
 )
 from ui_components import (
     display_analysis_kpis, display_comparison_kpis, display_simples_nacional_kpis,
-    show_success_message, create_status_filters, apply_filters,
-    create_download_buttons, format_comparison_table, create_comparison_download_buttons
+    show_success_message, show_read_diagnostics, show_stage_stats,
+    filtered_result_fragment, comparison_table_fragment, create_workbook_download_button
 )
 
 
@@ -76,16 +78,15 @@ if manual_path.exists():
 st.sidebar.header("Base de CFOP (JSON do disco)")
 DEFAULT_BASE_PATH = Path("cfop_base.json")
 
-@st.cache_data(show_spinner=False)
-def load_base_json_cached(p: Path):
-    return load_base_json(p)
-
 base_path = Path(st.sidebar.text_input("Caminho do arquivo JSON", value=str(DEFAULT_BASE_PATH))).expanduser()
 base_map = {}
+base_index = None
 
 try:
     if base_path.exists():
-        base_map = load_base_json_cached(base_path)
+        # Índice compilado compartilhado entre as sessões; recarrega sozinho quando o arquivo muda
+        base_index = get_base_index(base_path)
+        base_map = base_index.base
         st.sidebar.success(f"Base carregada: {base_path.name} • {len(base_map)} CFOPs")
     else:
         st.sidebar.error("Arquivo cfop_base.json não encontrado. Informe um caminho válido na sidebar.")
@@ -93,9 +94,111 @@ except Exception as e:
     st.sidebar.error(f"Erro ao carregar base: {e}")
 
 
+# =============================================================================
+# Sidebar — Regras de exclusão (por cliente)
+# =============================================================================
+st.sidebar.header("Regras de exclusão")
+DEFAULT_RULES_PATH = Path("regras_exclusao.json")
+
+rules_path = Path(st.sidebar.text_input("Arquivo de regras (JSON, opcional)", value=str(DEFAULT_RULES_PATH))).expanduser()
+cliente = st.sidebar.text_input("Cliente", value="", help="Código do cliente na seção \"clientes\" do arquivo de regras.")
+try:
+    regras = load_rules(rules_path, cliente or None)
+    if rules_path.exists():
+        st.sidebar.success(f"Regras carregadas: {rules_path.name}" + (f" • cliente {cliente}" if cliente else ""))
+except Exception as e:
+    st.sidebar.error(f"Erro nas regras de exclusão: {e}")
+    regras = dict(REGRAS_PADRAO)
+
+
+# =============================================================================
+# Etapas (nós memoizados: só rodam quando as entradas mudam)
+# =============================================================================
+stages = new_run(st.session_state.setdefault("etapas", {}))
+
+
+def p1_analysis_state(bi_key, bi_all, base_index):
+    """Mesmo BI já analisado: se só a base mudou, revalida só os CFOPs alterados."""
+    previous = st.session_state.get("p1_state")
+    if previous is None or st.session_state.get("p1_state_key") != bi_key:
+        return build_analysis_state(bi_all, base_index), []
+    return update_analysis_state(previous, base_index)
+
+
+def p2_aggregate_bi(result_entrada, result_saida):
+    """Soma por lançamento das abas processadas (valor_bi em centavos)."""
+    bi_parts = []
+    for result, origem in ((result_entrada, "entradas"), (result_saida, "saidas")):
+        if result is not None:
+            agg = aggregate_bi_all(result[0])
+            agg["origem"] = origem
+            bi_parts.append(agg)
+    if not bi_parts:
+        return pd.DataFrame(columns=["lancamento","valor_bi"])
+    return (
+        pd.concat(bi_parts, ignore_index=True)
+          .groupby("lancamento", as_index=False)["valor_bi"].sum()
+    )
+
+
+def p2_load_razao(razao_files, regras_servicos):
+    """Razão consolidado e separado em (total, sem serviços prestados, serviços prestados)."""
+    razao_total = consolidate_razao_files(razao_files)
+    if razao_total.empty:
+        return razao_total, razao_total, pd.DataFrame()
+    razao_sem_servicos, razao_servicos = filter_servicos_prestados(razao_total, regras_servicos)
+    return razao_total, razao_sem_servicos, razao_servicos
+
+
+def p2_compare(bi_total, razao_sem_servicos):
+    """Comparação BI × Razão já pronta para exibição, com as métricas."""
+    comp = compare_bi_vs_razao(bi_total, razao_sem_servicos)
+    metrics = calculate_comparison_metrics(comp, bi_total, razao_sem_servicos)
+
+    # Renomear colunas para exibição
+    comp_display = comp.rename(columns={
+        "lancamento": "Código de Lançamento",
+        "descricao": "Descrição",
+        "valor_bi": "Valor BI",
+        "valor_razao": "Valor Razão",
+        "dif": "Diferença",
+        "ok": "Status"
+    })
+    # Formatar coluna Status
+    comp_display["Status"] = comp_display["Status"].apply(lambda x: "OK ✅" if x else "DIVERGÊNCIA ❌")
+    return comp_display, metrics
+
+
+def p3_load_txt(txt_file, regras_servicos):
+    """Lote contábil (TXT): totais, descrições e a separação dos serviços prestados."""
+    txt_lanc_tot, txt_desc = parse_txt_lancamento_valor_desc(txt_file)
+    if txt_lanc_tot.empty:
+        return txt_lanc_tot, txt_desc, txt_lanc_tot, pd.DataFrame()
+    txt_sem_servicos, txt_servicos = filter_servicos_prestados_txt(txt_lanc_tot, txt_desc, regras_servicos)
+    return txt_lanc_tot, txt_desc, txt_sem_servicos, txt_servicos
+
+
+def p3_compare(pdf_lanc_tot, st_lanc_tot, txt_sem_servicos, txt_desc, comp_map_icms, comp_map_st):
+    """Comparação Livro ICMS & ICMS ST × Lote Contábil, com as métricas."""
+    # Unir composições ICMS + ICMS ST
+    comp_map_union = {}
+    for lanc, cfops in comp_map_icms.items():
+        comp_map_union.setdefault(lanc, set()).update(cfops)
+    for lanc, cfops in comp_map_st.items():
+        comp_map_union.setdefault(lanc, set()).update(cfops)
+
+    # Comparação final (usar TXT sem serviços)
+    comp = compare_simples_nacional(pdf_lanc_tot, st_lanc_tot, txt_sem_servicos, txt_desc, comp_map_union)
+    metrics = calculate_simples_nacional_metrics(comp, pdf_lanc_tot, st_lanc_tot, txt_sem_servicos)
+    return comp, metrics
+
+
 # =============================================================================
 # Abas Principais
 # =============================================================================
+# Resultados de cada aba para a exportação consolidada (uma aba do Excel por tabela)
+relatorios = {}
+
 tab1, tab2, tab3 = st.tabs([
     "① Análise do BI",
     "② Conferência BI × Razão",
@@ -124,9 +227,11 @@ with tab1:
     bi_all = None
     if bi_file is not None:
         try:
-            bi_all = load_bi_strict_multisheet(bi_file, "BI")
+            bi_all, bi_key = run_node(stages, "p1_bi", (bi_file, regras["bi"]),
+                                      load_bi_strict_multisheet, bi_file, "BI", regras["bi"])
             if bi_all is not None and not bi_all.empty:
                 st.success(f"✅ Arquivo processado com sucesso: {len(bi_all)} registros encontrados")
+                show_read_diagnostics(bi_all)
         except Exception as e:
             st.error(f"Erro ao processar arquivo BI: {e}")
 
@@ -135,17 +240,34 @@ with tab1:
     elif bi_all is None or bi_all.empty:
         st.info("Envie um arquivo de BI para conferir.")
     else:
-        bi_all = bi_excluir_lixo(bi_all)
+        bi_all, bi_key = run_node(stages, "p1_bi_limpo", (bi_key,), bi_excluir_lixo, bi_all, regras["bi"])
+
+        agrupar = st.checkbox(
+            "Agrupar linhas iguais (mesmo CFOP, códigos de lançamento e valores zerados/preenchidos)",
+            value=False, key="p1_agrupar",
+            help="Mostra uma linha por combinação, com a quantidade de linhas do BI e os valores somados.",
+        )
 
-        result_df = analyze_bi_against_base(bi_all, base_map)
+        # Mesmo BI já analisado: se a base mudou, revalida só os CFOPs alterados
+        (analysis_state, cfops_alterados), state_key = run_node(
+            stages, "p1_validacao", (bi_key, base_index), p1_analysis_state, bi_key, bi_all, base_index
+        )
+        if cfops_alterados and node_ran(stages, "p1_validacao"):
+            st.info(f"Base CFOP alterada: {len(cfops_alterados)} CFOP(s) revalidado(s) — "
+                    + ", ".join(cfops_alterados[:20]) + ("..." if len(cfops_alterados) > 20 else ""))
+        result_df, _ = run_node(stages, "p1_resultado", (state_key, agrupar),
+                                analysis_frame, analysis_state, collapse=agrupar)
 
         # Persistir para eventual uso futuro
+        st.session_state["p1_state"] = analysis_state
+        st.session_state["p1_state_key"] = bi_key
         st.session_state["p1_bi_all"] = bi_all
         st.session_state["p1_result"] = result_df
+        relatorios["Validação CFOP"] = result_df
 
         st.subheader("Resultado da Validação")
 
-        metrics = calculate_analysis_metrics(result_df)
+        metrics = analysis_state["metrics"]
         display_analysis_kpis(
             metrics["ok_count"], metrics["diff_count"],
             metrics["zero_count"], metrics["notfound_count"]
@@ -155,11 +277,7 @@ with tab1:
         if is_analysis_perfect(metrics):
             show_success_message("Todas as análises da Parte 1 estão perfeitas - sem divergências!")
 
-        status_filter, origem_filter = create_status_filters(result_df)
-        filtered = apply_filters(result_df, status_filter, origem_filter)
-
-        st.dataframe(filtered, use_container_width=True)
-        create_download_buttons(filtered, "Resultado Validação CFOP")
+        filtered_result_fragment(result_df, "Resultado Validação CFOP", key_prefix="p1")
 
 
 # =============================================================================
@@ -177,56 +295,54 @@ with tab2:
     st.divider()
 
     # Processar BIs
-    bi_parts = []
+    bi_total = pd.DataFrame(columns=["lancamento","valor_bi"])
+    bi_total_key = None
 
     if bi_file is not None:
         try:
-            result_entrada, result_saida = load_bi_multisheet(bi_file)
+            (result_entrada, result_saida), p2_bi_key = run_node(
+                stages, "p2_bi", (bi_file, regras["bi"]), load_bi_multisheet, bi_file, regras["bi"]
+            )
+            bi_total, bi_total_key = run_node(stages, "p2_bi_agregado", (p2_bi_key,),
+                                              p2_aggregate_bi, result_entrada, result_saida)
 
             if result_entrada is not None:
-                bi_df_ent, cfop_ent = result_entrada
-                agg_ent = aggregate_bi_all(bi_df_ent)
-                agg_ent["origem"] = "entradas"
-                bi_parts.append(agg_ent)
                 st.success("✅ Aba 'Entrada' processada com sucesso.")
 
             if result_saida is not None:
-                bi_df_sai, cfop_sai = result_saida
-                agg_sai = aggregate_bi_all(bi_df_sai)
-                agg_sai["origem"] = "saidas"
-                bi_parts.append(agg_sai)
                 st.success("✅ Aba 'Saída' processada com sucesso.")
 
             if result_entrada is None and result_saida is None:
                 st.error("Nenhuma aba 'Entrada' ou 'Saída' foi encontrada no arquivo.")
+            else:
+                show_read_diagnostics((result_entrada or result_saida)[0])
         except Exception as e:
             st.error(f"Erro ao processar arquivo BI: {e}")
 
     # BI — Soma por Lançamento
-    if bi_parts:
-        bi_total = (
-            pd.concat(bi_parts, ignore_index=True)
-              .groupby("lancamento", as_index=False)["valor_bi"].sum()
-        )
+    if not bi_total.empty:
         with st.expander("📊 BI — Soma por Lançamento", expanded=False):
-            st.dataframe(bi_total, use_container_width=True, height=280)
+            st.dataframe(cents_columns_to_reais(bi_total, ["valor_bi"]), use_container_width=True, height=280)
     else:
-        bi_total = pd.DataFrame(columns=["lancamento","valor_bi"])
         st.info("Envie ao menos um BI (Entradas, Saídas ou Serviços).")
 
-    # Processar Razões
+    # Processar Razões (separando serviços prestados)
     razao_servicos = pd.DataFrame()
+    razao_key = None
     try:
-        razao_total = consolidate_razao_files(razao_files)
+        (razao_total, razao_sem_servicos, razao_servicos), razao_key = run_node(
+            stages, "p2_razao", (razao_files, regras["servicos_prestados"]),
+            p2_load_razao, razao_files, regras["servicos_prestados"]
+        )
         if not razao_total.empty:
-            # Separar serviços prestados
-            razao_sem_servicos, razao_servicos = filter_servicos_prestados(razao_total)
-
             with st.expander("📒 Razão consolidado (todos TXT)", expanded=False):
-                st.dataframe(razao_sem_servicos, use_container_width=True, height=240)
+                engines = razao_total.attrs.get("engines", {})
+                if engines:
+                    st.caption("Leitura: " + " · ".join(f"{n} ({e})" for n, e in engines.items()))
+                st.dataframe(cents_columns_to_reais(razao_sem_servicos, ["valor_razao"]),
+                             use_container_width=True, height=240)
         else:
             st.info("Envie ao menos um arquivo TXT de Razão.")
-            razao_sem_servicos = razao_total
     except Exception as e:
         st.error(f"Erro processando razões: {e}")
         razao_total = pd.DataFrame(columns=["lancamento","valor_razao","descricao"])
@@ -237,9 +353,8 @@ with tab2:
     # Comparação (usar razão sem serviços)
     if not bi_total.empty and not razao_sem_servicos.empty:
         st.subheader("✅ Comparação BI × Razão por Lançamento")
-        comp = compare_bi_vs_razao(bi_total, razao_sem_servicos)
-
-        metrics = calculate_comparison_metrics(comp, bi_total, razao_sem_servicos)
+        comp_display, metrics = run_node(stages, "p2_comparacao", (bi_total_key, razao_key),
+                                         p2_compare, bi_total, razao_sem_servicos)[0]
         display_comparison_kpis(
             metrics["bi_count"], metrics["razao_count"],
             metrics["div_count"], metrics["ok_count"]
@@ -249,23 +364,9 @@ with tab2:
         if is_comparison_perfect(metrics):
             show_success_message("Todas as comparações BI × Razão estão perfeitas - sem divergências!")
 
-        # Renomear colunas para exibição
-        comp_display = comp.rename(columns={
-            "lancamento": "Código de Lançamento",
-            "descricao": "Descrição",
-            "valor_bi": "Valor BI",
-            "valor_razao": "Valor Razão",
-            "dif": "Diferença",
-            "ok": "Status"
-        })
-        # Formatar coluna Status
-        comp_display["Status"] = comp_display["Status"].apply(lambda x: "OK ✅" if x else "DIVERGÊNCIA ❌")
-
-        styled = format_comparison_table(comp_display)
-        st.dataframe(styled, use_container_width=True, height=420)
-
-        # Downloads - Apenas 2 botões para comparação
-        create_comparison_download_buttons(comp_display, "Comparação", key_prefix="parte2")
+        # Tabela e downloads (apenas 2 botões para comparação)
+        comparison_table_fragment(comp_display, "Comparação", key_prefix="parte2", height=420)
+        relatorios["BI x Razão"] = comp_display
 
         # Exibir tabela de serviços prestados APÓS o relatório principal
         if not razao_servicos.empty:
@@ -296,7 +397,9 @@ with tab3:
 
     # Processar PDF ICMS
     try:
-        pdf_lanc_tot, log_df, cfop_sem_mapa, comp_map_icms = process_icms_pdf(pdf_file, base_map)
+        (pdf_lanc_tot, log_df, cfop_sem_mapa, comp_map_icms), pdf_key = run_node(
+            stages, "p3_livro_icms", (pdf_file, base_index), process_icms_pdf, pdf_file, base_index
+        )
         if cfop_sem_mapa:
             st.warning(f"CFOP (ICMS) sem mapeamento na base: {', '.join(sorted(set(cfop_sem_mapa)))}")
 
@@ -309,47 +412,42 @@ with tab3:
         st.error(f"Erro processando PDF ICMS: {e}")
         pdf_lanc_tot = pd.DataFrame(columns=["lancamento","valor"])
         comp_map_icms = {}
+        pdf_key = None
 
     # Processar PDF ICMS ST
     try:
-        st_lanc_tot, cfop_st_sem_mapa, comp_map_st = process_icms_st_pdf(pdf_file_st, base_map)
+        (st_lanc_tot, cfop_st_sem_mapa, comp_map_st), pdf_st_key = run_node(
+            stages, "p3_livro_st", (pdf_file_st, base_index), process_icms_st_pdf, pdf_file_st, base_index
+        )
         if cfop_st_sem_mapa:
             st.warning(f"CFOP (ICMS ST) sem mapeamento na base (icms_subst): {', '.join(sorted(set(cfop_st_sem_mapa)))}")
     except Exception as e:
         st.error(f"Erro processando PDF ICMS ST: {e}")
         st_lanc_tot = pd.DataFrame(columns=["lancamento","valor"])
         comp_map_st = {}
+        pdf_st_key = None
 
-    # Processar TXT
+    # Processar TXT (separando serviços prestados)
     txt_servicos = pd.DataFrame()
     try:
-        txt_lanc_tot, txt_desc = parse_txt_lancamento_valor_desc(txt_file)
-
-        # Separar serviços prestados do TXT
-        if not txt_lanc_tot.empty:
-            txt_sem_servicos, txt_servicos = filter_servicos_prestados_txt(txt_lanc_tot, txt_desc)
-        else:
-            txt_sem_servicos = txt_lanc_tot
+        (txt_lanc_tot, txt_desc, txt_sem_servicos, txt_servicos), txt_key = run_node(
+            stages, "p3_txt", (txt_file, regras["servicos_prestados"]),
+            p3_load_txt, txt_file, regras["servicos_prestados"]
+        )
     except Exception as e:
         st.error(f"Erro processando TXT: {e}")
         txt_lanc_tot = pd.DataFrame(columns=["lancamento","valor"])
         txt_desc = pd.DataFrame(columns=["lancamento","descrição"])
         txt_sem_servicos = pd.DataFrame(columns=["lancamento","valor"])
-
-    # Unir composições ICMS + ICMS ST
-    comp_map_union = {}
-    for lanc, cfops in comp_map_icms.items():
-        comp_map_union.setdefault(lanc, set()).update(cfops)
-    for lanc, cfops in comp_map_st.items():
-        comp_map_union.setdefault(lanc, set()).update(cfops)
+        txt_key = None
 
     st.divider()
     st.subheader("🔎 Comparação — Livro ICMS & ICMS ST (PDF) × Lote Contábil (TXT)")
 
     # Comparação final (usar TXT sem serviços)
-    comp = compare_simples_nacional(pdf_lanc_tot, st_lanc_tot, txt_sem_servicos, txt_desc, comp_map_union)
-
-    metrics = calculate_simples_nacional_metrics(comp, pdf_lanc_tot, st_lanc_tot, txt_sem_servicos)
+    comp, metrics = run_node(stages, "p3_comparacao", (pdf_key, pdf_st_key, txt_key),
+                             p3_compare, pdf_lanc_tot, st_lanc_tot, txt_sem_servicos, txt_desc,
+                             comp_map_icms, comp_map_st)[0]
     display_simples_nacional_kpis(
         metrics["pdf_lanc_count"], metrics["rz_count"],
         metrics["div_count"], metrics["ok_count"]
@@ -359,12 +457,11 @@ with tab3:
     if is_simples_nacional_perfect(metrics):
         show_success_message("Todas as análises do Livro de ICMS x Lote Contábil estão perfeitas - sem divergências!")
 
-    # Tabela final
-    styled = format_comparison_table(comp)
-    st.dataframe(styled, use_container_width=True, height=460, key="sn_comp_icms_icmsst")
-
-    # Downloads - Apenas 2 botões para comparação
-    create_comparison_download_buttons(comp, "Comparação", key_prefix="parte3")
+    # Tabela final e downloads (apenas 2 botões para comparação)
+    comparison_table_fragment(comp, "Comparação", key_prefix="parte3", height=460,
+                              table_key="sn_comp_icms_icmsst")
+    if not comp.empty:
+        relatorios["Livro x Razão"] = comp
 
     # Exibir tabela de serviços prestados APÓS o relatório principal
     if not txt_servicos.empty:
@@ -374,6 +471,22 @@ with tab3:
         st.dataframe(txt_servicos, use_container_width=True, height=200)
 
 
+# =============================================================================
+# Exportação Consolidada — resultados das 3 abas num único Excel
+# =============================================================================
+if relatorios:
+    with st.sidebar.expander("📦 Exportar resultados", expanded=False):
+        st.caption("Abas: " + ", ".join(relatorios))
+        create_workbook_download_button(relatorios, "Conferência", key="todas_abas_excel_download")
+
+
+# =============================================================================
+# Etapas — hit/miss e tempo de cada nó nesta execução
+# =============================================================================
+with st.sidebar.expander("⏱️ Etapas (cache)", expanded=False):
+    show_stage_stats(stats_frame(stages))
+
+
 # =============================================================================
 # Fim da Aplicação
 # =============================================================================
\ No newline at end of file
@@ -4,13 +4,19 @@ Responsável por carregar, limpar e processar dados do Business Intelligence.
 """
 
 import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 from typing import Dict, List, Optional, Tuple
 from utils import (
-    clean_code_main, is_empty_code_main, to_number_br_main,
-    norm_text_main, read_excel_best_main, EMPTY_TOKENS_MAIN
+    clean_code_series, is_empty_code_series,
+    to_number_br_main, to_number_br_series, to_cents_br_series, norm_text_main,
+    excel_sheet_width_bound, widest_sheet, CENTS_DTYPE
 )
+from disk_cache import content_key, load_frame, store_frame, load_json, store_json
+from exclusion_rules import REGRAS_PADRAO, apply_rules, exclude_rows, merge_counts
 
 
 # =============================================================================
@@ -62,35 +68,180 @@ SERV_COLS = [
 ]
 
 
+# Assinaturas (magic bytes) dos formatos aceitos e o engine de cada um
+_MAGIC_OLE2 = b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"   # .xls (BIFF dentro de OLE2)
+_MAGIC_ZIP = b"PK\x03\x04"                           # .xlsx (OOXML dentro de ZIP)
+EXCEL_ENGINES = {"xls": "xlrd", "xlsx": "openpyxl"}
+
+# Cache das planilhas já lidas (abas, cabeçalhos e tabelas): incrementar ao mudar como as
+# abas são lidas (dtypes, colunas carregadas) para não reaproveitar tabelas antigas
+BI_CACHE_VERSION = "1"
+
+
 # =============================================================================
 # Funções de Leitura de Arquivos
 # =============================================================================
-def _read_excel_first_sheet(data: bytes, engine: str) -> Optional[pd.DataFrame]:
-    """Lê a primeira planilha de um arquivo Excel."""
-    bio = io.BytesIO(data)
+def sniff_format(data: bytes) -> str:
+    """Formato pelo conteúdo (não pela extensão): 'xls' (OLE2), 'xlsx' (ZIP) ou 'texto'."""
+    if data[:8] == _MAGIC_OLE2:
+        return "xls"
+    if data[:4] == _MAGIC_ZIP:
+        return "xlsx"
+    return "texto"
+
+
+def _new_diagnostics(file) -> Dict:
+    """Diagnóstico da leitura (formato, engine, cache e tempo), guardado em df.attrs["leitura"]."""
+    return {"arquivo": getattr(file, "name", None), "formato": None, "engine": None,
+            "cache": None, "segundos": None, "_inicio": time.perf_counter()}
+
+
+def _finish_diagnostics(diag: Dict, *dfs: Optional[pd.DataFrame]) -> None:
+    diag["segundos"] = round(time.perf_counter() - diag.pop("_inicio"), 3)
+    for df in dfs:
+        if df is not None:
+            df.attrs["leitura"] = dict(diag)
+
+
+def _open_workbook(raw: bytes, diag: Dict) -> Dict:
+    """
+    Pasta de trabalho com cache em disco pelo hash do conteúdo: abas, cabeçalhos e tabelas
+    já lidas vêm do cache, e o arquivo só é decodificado (xlrd/openpyxl, com o engine do
+    formato detectado) quando algo pedido ainda não está lá.
+    """
+    fmt = sniff_format(raw)
+    diag["formato"] = fmt
+    if fmt not in EXCEL_ENGINES:
+        raise ValueError("o conteúdo não é .xls (OLE2) nem .xlsx (ZIP)")
+    diag["engine"] = EXCEL_ENGINES[fmt]
+    diag["cache"] = True
+    wb = {"raw": raw, "engine": EXCEL_ENGINES[fmt], "diag": diag,
+          "local": threading.local(), "lock": threading.Lock(),
+          "key": content_key(raw, "bi_workbook", BI_CACHE_VERSION)}
+    layout = load_json(wb["key"])
+    if layout is None:
+        layout = {"sheets": list(_wb_excel(wb).sheet_names), "headers": {}}
+        store_json(wb["key"], layout)
+    wb["layout"] = layout
+    return wb
+
+
+def _wb_excel(wb: Dict) -> pd.ExcelFile:
+    """
+    ExcelFile da pasta, aberto só na primeira vez que o cache não basta. Cada thread tem o
+    seu (xlrd/openpyxl não são seguros para leitura concorrente do mesmo arquivo).
+    """
+    xls = getattr(wb["local"], "xls", None)
+    if xls is None:
+        xls = wb["local"].xls = _excel_file(wb["raw"], wb["engine"])
+        wb["diag"]["cache"] = False
+    return xls
+
+
+def _wb_header(wb: Dict, sheet_name: str) -> List[str]:
+    """Cabeçalho da aba (do cache ou lido e guardado)."""
+    with wb["lock"]:
+        headers = wb["layout"]["headers"]
+        if sheet_name not in headers:
+            headers[sheet_name] = _sheet_columns(_wb_excel(wb), sheet_name)
+            store_json(wb["key"], wb["layout"])
+        return headers[sheet_name]
+
+
+def _wb_read(wb: Dict, sheet_name: str, modo: str, columns: Optional[List[str]], reader) -> pd.DataFrame:
+    """
+    Tabela da aba do cache em disco (Parquet); na falta, `reader(xls)` lê do Excel e o
+    resultado é guardado. A chave inclui o modo de leitura e as colunas carregadas.
+    """
+    key = content_key(b"", wb["key"], sheet_name, modo, *(columns or ["*"]))
+    df = load_frame(key)
+    if df is None:
+        df = reader(_wb_excel(wb))
+        store_frame(key, df, exact=True)
+    return df
+
+
+def _excel_file(data: bytes, engine: str) -> pd.ExcelFile:
+    """
+    Abre a pasta de trabalho sem carregar as abas: o pandas já abre o openpyxl em read-only
+    e o xlrd é aberto em on_demand (cada aba só é lida quando for usada).
+    """
+    engine_kwargs = {"on_demand": True} if engine == "xlrd" else {}
+    return pd.ExcelFile(io.BytesIO(data), engine=engine, engine_kwargs=engine_kwargs)
+
+
+def _sheet_columns(xls: pd.ExcelFile, sheet_name) -> List[str]:
+    """Nomes das colunas da aba, lendo só a linha de cabeçalho."""
+    return [str(c) for c in pd.read_excel(xls, sheet_name=sheet_name, nrows=0).columns]
+
+
+def _only(columns: List[str]):
+    """usecols para o read_excel: só as colunas pedidas (comparadas como texto)."""
+    wanted = set(columns)
+    return lambda c: str(c) in wanted
+
+
+def _strict_columns(header: List[str]) -> Optional[List[str]]:
+    """Colunas que a leitura estrita usa, ou None se faltar alguma obrigatória."""
+    if any(c not in header for c in REQUIRED_COLS_DISPLAY):
+        return None
+    return REQUIRED_COLS_DISPLAY + [c for c in OPTIONAL_VALUE_COLS if c in header]
+
+
+def _read_excel_first_sheet(wb: Dict) -> Optional[pd.DataFrame]:
+    """
+    Lê a primeira planilha de um arquivo Excel.
+    Com os cabeçalhos obrigatórios presentes, carrega só as colunas usadas pela leitura estrita;
+    sem eles devolve apenas o cabeçalho (suficiente para a mensagem de erro).
+    """
     try:
-        xls = pd.ExcelFile(bio, engine=engine)
-        if not xls.sheet_names:
+        sheets = wb["layout"]["sheets"]
+        if not sheets:
             return None
-        df = pd.read_excel(xls, sheet_name=xls.sheet_names[0], dtype=str)
-        df.columns = [str(c) for c in df.columns]
-        return df
+        sheet = sheets[0]
+        header = _wb_header(wb, sheet)
+        keep = _strict_columns(header)
+        if keep is None:
+            return pd.DataFrame(columns=header, dtype=str)
+
+        def reader(xls):
+            df = pd.read_excel(xls, sheet_name=sheet, dtype=str, usecols=_only(keep))
+            df.columns = [str(c) for c in df.columns]
+            return df
+
+        return _wb_read(wb, sheet, "texto", keep, reader)
     except Exception:
         return None
 
 
-def _try_read_as_excel(data: bytes) -> Optional[pd.DataFrame]:
-    """Tenta ler arquivo como Excel (xlsx/xls)."""
-    df = _read_excel_first_sheet(data, engine="openpyxl")
-    if df is not None:
-        return df
+def _try_read_as_excel(data: bytes, diag: Dict) -> Optional[pd.DataFrame]:
+    """Lê arquivo como Excel (xlsx/xls) com o engine do formato detectado; None se não for Excel."""
     try:
-        df = _read_excel_first_sheet(data, engine="xlrd")
-        if df is not None:
-            return df
+        wb = _open_workbook(data, diag)
     except Exception:
-        pass
-    return None
+        return None
+    return _read_excel_first_sheet(wb)
+
+
+def _wb_width_bound(wb: Dict, sheet_name: str) -> Optional[int]:
+    """Limite superior das colunas da aba (excel_sheet_width_bound), do cache ou calculado e guardado."""
+    with wb["lock"]:
+        limites = wb["layout"].setdefault("limites", {})
+        if sheet_name not in limites:
+            limites[sheet_name] = excel_sheet_width_bound(_wb_excel(wb), sheet_name)
+            store_json(wb["key"], wb["layout"])
+        return limites[sheet_name]
+
+
+def _read_best_sheet(file) -> pd.DataFrame:
+    """read_excel_best_main via cache: a aba com mais colunas, lida inteira."""
+    raw = file.read()
+    wb = _open_workbook(raw, _new_diagnostics(file))
+    _, df = widest_sheet(
+        wb["layout"]["sheets"], lambda sh: _wb_width_bound(wb, sh),
+        lambda sh: _wb_read(wb, sh, "inteira", None, lambda xls: xls.parse(sh))
+    )
+    return df if df is not None else pd.DataFrame()
 
 
 def _try_read_as_csv(data: bytes) -> Optional[pd.DataFrame]:
@@ -106,24 +257,17 @@ def _try_read_as_csv(data: bytes) -> Optional[pd.DataFrame]:
 # =============================================================================
 # Funções de Limpeza de BI
 # =============================================================================
-def filter_cancelada(df: pd.DataFrame) -> pd.DataFrame:
+# As exclusões seguem as regras declaradas em exclusion_rules (conjunto "bi": cancelada, lixo
+# e o que o cliente acrescentar); `regras=None` usa o conjunto padrão.
+def filter_cancelada(df: pd.DataFrame, regras: Optional[List[Dict]] = None) -> pd.DataFrame:
     """Remove linhas onde a coluna 'Cancelada' está vazia."""
     if df is None or df.empty or "cancelada" not in df.columns:
         return df
 
-    df = df.copy()
-    # Considera vazio: NaN, None, "", espaços em branco, "nan", etc.
-    cancelada_empty = (
-        df["cancelada"].isna() |
-        df["cancelada"].astype(str).str.strip().eq("") |
-        df["cancelada"].astype(str).str.lower().isin(["nan", "none", "null"])
-    )
-
-    # Remove linhas onde Cancelada está vazia
-    return df.loc[~cancelada_empty].reset_index(drop=True)
+    return exclude_rows(df, REGRAS_PADRAO["bi"] if regras is None else regras, only=["cancelada"])
 
 
-def bi_excluir_lixo(df: pd.DataFrame) -> pd.DataFrame:
+def bi_excluir_lixo(df: pd.DataFrame, regras: Optional[List[Dict]] = None) -> pd.DataFrame:
     """Remove linhas do BI quando CFOP está vazio E as 4 colunas de valores estão todas = 0."""
     if df is None or df.empty or ("CFOP" not in df.columns):
         return df
@@ -137,17 +281,11 @@ def bi_excluir_lixo(df: pd.DataFrame) -> pd.DataFrame:
     for c in val_cols:
         df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0)
 
-    cfop_digits = (
-        df["CFOP"].map(clean_code_main).astype(str).fillna("").str.replace(r"\D+", "", regex=True)
-    )
-    cfop_empty = cfop_digits.str.len().eq(0)
-    all_zero = df[val_cols].fillna(0.0).astype(float).abs().sum(axis=1).eq(0.0)
-
-    drop_mask = cfop_empty & all_zero
-    return df.loc[~drop_mask].reset_index(drop=True)
+    return exclude_rows(df, REGRAS_PADRAO["bi"] if regras is None else regras, only=["lixo"])
 
 
-def bi_es_excluir_lixo(out: pd.DataFrame, cfop_series: pd.Series) -> Tuple[pd.DataFrame, pd.Series]:
+def bi_es_excluir_lixo(out: pd.DataFrame, cfop_series: pd.Series,
+                       regras: Optional[List[Dict]] = None) -> Tuple[pd.DataFrame, pd.Series]:
     """Remove linhas quando CFOP vazio E (v_cont, v_icms, v_st, v_ipi) = 0."""
     if out is None or out.empty or cfop_series is None:
         return out, cfop_series
@@ -156,30 +294,30 @@ def bi_es_excluir_lixo(out: pd.DataFrame, cfop_series: pd.Series) -> Tuple[pd.Da
     if not all(c in out.columns for c in req):
         return out, cfop_series
 
-    sum_vals = out[req].fillna(0.0).astype(float).abs().sum(axis=1)
-    cfop_digits = cfop_series.map(clean_code_main).astype(str).fillna("").str.replace(r"\D+", "", regex=True)
-    cfop_empty = cfop_digits.str.len().eq(0)
-    all_zero = sum_vals.eq(0.0)
-
-    drop_mask = cfop_empty & all_zero
+    keep, _counts = apply_rules(out.assign(cfop=cfop_series), REGRAS_PADRAO["bi"] if regras is None else regras,
+                                only=["lixo"])
     return (
-        out.loc[~drop_mask].reset_index(drop=True),
-        cfop_series.loc[~drop_mask].reset_index(drop=True),
+        out.loc[keep].reset_index(drop=True),
+        cfop_series.loc[keep].reset_index(drop=True),
     )
 
 
 # =============================================================================
 # Funções de Carregamento de BI
 # =============================================================================
-def load_bi_strict(file, label_for_errors: str) -> Optional[pd.DataFrame]:
+def load_bi_strict(file, label_for_errors: str, regras: Optional[List[Dict]] = None) -> Optional[pd.DataFrame]:
     """Carrega BI com verificação estrita de cabeçalhos."""
     if file is None:
         return None
 
+    diag = _new_diagnostics(file)
     raw = file.read()
-    df = _try_read_as_excel(raw)
-    if df is None:
+    diag["formato"] = sniff_format(raw)
+    diag["engine"] = EXCEL_ENGINES.get(diag["formato"], "csv")
+    if diag["engine"] == "csv":
         df = _try_read_as_csv(raw)
+    else:
+        df = _try_read_as_excel(raw, diag)
 
     if df is None:
         raise ValueError(f"{label_for_errors}: não foi possível interpretar como Excel (xlsx/xls) nem como CSV.")
@@ -206,26 +344,14 @@ def load_bi_strict(file, label_for_errors: str) -> Optional[pd.DataFrame]:
         if src in df.columns:
             df[dst] = df[src]
 
-    # Limpeza: excluir quando CFOP vazio E todos os valores zerados
     val_cols = [c for c in ["valor_contabil", "vl_icms", "vl_st", "vl_ipi"] if c in df.columns]
     for c in val_cols:
-        df[c] = df[c].map(to_number_br_main)
-
-    cfop_series = df["CFOP"] if "CFOP" in df.columns else pd.Series([""] * len(df), index=df.index)
-    cfop_digits = cfop_series.map(clean_code_main)
-    cfop_empty = cfop_digits.eq("")
-
-    all_zero = (
-        df[val_cols].fillna(0.0).astype(float).abs().sum(axis=1).eq(0.0)
-        if val_cols else pd.Series(False, index=df.index)
-    )
-
-    drop_mask = cfop_empty & all_zero
-    df = df.loc[~drop_mask].reset_index(drop=True)
+        df[c] = to_number_br_series(df[c])
 
-    # Aplicar filtro da coluna "Cancelada" se ela existir
-    df = filter_cancelada(df)
+    # Exclusões (lixo: CFOP vazio E valores zerados; Cancelada vazia) num único recorte
+    df = exclude_rows(df, REGRAS_PADRAO["bi"] if regras is None else regras)
 
+    _finish_diagnostics(diag, df)
     return df
 
 
@@ -261,9 +387,9 @@ def detect_bi_columns(df: pd.DataFrame) -> Dict[str, Optional[str]]:
     return cols
 
 
-def load_bi_es(file) -> Tuple[pd.DataFrame, pd.Series]:
-    """Lê BI de Entradas/Saídas, normaliza campos e remove 'lixo'."""
-    df = read_excel_best_main(file)
+def load_bi_es(file, regras: Optional[List[Dict]] = None) -> Tuple[pd.DataFrame, pd.Series]:
+    """Lê BI de Entradas/Saídas, normaliza campos (valores em centavos) e remove 'lixo'."""
+    df = _read_best_sheet(file)
     cols = detect_bi_columns(df)
 
     if cols.get("cfop"):
@@ -271,54 +397,28 @@ def load_bi_es(file) -> Tuple[pd.DataFrame, pd.Series]:
     else:
         cfop_raw = pd.Series([""] * len(df), index=df.index)
 
-    cfop_series = cfop_raw.map(clean_code_main)
+    cfop_series = clean_code_series(cfop_raw)
 
     out = pd.DataFrame({
-        "la_cont": df[cols["la_cont"]].map(clean_code_main),
-        "la_icms": df[cols["la_icms"]].map(clean_code_main),
-        "la_st":   df[cols["la_st"]].map(clean_code_main),
-        "la_ipi":  df[cols["la_ipi"]].map(clean_code_main),
-        "v_cont":  df[cols["v_cont"]].map(to_number_br_main),
-        "v_icms":  df[cols["v_icms"]].map(to_number_br_main),
-        "v_st":    df[cols["v_st"]].map(to_number_br_main),
-        "v_ipi":   df[cols["v_ipi"]].map(to_number_br_main),
+        "la_cont": clean_code_series(df[cols["la_cont"]]),
+        "la_icms": clean_code_series(df[cols["la_icms"]]),
+        "la_st":   clean_code_series(df[cols["la_st"]]),
+        "la_ipi":  clean_code_series(df[cols["la_ipi"]]),
+        "v_cont":  to_cents_br_series(df[cols["v_cont"]]),
+        "v_icms":  to_cents_br_series(df[cols["v_icms"]]),
+        "v_st":    to_cents_br_series(df[cols["v_st"]]),
+        "v_ipi":   to_cents_br_series(df[cols["v_ipi"]]),
     })
 
     # Adicionar coluna cancelada se existir
     if cols.get("cancelada"):
         out["cancelada"] = df[cols["cancelada"]]
 
-    for c in ["la_cont", "la_icms", "la_st", "la_ipi"]:
-        out[c] = out[c].map(clean_code_main)
-
-    # Aplicar filtro da coluna "Cancelada" antes da limpeza de lixo
-    if "cancelada" in out.columns:
-        cancelada_empty = (
-            out["cancelada"].isna() |
-            out["cancelada"].astype(str).str.strip().eq("") |
-            out["cancelada"].astype(str).str.lower().isin(["nan", "none", "null"])
-        )
-        # Remove linhas onde Cancelada está vazia
-        keep_mask = ~cancelada_empty
-        out = out.loc[keep_mask].reset_index(drop=True)
-        cfop_series = cfop_series.loc[keep_mask].reset_index(drop=True)
-
-    # Limpeza de lixo
-    cfop_digits = (
-        cfop_series.astype(str)
-        .fillna("")
-        .str.replace(r"\D+", "", regex=True)
-    )
-    cfop_empty = cfop_digits.str.len().eq(0)
-
-    all_zero = (
-        out[["v_cont", "v_icms", "v_st", "v_ipi"]]
-        .fillna(0.0).astype(float).abs().sum(axis=1).eq(0.0)
-    )
-
-    drop_mask = cfop_empty & all_zero
-    out = out.loc[~drop_mask].reset_index(drop=True)
-    cfop_series = cfop_series.loc[~drop_mask].reset_index(drop=True)
+    # Exclusões (Cancelada vazia; lixo: CFOP vazio E valores zerados) num único recorte
+    keep, counts = apply_rules(out.assign(cfop=cfop_series), REGRAS_PADRAO["bi"] if regras is None else regras)
+    out = out.loc[keep].reset_index(drop=True)
+    out.attrs["exclusoes"] = counts
+    cfop_series = cfop_series.loc[keep].reset_index(drop=True)
 
     return out, cfop_series
 
@@ -327,29 +427,28 @@ def load_bi_es(file) -> Tuple[pd.DataFrame, pd.Series]:
 # Funções de Agregação
 # =============================================================================
 def aggregate_bi_all(bi: pd.DataFrame) -> pd.DataFrame:
-    """Agrega dados do BI por lançamento."""
+    """Agrega dados do BI por lançamento (códigos já normalizados, valores em centavos)."""
     stacks = []
     for c_l, c_v in [("la_cont", "v_cont"), ("la_icms", "v_icms"), ("la_st", "v_st"), ("la_ipi", "v_ipi")]:
         tmp = bi[[c_l, c_v]].copy()
         tmp.columns = ["lancamento", "valor"]
-        tmp["lancamento"] = tmp["lancamento"].map(clean_code_main)
         tmp = tmp[tmp["lancamento"] != ""]
         stacks.append(tmp)
     long = pd.concat(stacks, ignore_index=True) if stacks else pd.DataFrame(columns=["lancamento", "valor"])
-    long["valor"] = long["valor"].fillna(0.0).astype(float)
+    long["valor"] = long["valor"].fillna(0).astype(CENTS_DTYPE)
     return (long.groupby("lancamento", as_index=False)["valor"].sum().rename(columns={"valor": "valor_bi"}))
 
 
 def cfop_missing_matrix_es(bi_df: pd.DataFrame, cfop_series: pd.Series) -> pd.DataFrame:
-    """Cria matriz de lacunas por CFOP para Entradas/Saídas."""
+    """Cria matriz de lacunas por CFOP para Entradas/Saídas (saída de load_bi_es)."""
     if cfop_series is None or cfop_series.empty:
         return pd.DataFrame()
     aux = pd.DataFrame({
-        "CFOP": cfop_series.map(clean_code_main),
-        "has_cont": ~bi_df["la_cont"].map(is_empty_code_main),
-        "has_icms": ~bi_df["la_icms"].map(is_empty_code_main),
-        "has_st":   ~bi_df["la_st"].map(is_empty_code_main),
-        "has_ipi":  ~bi_df["la_ipi"].map(is_empty_code_main),
+        "CFOP": cfop_series,
+        "has_cont": ~is_empty_code_series(bi_df["la_cont"]),
+        "has_icms": ~is_empty_code_series(bi_df["la_icms"]),
+        "has_st":   ~is_empty_code_series(bi_df["la_st"]),
+        "has_ipi":  ~is_empty_code_series(bi_df["la_ipi"]),
     })
     aux = aux[aux["CFOP"] != ""]
     grp = aux.groupby("CFOP").agg({"has_cont": "any", "has_icms": "any", "has_st": "any", "has_ipi": "any"}).reset_index()
@@ -382,25 +481,21 @@ def _find_col(df: pd.DataFrame, *alvos: str) -> Optional[str]:
     return None
 
 
-def load_bi_servico(file) -> Tuple[pd.DataFrame, pd.Series, pd.DataFrame]:
-    """Carrega BI de Serviços."""
-    df = read_excel_best_main(file)
+def load_bi_servico(file, regras: Optional[List[Dict]] = None) -> Tuple[pd.DataFrame, pd.Series, pd.DataFrame]:
+    """Carrega BI de Serviços (valor_bi em centavos)."""
+    df = _read_best_sheet(file)
 
-    # Filtrar pela coluna "Cancelada" se ela existir
+    # Filtrar pela coluna "Cancelada" se ela existir (regra "cancelada")
     cancelada_col = _find_col(df, "cancelada")
     if cancelada_col:
-        cancelada_empty = (
-            df[cancelada_col].isna() |
-            df[cancelada_col].astype(str).str.strip().eq("") |
-            df[cancelada_col].astype(str).str.lower().isin(["nan", "none", "null"])
-        )
-        # Remove linhas onde Cancelada está vazia
-        df = df.loc[~cancelada_empty].reset_index(drop=True)
+        keep, _counts = apply_rules(df[[cancelada_col]].set_axis(["cancelada"], axis=1),
+                                    REGRAS_PADRAO["bi"] if regras is None else regras, only=["cancelada"])
+        df = df.loc[keep].reset_index(drop=True)
 
     cfop_col = _find_col(df, "cfop")
     cfop_series = pd.Series([], dtype="object")
     if cfop_col:
-        cfop_series = df[cfop_col].map(clean_code_main)
+        cfop_series = clean_code_series(df[cfop_col])
 
     stacks, pres_cols = [], {}
     for code_label, val_opts, lbl in SERV_COLS:
@@ -409,8 +504,9 @@ def load_bi_servico(file) -> Tuple[pd.DataFrame, pd.Series, pd.DataFrame]:
         for vname in val_opts:
             c_val = c_val or _find_col(df, vname, vname.replace(".", " ").replace("  ", " "))
         if c_cod and c_val:
-            pres_cols[lbl] = ~df[c_cod].map(is_empty_code_main)
-            tmp = pd.DataFrame({"lancamento": df[c_cod].map(clean_code_main), "valor": df[c_val].map(to_number_br_main)})
+            lanc = clean_code_series(df[c_cod])
+            pres_cols[lbl] = ~is_empty_code_series(lanc)
+            tmp = pd.DataFrame({"lancamento": lanc, "valor": to_cents_br_series(df[c_val])})
             tmp = tmp[(tmp["lancamento"] != "") & (tmp["valor"].notna())]
             stacks.append(tmp)
 
@@ -418,13 +514,13 @@ def load_bi_servico(file) -> Tuple[pd.DataFrame, pd.Series, pd.DataFrame]:
         raise ValueError("Não encontrei nenhuma dupla código/valor do BI de Serviços.")
 
     long = pd.concat(stacks, ignore_index=True)
-    long["valor"] = long["valor"].fillna(0.0).astype(float)
+    long["valor"] = long["valor"].fillna(0).astype(CENTS_DTYPE)
     agg = long.groupby("lancamento", as_index=False)["valor"].sum().rename(columns={"valor": "valor_bi"})
 
     # Matriz de lacunas por CFOP
     missing_matrix_srv = pd.DataFrame()
     if not cfop_series.empty and pres_cols:
-        aux = pd.DataFrame({"CFOP": cfop_series.map(clean_code_main)})
+        aux = pd.DataFrame({"CFOP": cfop_series})
         for lbl, ser in pres_cols.items():
             aux[lbl] = ser.fillna(False).astype(bool)
         aux = aux[aux["CFOP"] != ""]
@@ -454,11 +550,13 @@ def safe_to_number(val):
     return to_number_br_main(val)
 
 
-def read_excel_hybrid(xls, sheet_name):
+def read_excel_hybrid(xls, sheet_name, select=None):
     """
     Lê Excel preservando códigos como string e valores como números.
     Colunas de código devem ser string para preservar zeros à esquerda.
     Colunas de valores devem ser números para evitar conversão errada.
+    `select` recebe os nomes do cabeçalho e devolve as colunas a carregar (pode levantar
+    erro antes de os dados serem lidos); sem ele todas as colunas são carregadas.
     """
     # Definir quais colunas devem ser lidas como string (códigos)
     code_columns = [
@@ -470,334 +568,203 @@ def read_excel_hybrid(xls, sheet_name):
         'Cancelada'
     ]
 
-    # Ler todas as colunas primeiro para ver quais existem
-    df_temp = pd.read_excel(xls, sheet_name=sheet_name, nrows=0)
-    existing_code_cols = [c for c in code_columns if c in df_temp.columns]
+    # Só o cabeçalho primeiro, para ver quais colunas existem
+    header = _sheet_columns(xls, sheet_name)
+    existing_code_cols = [c for c in code_columns if c in header]
 
     # Criar dtype dict: códigos como str, resto como padrão (números ficam como float)
     dtype_dict = {col: str for col in existing_code_cols}
+    usecols = _only(select(header)) if select is not None else None
 
-    # Ler o Excel com dtypes específicos
-    df = pd.read_excel(xls, sheet_name=sheet_name, dtype=dtype_dict)
+    # Ler o Excel com dtypes específicos (e só as colunas escolhidas)
+    df = pd.read_excel(xls, sheet_name=sheet_name, dtype=dtype_dict, usecols=usecols)
     df.columns = [str(c) for c in df.columns]
 
     return df
 
 
-# =============================================================================
-# Função para carregar arquivo único com múltiplas abas
-# =============================================================================
-def load_bi_multisheet(file) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
-    """
-    Carrega um único arquivo Excel com as abas 'Saída' e 'Entrada'.
-    Retorna duas tuplas: (bi_df_saida, cfop_saida), (bi_df_entrada, cfop_entrada)
-    """
-    if file is None:
-        return None, None
+def _read_sheet_hybrid(wb: Dict, sheet_name: str, select) -> pd.DataFrame:
+    """read_excel_hybrid via cache: `select` recebe o cabeçalho (também do cache) antes de tudo."""
+    columns = select(_wb_header(wb, sheet_name))
+    return _wb_read(wb, sheet_name, "hibrido", columns,
+                    lambda xls: read_excel_hybrid(xls, sheet_name, lambda _header: columns))
 
-    raw = file.read()
-    bio = io.BytesIO(raw)
 
-    try:
-        xls = pd.ExcelFile(bio, engine="openpyxl")
-    except Exception:
-        try:
-            bio = io.BytesIO(raw)
-            xls = pd.ExcelFile(bio, engine="xlrd")
-        except Exception as e:
-            raise ValueError(f"Não foi possível abrir o arquivo Excel: {e}")
+# =============================================================================
+# Pipeline das abas Entrada/Saída (arquivo único com múltiplas abas)
+# =============================================================================
+# origem -> nomes aceitos para a aba (sem diferenciar maiúsculas e espaços nas pontas)
+BI_SHEETS = {"Entrada": ("entrada",), "Saída": ("saída", "saida")}
 
-    # Verificar abas disponíveis
-    available_sheets = xls.sheet_names
+ES_CODE_KEYS = ["la_cont", "la_icms", "la_st", "la_ipi"]
+ES_VALUE_KEYS = ["v_cont", "v_icms", "v_st", "v_ipi"]
 
-    # Procurar pelas abas necessárias (case-insensitive)
-    entrada_sheet = None
-    saida_sheet = None
 
-    for sheet in available_sheets:
-        sheet_lower = sheet.lower().strip()
-        if sheet_lower == "entrada":
-            entrada_sheet = sheet
-        elif sheet_lower == "saída" or sheet_lower == "saida":
-            saida_sheet = sheet
+def find_bi_sheets(sheet_names: List[str]) -> List[Tuple[str, str]]:
+    """Pares (origem, aba) das abas Entrada/Saída encontradas, na ordem de BI_SHEETS."""
+    found = {}
+    for sheet in sheet_names:
+        for origem, nomes in BI_SHEETS.items():
+            if sheet.lower().strip() in nomes:
+                found[origem] = sheet
+    return [(origem, found[origem]) for origem in BI_SHEETS if origem in found]
 
-    result_entrada = None
-    result_saida = None
 
-    # Processar aba Entrada
-    if entrada_sheet:
+def run_bi_pipeline(wb: Dict, sheets: List[Tuple[str, str]], select, normalize,
+                    error_msg: str) -> List[Tuple[pd.DataFrame, pd.Series]]:
+    """
+    Etapas por aba: ler (só as colunas que `select(origem, cabeçalho)` escolher, códigos como
+    string e valores como número) → `normalize(origem, df)`, que monta o frame tipado com a
+    coluna 'origem' e devolve junto a máscara das linhas a manter (regras de exclusão; o
+    recorte fica a cargo de quem chama, uma única vez).
+    As abas são processadas em paralelo; o resultado segue a ordem de `sheets` e, havendo
+    erro, vale o da primeira aba, formatado por `error_msg` ({origem} e {erro}).
+    """
+    def run(origem, sheet):
         try:
-            # Ler com tipos híbridos (códigos como string, valores como float)
-            df_entrada = read_excel_hybrid(xls, entrada_sheet)
-
-            # Processar como BI ES
-            cols = detect_bi_columns(df_entrada)
-
-            if cols.get("cfop"):
-                cfop_raw = df_entrada[cols["cfop"]]
-            else:
-                cfop_raw = pd.Series([""] * len(df_entrada), index=df_entrada.index)
-
-            cfop_series = cfop_raw.map(clean_code_main)
-
-            out = pd.DataFrame({
-                "la_cont": df_entrada[cols["la_cont"]].map(clean_code_main),
-                "la_icms": df_entrada[cols["la_icms"]].map(clean_code_main),
-                "la_st":   df_entrada[cols["la_st"]].map(clean_code_main),
-                "la_ipi":  df_entrada[cols["la_ipi"]].map(clean_code_main),
-                "v_cont":  df_entrada[cols["v_cont"]].map(safe_to_number),
-                "v_icms":  df_entrada[cols["v_icms"]].map(safe_to_number),
-                "v_st":    df_entrada[cols["v_st"]].map(safe_to_number),
-                "v_ipi":   df_entrada[cols["v_ipi"]].map(safe_to_number),
-            })
-
-            # Adicionar coluna cancelada se existir
-            if cols.get("cancelada"):
-                out["cancelada"] = df_entrada[cols["cancelada"]]
-
-            for c in ["la_cont", "la_icms", "la_st", "la_ipi"]:
-                out[c] = out[c].map(clean_code_main)
-
-            # Aplicar filtro da coluna "Cancelada" antes da limpeza de lixo
-            if "cancelada" in out.columns:
-                cancelada_empty = (
-                    out["cancelada"].isna() |
-                    out["cancelada"].astype(str).str.strip().eq("") |
-                    out["cancelada"].astype(str).str.lower().isin(["nan", "none", "null"])
-                )
-                keep_mask = ~cancelada_empty
-                out = out.loc[keep_mask].reset_index(drop=True)
-                cfop_series = cfop_series.loc[keep_mask].reset_index(drop=True)
-
-            # Limpeza de lixo
-            cfop_digits = (
-                cfop_series.astype(str)
-                .fillna("")
-                .str.replace(r"\D+", "", regex=True)
-            )
-            cfop_empty = cfop_digits.str.len().eq(0)
-
-            all_zero = (
-                out[["v_cont", "v_icms", "v_st", "v_ipi"]]
-                .fillna(0.0).astype(float).abs().sum(axis=1).eq(0.0)
-            )
-
-            drop_mask = cfop_empty & all_zero
-            out = out.loc[~drop_mask].reset_index(drop=True)
-            cfop_series = cfop_series.loc[~drop_mask].reset_index(drop=True)
-
-            result_entrada = (out, cfop_series)
+            return normalize(origem, _read_sheet_hybrid(wb, sheet, lambda header: select(origem, header)))
         except Exception as e:
-            raise ValueError(f"Erro ao processar aba 'Entrada': {e}")
+            raise ValueError(error_msg.format(origem=origem, erro=e))
 
-    # Processar aba Saída
-    if saida_sheet:
-        try:
-            # Ler com tipos híbridos (códigos como string, valores como float)
-            df_saida = read_excel_hybrid(xls, saida_sheet)
-
-            # Processar como BI ES
-            cols = detect_bi_columns(df_saida)
-
-            if cols.get("cfop"):
-                cfop_raw = df_saida[cols["cfop"]]
-            else:
-                cfop_raw = pd.Series([""] * len(df_saida), index=df_saida.index)
-
-            cfop_series = cfop_raw.map(clean_code_main)
-
-            out = pd.DataFrame({
-                "la_cont": df_saida[cols["la_cont"]].map(clean_code_main),
-                "la_icms": df_saida[cols["la_icms"]].map(clean_code_main),
-                "la_st":   df_saida[cols["la_st"]].map(clean_code_main),
-                "la_ipi":  df_saida[cols["la_ipi"]].map(clean_code_main),
-                "v_cont":  df_saida[cols["v_cont"]].map(safe_to_number),
-                "v_icms":  df_saida[cols["v_icms"]].map(safe_to_number),
-                "v_st":    df_saida[cols["v_st"]].map(safe_to_number),
-                "v_ipi":   df_saida[cols["v_ipi"]].map(safe_to_number),
-            })
-
-            # Adicionar coluna cancelada se existir
-            if cols.get("cancelada"):
-                out["cancelada"] = df_saida[cols["cancelada"]]
-
-            for c in ["la_cont", "la_icms", "la_st", "la_ipi"]:
-                out[c] = out[c].map(clean_code_main)
-
-            # Aplicar filtro da coluna "Cancelada" antes da limpeza de lixo
-            if "cancelada" in out.columns:
-                cancelada_empty = (
-                    out["cancelada"].isna() |
-                    out["cancelada"].astype(str).str.strip().eq("") |
-                    out["cancelada"].astype(str).str.lower().isin(["nan", "none", "null"])
-                )
-                keep_mask = ~cancelada_empty
-                out = out.loc[keep_mask].reset_index(drop=True)
-                cfop_series = cfop_series.loc[keep_mask].reset_index(drop=True)
-
-            # Limpeza de lixo
-            cfop_digits = (
-                cfop_series.astype(str)
-                .fillna("")
-                .str.replace(r"\D+", "", regex=True)
-            )
-            cfop_empty = cfop_digits.str.len().eq(0)
+    if len(sheets) < 2:
+        return [run(origem, sheet) for origem, sheet in sheets]
+    with ThreadPoolExecutor(max_workers=len(sheets)) as pool:
+        futures = [pool.submit(run, origem, sheet) for origem, sheet in sheets]
+        return [f.result() for f in futures]
 
-            all_zero = (
-                out[["v_cont", "v_icms", "v_st", "v_ipi"]]
-                .fillna(0.0).astype(float).abs().sum(axis=1).eq(0.0)
-            )
 
-            drop_mask = cfop_empty & all_zero
-            out = out.loc[~drop_mask].reset_index(drop=True)
-            cfop_series = cfop_series.loc[~drop_mask].reset_index(drop=True)
+def load_bi_multisheet(file, regras: Optional[List[Dict]] = None) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """
+    Carrega um único arquivo Excel com as abas 'Saída' e 'Entrada'.
+    Retorna duas tuplas: (bi_df_saida, cfop_saida), (bi_df_entrada, cfop_entrada)
+    Os valores (v_cont, v_icms, v_st, v_ipi) vêm em centavos (int64).
+    As linhas excluídas por regra ficam em bi_df.attrs["exclusoes"].
+    """
+    if file is None:
+        return None, None
+    regras = REGRAS_PADRAO["bi"] if regras is None else regras
+
+    diag = _new_diagnostics(file)
+    raw = file.read()
 
-            result_saida = (out, cfop_series)
-        except Exception as e:
-            raise ValueError(f"Erro ao processar aba 'Saída': {e}")
+    try:
+        wb = _open_workbook(raw, diag)
+    except Exception as e:
+        raise ValueError(f"Não foi possível abrir o arquivo Excel: {e}")
 
-    if result_entrada is None and result_saida is None:
+    available_sheets = wb["layout"]["sheets"]
+    sheets = find_bi_sheets(available_sheets)
+    if not sheets:
         raise ValueError(
             f"Não foram encontradas as abas 'Entrada' ou 'Saída' no arquivo. "
             f"Abas disponíveis: {', '.join(available_sheets)}"
         )
 
+    # Colunas detectadas pelo cabeçalho de cada aba; só elas são lidas
+    detected = {}
+
+    def select(origem, header):
+        cols = detected[origem] = detect_bi_columns(pd.DataFrame(columns=header))
+        return [c for c in cols.values() if c]
+
+    def normalize(origem, df):
+        # Cada coluna é convertida uma única vez; as regras de exclusão viram uma só máscara
+        cols = detected[origem]
+        cfop_raw = df[cols["cfop"]] if cols.get("cfop") else pd.Series([""] * len(df), index=df.index)
+        data = {"origem": origem, "cfop": clean_code_series(cfop_raw)}
+        data.update({k: clean_code_series(df[cols[k]]) for k in ES_CODE_KEYS})
+        data.update({k: to_cents_br_series(df[cols[k]]) for k in ES_VALUE_KEYS})
+        if cols.get("cancelada"):
+            data["cancelada"] = df[cols["cancelada"]]
+        out = pd.DataFrame(data, index=df.index)
+        keep, out.attrs["exclusoes"] = apply_rules(out, regras)
+        return out, keep
+
+    results = {}
+    for (origem, _sheet), (out, keep) in zip(
+        sheets, run_bi_pipeline(wb, sheets, select, normalize, "Erro ao processar aba '{origem}': {erro}")
+    ):
+        out = out.loc[keep].reset_index(drop=True)
+        cfop_series = out["cfop"].rename(detected[origem].get("cfop"))
+        results[origem] = (out.drop(columns=["origem", "cfop"]), cfop_series)
+
+    result_entrada, result_saida = results.get("Entrada"), results.get("Saída")
+    _finish_diagnostics(diag, *(r[0] for r in (result_entrada, result_saida) if r is not None))
     return result_entrada, result_saida
 
 
-def load_bi_strict_multisheet(file, label_for_errors: str) -> Optional[pd.DataFrame]:
+def load_bi_strict_multisheet(file, label_for_errors: str,
+                              regras: Optional[List[Dict]] = None) -> Optional[pd.DataFrame]:
     """
     Carrega arquivo Excel único com abas 'Entrada' e 'Saída' usando validação estrita.
-    Retorna DataFrame consolidado com ambas as abas.
+    Retorna DataFrame consolidado com ambas as abas (exclusões por regra em attrs["exclusoes"]).
     """
     if file is None:
         return None
+    regras = REGRAS_PADRAO["bi"] if regras is None else regras
 
+    diag = _new_diagnostics(file)
     raw = file.read()
-    bio = io.BytesIO(raw)
 
     try:
-        xls = pd.ExcelFile(bio, engine="openpyxl")
-    except Exception:
-        try:
-            bio = io.BytesIO(raw)
-            xls = pd.ExcelFile(bio, engine="xlrd")
-        except Exception as e:
-            raise ValueError(f"{label_for_errors}: não foi possível abrir o arquivo Excel: {e}")
+        wb = _open_workbook(raw, diag)
+    except Exception as e:
+        raise ValueError(f"{label_for_errors}: não foi possível abrir o arquivo Excel: {e}")
 
-    # Verificar abas disponíveis
-    available_sheets = xls.sheet_names
-
-    # Procurar pelas abas necessárias (case-insensitive)
-    entrada_sheet = None
-    saida_sheet = None
-
-    for sheet in available_sheets:
-        sheet_lower = sheet.lower().strip()
-        if sheet_lower == "entrada":
-            entrada_sheet = sheet
-        elif sheet_lower == "saída" or sheet_lower == "saida":
-            saida_sheet = sheet
-
-    dfs = []
-
-    # Processar aba Entrada
-    if entrada_sheet:
-        try:
-            # Ler com tipos híbridos (códigos como string, valores como float)
-            df_entrada = read_excel_hybrid(xls, entrada_sheet)
-
-            # Validar cabeçalhos
-            missing = [c for c in REQUIRED_COLS_DISPLAY if c not in df_entrada.columns]
-            if missing:
-                raise ValueError(
-                    f"{label_for_errors} (aba Entrada): cabeçalhos faltantes {missing}. "
-                    f"Os cabeçalhos devem ser estritamente iguais a: {REQUIRED_COLS_DISPLAY}. "
-                    f"Colunas encontradas: {list(df_entrada.columns)}"
-                )
-
-            present_optional = [c for c in OPTIONAL_VALUE_COLS if c in df_entrada.columns]
-            keep = REQUIRED_COLS_DISPLAY + present_optional
-            df_entrada = df_entrada[keep].copy()
-
-            # Mapeia para nomes internos
-            for src, dst in INTERNAL_KEYS.items():
-                if src in df_entrada.columns and dst != src:
-                    df_entrada[dst] = df_entrada[src]
-            for src, dst in INTERNAL_VALUE_KEYS.items():
-                if src in df_entrada.columns:
-                    # Já vem como float do read_excel_hybrid, apenas garantir que é numérico
-                    df_entrada[dst] = pd.to_numeric(df_entrada[src], errors='coerce').fillna(0.0)
-
-            # Aplicar filtro da coluna "Cancelada" se ela existir
-            df_entrada = filter_cancelada(df_entrada)
-
-            df_entrada["origem"] = "Entrada"
-            dfs.append(df_entrada)
-        except Exception as e:
-            raise ValueError(f"{label_for_errors}: erro ao processar aba 'Entrada': {e}")
-
-    # Processar aba Saída
-    if saida_sheet:
-        try:
-            # Ler com tipos híbridos (códigos como string, valores como float)
-            df_saida = read_excel_hybrid(xls, saida_sheet)
-
-            # Validar cabeçalhos
-            missing = [c for c in REQUIRED_COLS_DISPLAY if c not in df_saida.columns]
-            if missing:
-                raise ValueError(
-                    f"{label_for_errors} (aba Saída): cabeçalhos faltantes {missing}. "
-                    f"Os cabeçalhos devem ser estritamente iguais a: {REQUIRED_COLS_DISPLAY}. "
-                    f"Colunas encontradas: {list(df_saida.columns)}"
-                )
-
-            present_optional = [c for c in OPTIONAL_VALUE_COLS if c in df_saida.columns]
-            keep = REQUIRED_COLS_DISPLAY + present_optional
-            df_saida = df_saida[keep].copy()
-
-            # Mapeia para nomes internos
-            for src, dst in INTERNAL_KEYS.items():
-                if src in df_saida.columns and dst != src:
-                    df_saida[dst] = df_saida[src]
-            for src, dst in INTERNAL_VALUE_KEYS.items():
-                if src in df_saida.columns:
-                    # Já vem como float do read_excel_hybrid, apenas garantir que é numérico
-                    df_saida[dst] = pd.to_numeric(df_saida[src], errors='coerce').fillna(0.0)
-
-            # Aplicar filtro da coluna "Cancelada" se ela existir
-            df_saida = filter_cancelada(df_saida)
-
-            df_saida["origem"] = "Saída"
-            dfs.append(df_saida)
-        except Exception as e:
-            raise ValueError(f"{label_for_errors}: erro ao processar aba 'Saída': {e}")
-
-    if not dfs:
+    available_sheets = wb["layout"]["sheets"]
+    sheets = find_bi_sheets(available_sheets)
+    if not sheets:
         raise ValueError(
             f"{label_for_errors}: não foram encontradas as abas 'Entrada' ou 'Saída' no arquivo. "
             f"Abas disponíveis: {', '.join(available_sheets)}"
         )
 
-    # Consolidar ambas as abas
-    bi_all = pd.concat(dfs, ignore_index=True)
-
-    # Limpeza: excluir quando CFOP vazio E todos os valores zerados
+    # Validar cabeçalhos antes de ler os dados; só as colunas usadas são carregadas
+    def select(origem, header):
+        keep = _strict_columns(header)
+        if keep is None:
+            missing = [c for c in REQUIRED_COLS_DISPLAY if c not in header]
+            raise ValueError(
+                f"{label_for_errors} (aba {origem}): cabeçalhos faltantes {missing}. "
+                f"Os cabeçalhos devem ser estritamente iguais a: {REQUIRED_COLS_DISPLAY}. "
+                f"Colunas encontradas: {header}"
+            )
+        return keep
+
+    def normalize(origem, df):
+        # Colunas originais + nomes internos (valores já vêm como número do read_excel_hybrid)
+        data = {c: df[c] for c in _strict_columns(list(df.columns))}
+        for src, dst in INTERNAL_KEYS.items():
+            if src in df.columns and dst != src:
+                data[dst] = df[src]
+        for src, dst in INTERNAL_VALUE_KEYS.items():
+            if src in df.columns:
+                data[dst] = pd.to_numeric(df[src], errors='coerce').fillna(0.0)
+        data["origem"] = origem
+        out = pd.DataFrame(data, index=df.index)
+        # 'Cancelada' é avaliada por aba: após o concat, abas sem a coluna teriam NaN (= vazia)
+        keep, out.attrs["exclusoes"] = apply_rules(out, regras, only=["cancelada"])
+        return out, keep
+
+    parts = run_bi_pipeline(wb, sheets, select, normalize,
+                            f"{label_for_errors}: erro ao processar aba '{{origem}}': {{erro}}")
+
+    # Consolidar ambas as abas; as exclusões viram um único recorte
+    bi_all = pd.concat([out for out, _ in parts], ignore_index=True)
+    keep = pd.concat([k for _, k in parts], ignore_index=True)
+    counts = merge_counts(*(out.attrs["exclusoes"] for out, _ in parts))
+
+    # Abas sem alguma coluna de valor ficam com NaN após o concat: tratar como zero
     val_cols = [c for c in ["valor_contabil", "vl_icms", "vl_st", "vl_ipi"] if c in bi_all.columns]
-    # Valores já vêm como float, apenas garantir que são numéricos
     for c in val_cols:
-        bi_all[c] = pd.to_numeric(bi_all[c], errors='coerce').fillna(0.0)
-
-    cfop_series = bi_all["CFOP"] if "CFOP" in bi_all.columns else pd.Series([""] * len(bi_all), index=bi_all.index)
-    cfop_digits = cfop_series.map(clean_code_main)
-    cfop_empty = cfop_digits.eq("")
-
-    all_zero = (
-        bi_all[val_cols].fillna(0.0).astype(float).abs().sum(axis=1).eq(0.0)
-        if val_cols else pd.Series(False, index=bi_all.index)
-    )
+        if bi_all[c].hasnans:
+            bi_all[c] = bi_all[c].fillna(0.0)
 
-    drop_mask = cfop_empty & all_zero
-    bi_all = bi_all.loc[~drop_mask].reset_index(drop=True)
+    # Demais regras (lixo: CFOP vazio E todos os valores zerados, e as do cliente) no frame único
+    keep, rest_counts = apply_rules(bi_all, regras, only=[r["nome"] for r in regras if r["nome"] != "cancelada"],
+                                    keep=keep)
+    bi_all = bi_all.loc[keep].reset_index(drop=True)
+    bi_all.attrs["exclusoes"] = merge_counts(counts, rest_counts)
 
-    return bi_all
\ No newline at end of file
+    _finish_diagnostics(diag, bi_all)
+    return bi_all
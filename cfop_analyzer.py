@@ -3,11 +3,16 @@ Módulo para análise e comparação de CFOP com base de dados.
 Responsável por validar códigos de lançamento contra a base CFOP.
 """
 
+import hashlib
 import json
+import os
+import threading
+from types import MappingProxyType
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
-from utils import clean_code_main
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple, Union
+from utils import clean_code_main, map_distinct
 
 
 # =============================================================================
@@ -19,6 +24,104 @@ def load_base_json(path: Path) -> Dict[str, Dict]:
         return json.load(f)
 
 
+# Chaves de lançamento da base, na ordem usada em todo o módulo
+_BASE_CODE_KEYS = ("contabil", "icms", "icms_subst", "ipi")
+
+
+class BaseIndex(NamedTuple):
+    """
+    Base CFOP compilada (somente leitura).
+    `cfops` e `arrays` são colunares (nome + códigos já normalizados com normalize_code_cfop),
+    `expected` é o mesmo conteúdo por CFOP para consultas pontuais e `lanc` traz os códigos
+    já limpos com clean_code_main (contabil, icms, icms_subst, ipi), como o Livro usa;
+    `lanc_table` é o mesmo mapa em forma de tabela (coluna CFOP + uma coluna por código).
+    """
+    base: Mapping[str, Dict]
+    cfops: pd.Index
+    arrays: Dict[str, np.ndarray]
+    expected: Mapping[str, Dict[str, Optional[str]]]
+    lanc: Mapping[str, Tuple[str, str, str, str]]
+    lanc_table: pd.DataFrame
+    source: Optional[Tuple[str, int, int]] = None  # (caminho, mtime_ns, tamanho)
+    digest: Optional[str] = None
+
+
+def compile_base_index(base_map: Dict[str, Dict], source: Optional[Tuple[str, int, int]] = None,
+                       digest: Optional[str] = None) -> BaseIndex:
+    """Pré-normaliza a base CFOP uma única vez: colunas indexadas por CFOP e mapas congelados."""
+    cfops = pd.Index(list(base_map.keys()), dtype=object)
+    arrays = {"nome": np.empty(len(cfops), dtype=object)}
+    arrays["nome"][:] = [b.get("nome") for b in base_map.values()]
+    for key in _BASE_CODE_KEYS:
+        arrays[key] = np.empty(len(cfops), dtype=object)
+        arrays[key][:] = [normalize_code_cfop(b.get(key)) for b in base_map.values()]
+
+    expected = {cf: {key: arrays[key][i] for key in _BASE_CODE_KEYS} for i, cf in enumerate(cfops)}
+    lanc = {cf: tuple(clean_code_main(b.get(key) or "") for key in _BASE_CODE_KEYS)
+            for cf, b in base_map.items()}
+    lanc_table = pd.DataFrame(list(lanc.values()), columns=list(_BASE_CODE_KEYS), dtype=object)
+    lanc_table.insert(0, "CFOP", pd.Series(list(lanc.keys()), dtype=object))
+    return BaseIndex(
+        base=MappingProxyType(dict(base_map)),
+        cfops=cfops,
+        arrays=arrays,
+        expected=MappingProxyType(expected),
+        lanc=MappingProxyType(lanc),
+        lanc_table=lanc_table,
+        source=source,
+        digest=digest,
+    )
+
+
+def as_base_index(base: Union[Dict[str, Dict], BaseIndex]) -> BaseIndex:
+    """Aceita a base como dict (compilada na hora) ou já compilada."""
+    return base if isinstance(base, BaseIndex) else compile_base_index(base or {})
+
+
+def diff_base_indexes(old: BaseIndex, new: BaseIndex) -> List[str]:
+    """CFOPs incluídos, removidos ou com nome/códigos de lançamento alterados entre duas versões da base."""
+    if old.digest is not None and old.digest == new.digest:
+        return []
+    changed = []
+    for cf in set(old.expected) | set(new.expected):
+        before, after = old.expected.get(cf), new.expected.get(cf)
+        if before != after or (before is not None and
+                               (old.base[cf] or {}).get("nome") != (new.base[cf] or {}).get("nome")):
+            changed.append(cf)
+    return sorted(changed)
+
+
+# Índices compilados por caminho, compartilhados por todas as sessões do processo
+_BASE_INDEXES: Dict[str, BaseIndex] = {}
+_BASE_INDEXES_LOCK = threading.Lock()
+
+
+def get_base_index(path: Path) -> BaseIndex:
+    """
+    Base CFOP compilada do arquivo, recarregada automaticamente quando ele muda.
+    Cada chamada custa um stat: com mtime e tamanho iguais devolve o índice já compilado;
+    se mudaram, relê o arquivo e só recompila se o hash do conteúdo for diferente.
+    """
+    key = str(Path(path).expanduser().resolve())
+    st = os.stat(key)
+    source = (key, st.st_mtime_ns, st.st_size)
+
+    with _BASE_INDEXES_LOCK:
+        cached = _BASE_INDEXES.get(key)
+        if cached is not None and cached.source == source:
+            return cached
+
+        with open(key, "rb") as fh:
+            data = fh.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if cached is not None and cached.digest == digest:
+            index = cached._replace(source=source)
+        else:
+            index = compile_base_index(json.loads(data.decode("utf-8")), source, digest)
+        _BASE_INDEXES[key] = index
+        return index
+
+
 # =============================================================================
 # Funções de Comparação CFOP
 # =============================================================================
@@ -30,7 +133,7 @@ def normalize_code_cfop(val: Optional[str]) -> Optional[str]:
     return s if s and s.lower() != "nan" else None
 
 
-def compare_row(cfop_code: str, row: Dict[str, Optional[str]], base_map: Dict[str, Dict]) -> Tuple[str, str, Optional[Dict], Dict, Optional[str]]:
+def compare_row(cfop_code: str, row: Dict[str, Optional[str]], base_map: Union[Dict[str, Dict], BaseIndex]) -> Tuple[str, str, Optional[Dict], Dict, Optional[str]]:
     """Compara uma linha do BI com a base CFOP."""
     cfop = normalize_code_cfop(cfop_code)
     found = {
@@ -39,6 +142,8 @@ def compare_row(cfop_code: str, row: Dict[str, Optional[str]], base_map: Dict[st
         "icms_subst": normalize_code_cfop(row.get("icms_subst")),
         "ipi": normalize_code_cfop(row.get("ipi")),
     }
+    index = base_map if isinstance(base_map, BaseIndex) else None
+    base_map = index.base if index is not None else base_map
     base = base_map.get(str(cfop)) if cfop is not None else None
 
     # Verificar ausência de lançamento automático quando valor != 0 mas código está vazio
@@ -78,12 +183,15 @@ def compare_row(cfop_code: str, row: Dict[str, Optional[str]], base_map: Dict[st
             details = "CFOP não existe na base."
         expected = None
     else:
-        expected = {
-            "contabil": normalize_code_cfop(base.get("contabil")),
-            "icms": normalize_code_cfop(base.get("icms")),
-            "icms_subst": normalize_code_cfop(base.get("icms_subst")),
-            "ipi": normalize_code_cfop(base.get("ipi")),
-        }
+        if index is not None:
+            expected = dict(index.expected[str(cfop)])
+        else:
+            expected = {
+                "contabil": normalize_code_cfop(base.get("contabil")),
+                "icms": normalize_code_cfop(base.get("icms")),
+                "icms_subst": normalize_code_cfop(base.get("icms_subst")),
+                "ipi": normalize_code_cfop(base.get("ipi")),
+            }
         zeros, mismatches = [], []
         for key, lbl in [("contabil", "Contábil"), ("icms", "ICMS"), ("icms_subst", "ICMS Subst. Trib."), ("ipi", "IPI")]:
             exp, got = expected.get(key), found.get(key)
@@ -126,57 +234,283 @@ def compare_row(cfop_code: str, row: Dict[str, Optional[str]], base_map: Dict[st
     return status, details, expected, found, nome
 
 
-def analyze_bi_against_base(bi_df: pd.DataFrame, base_map: Dict[str, Dict]) -> pd.DataFrame:
-    """Analisa todo o BI contra a base CFOP."""
-    results = []
-    for _, r in bi_df.iterrows():
-        status, details, expected, found, nome = compare_row(
-            r.get("CFOP"),
-            {
-                "contabil": r.get("contabil"),
-                "icms": r.get("icms"),
-                "icms_subst": r.get("icms_subst"),
-                "ipi": r.get("ipi"),
-                "valor_contabil": r.get("valor_contabil"),
-                "vl_icms": r.get("vl_icms"),
-                "vl_st": r.get("vl_st"),
-                "vl_ipi": r.get("vl_ipi"),
-            },
-            base_map
-        )
-
-        row_out = {
-            "origem": r.get("origem"),
-            "CFOP": r.get("CFOP"),
-            "Nome (Base)": nome,
-            "Status": status,
-            "Detalhes": details,
-            "Esperado Contábil": None if expected is None else expected.get("contabil"),
-            "Encontrado Contábil": None if expected is None else found.get("contabil"),
-            "Esperado ICMS": None if expected is None else expected.get("icms"),
-            "Encontrado ICMS": None if expected is None else found.get("icms"),
-            "Esperado ICMS Subst. Trib.": None if expected is None else expected.get("icms_subst"),
-            "Encontrado ICMS Subst. Trib.": None if expected is None else found.get("icms_subst"),
-            "Esperado IPI": None if expected is None else expected.get("ipi"),
-            "Encontrado IPI": None if expected is None else found.get("ipi"),
-        }
+# Chaves de lançamento (com rótulo) e a coluna de valor correspondente, na ordem do compare_row
+_CODE_KEYS = [
+    ("contabil", "Contábil", "valor_contabil"),
+    ("icms", "ICMS", "vl_icms"),
+    ("icms_subst", "ICMS Subst. Trib.", "vl_st"),
+    ("ipi", "IPI", "vl_ipi"),
+]
+_VALUE_LABELS = [("valor_contabil", "Valor Contábil"), ("vl_icms", "Vl. ICMS"), ("vl_st", "Vl. ST"), ("vl_ipi", "Vl. IPI")]
+
+STATUS_OK = "OK"
+STATUS_MISMATCH = "❌ Código de lançamento incorreto"
+STATUS_AUSENCIA = "🟡 Ausência de lançamento automático"
+STATUS_NOT_FOUND = "⚠️ CFOP não cadastrado"
+
+
+def _valor_existe(valor) -> bool:
+    """Valor preenchido e diferente de zero (NaN conta como preenchido, como no compare_row)."""
+    if valor is None:
+        return False
+    try:
+        return float(valor) != 0.0
+    except (ValueError, TypeError):
+        return False
+
+
+def _row_values(bi_df: pd.DataFrame, col: str, dtype) -> np.ndarray:
+    """Valores da coluna como o iterrows os entregaria (None se a coluna não existe)."""
+    if col not in bi_df.columns:
+        return np.full(len(bi_df), None, dtype=object)
+    values = bi_df[col].to_numpy(dtype=dtype)
+    if values.dtype == object:
+        # iterrows monta cada linha como Series: se a linha inteira for texto, o None vira NaN
+        rows = [i for i, v in enumerate(values) if v is None]
+        if rows:
+            values = values.copy()
+            for i, row in zip(rows, bi_df.iloc[rows].values):
+                if pd.Series(row).dtype != object:
+                    values[i] = np.nan
+    return values
+
+
+def _nonzero_flags(values: np.ndarray) -> np.ndarray:
+    """_valor_existe por linha; vetorizado quando os valores já são numéricos."""
+    if values.dtype.kind in "biuf":
+        return values.astype(float) != 0.0
+    return np.fromiter((_valor_existe(v) for v in values), dtype=bool, count=len(values))
 
-        # Sempre incluir os valores do BI no Resultado da Validação
-        for k, label in (
-            ("valor_contabil", "Valor Contábil"),
-            ("vl_icms",       "Vl. ICMS"),
-            ("vl_st",         "Vl. ST"),
-            ("vl_ipi",        "Vl. IPI"),
-        ):
-            row_out[label] = r.get(k) if k in bi_df.columns else None
 
-        results.append(row_out)
+def _signatures(keys: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Agrupa as linhas pela combinação das chaves (None/NaN formam um grupo próprio).
+    Retorna o id do grupo de cada linha (na ordem de primeira aparição) e a primeira linha de cada grupo.
+    """
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    for arr in keys:
+        codes, uniques = pd.factorize(arr)
+        # Re-fatora a cada passo para o código combinado nunca estourar o int64
+        combined, _ = pd.factorize(combined * (len(uniques) + 1) + (codes + 1))
+    _, first = np.unique(combined, return_index=True)
+    return combined, first
 
-    out_df = pd.DataFrame(results)
+
+def _detalhes(in_base: bool, ausentes: List[Tuple[str, str]], mismatches: List[str],
+              zeros: List[str], valores: Dict[str, object]) -> str:
+    """Texto de detalhe de uma linha (ou grupo) fora do OK, no mesmo formato do compare_row."""
+    ausencia = [f"{lbl}: valor {valores[vkey]} sem lançamento automático" for lbl, vkey in ausentes]
+    if not in_base:
+        return "; ".join(ausencia)
+
+    resumo_valores = " | ".join(
+        f"{label}={valores[k]}" for k, label in _VALUE_LABELS
+        if valores[k] is not None and str(valores[k]).strip() != ""
+    )
+    sufixo = f"  •  Valores (BI): {resumo_valores}" if resumo_valores else ""
+    if mismatches:
+        return "; ".join(mismatches + zeros) + sufixo
+    if ausencia:
+        return "; ".join(ausencia + zeros) + sufixo
+    return "; ".join(zeros) + sufixo
+
+
+def prepare_bi_analysis(bi_df: pd.DataFrame) -> Dict:
+    """
+    Parte da análise que só depende do BI: valores por linha (como o iterrows os entregaria),
+    códigos normalizados e as assinaturas (CFOP, códigos encontrados, valores != 0).
+    """
+    # Tipo em que o iterrows entregaria os valores (dtypes mistos viram object)
+    row_dtype = bi_df.iloc[:0].to_numpy().dtype
+
+    cfop_raw = _row_values(bi_df, "CFOP", row_dtype)
+    cfop = map_distinct(pd.Series(cfop_raw, dtype=object), normalize_code_cfop, None)
+    cfop_key = np.where(pd.isna(cfop), None, cfop.astype(str))
+
+    found, values, nonzero = {}, {}, {}
+    for key, _, vkey in _CODE_KEYS:
+        found[key] = map_distinct(pd.Series(_row_values(bi_df, key, row_dtype), dtype=object),
+                                  normalize_code_cfop, None)
+        values[vkey] = _row_values(bi_df, vkey, row_dtype)
+        nonzero[key] = _nonzero_flags(values[vkey])
+
+    sig, first = _signatures([cfop_key] + [found[k] for k, _, _ in _CODE_KEYS]
+                             + [nonzero[k] for k, _, _ in _CODE_KEYS])
+    return {
+        "cfop_raw": cfop_raw,
+        "cfop_key": cfop_key,
+        "found": found,
+        "values": values,
+        "nonzero": nonzero,
+        "origem": _row_values(bi_df, "origem", row_dtype),
+        "sig": sig,
+        "first": first,
+        "counts": np.bincount(sig, minlength=len(first)),
+    }
+
+
+def _evaluate_signatures(prep: Dict, index: BaseIndex, sel: np.ndarray) -> Dict[str, np.ndarray]:
+    """Valida as assinaturas `sel` contra a base, com a precedência do compare_row."""
+    first = prep["first"][sel]
+    m = len(first)
+    pos = index.cfops.get_indexer(prep["cfop_key"][first]) if len(index.cfops) else np.full(m, -1)
+    in_base = pos >= 0
+
+    def from_base(key: str) -> np.ndarray:
+        col = index.arrays[key][pos] if len(index.cfops) else np.full(m, None, dtype=object)
+        return np.where(in_base, col, None)
+
+    got, expected, zero, mism, aus = {}, {}, {}, {}, {}
+    for key, _, _ in _CODE_KEYS:
+        got[key] = prep["found"][key][first]
+        expected[key] = from_base(key)
+        got_null = pd.isna(got[key])
+        exp_null = pd.isna(expected[key])
+        zero[key] = in_base & ~exp_null & got_null
+        mism[key] = in_base & ~got_null & (exp_null | (expected[key] != got[key]))
+        aus[key] = prep["nonzero"][key][first] & got_null
+
+    any_mism = np.logical_or.reduce([mism[k] for k, _, _ in _CODE_KEYS])
+    any_aus = np.logical_or.reduce([aus[k] for k, _, _ in _CODE_KEYS])
+    any_zero = np.logical_or.reduce([zero[k] for k, _, _ in _CODE_KEYS])
+
+    status = np.select(
+        [~in_base & any_aus, ~in_base, any_mism, any_aus | any_zero],
+        [STATUS_AUSENCIA, STATUS_NOT_FOUND, STATUS_MISMATCH, STATUS_AUSENCIA],
+        default=STATUS_OK,
+    ).astype(object)
+
+    # Partes do detalhe que não dependem dos valores (None: texto fixo de "detalhe")
+    detalhe = np.where(in_base, "Tudo certo conforme a base.", "CFOP não existe na base.").astype(object)
+    partes = np.full(m, None, dtype=object)
+    for s in np.flatnonzero((status != STATUS_OK) & (in_base | any_aus)):
+        zeros, mismatches = [], []
+        for key, lbl, _ in _CODE_KEYS:
+            if zero[key][s]:
+                zeros.append(f"{lbl}: zerado no BI, esperado {expected[key][s]}")
+            elif mism[key][s]:
+                if expected[key][s] is None:
+                    mismatches.append(f"{lbl}: encontrado {got[key][s]}, esperado vazio")
+                else:
+                    mismatches.append(f"{lbl}: encontrado {got[key][s]}, deveria ser {expected[key][s]}")
+        ausentes = [(lbl, vkey) for key, lbl, vkey in _CODE_KEYS if aus[key][s]]
+        partes[s] = (bool(in_base[s]), ausentes, mismatches, zeros)
+
+    ev = {"Nome (Base)": from_base("nome"), "Status": status, "detalhe": detalhe, "partes": partes}
+    for key, lbl, _ in _CODE_KEYS:
+        ev[f"Esperado {lbl}"] = expected[key]
+        # Encontrado X só é preenchido quando o CFOP está na base
+        ev[f"Encontrado {lbl}"] = np.where(in_base, got[key], None)
+    return ev
+
+
+def _row_details(prep: Dict, ev: Dict[str, np.ndarray], rows: np.ndarray, out: np.ndarray) -> None:
+    """Preenche em `out` o texto de detalhe das linhas `rows`."""
+    sig = prep["sig"]
+    values = prep["values"]
+    for i in rows:
+        partes = ev["partes"][sig[i]]
+        if partes is None:
+            out[i] = ev["detalhe"][sig[i]]
+        else:
+            out[i] = _detalhes(*partes, {k: values[k][i] for k, _ in _VALUE_LABELS})
+
+
+def _state_metrics(ev: Dict[str, np.ndarray], counts: np.ndarray) -> Dict[str, int]:
+    """Métricas da análise (em linhas do BI) a partir do status de cada assinatura."""
+    status = ev["Status"]
+    return {
+        "ok_count": int(counts[status == STATUS_OK].sum()),
+        "diff_count": int(counts[status == STATUS_MISMATCH].sum()),
+        "zero_count": int(counts[status == STATUS_AUSENCIA].sum()),
+        "notfound_count": int(counts[status == STATUS_NOT_FOUND].sum()),
+    }
+
+
+def build_analysis_state(bi_df: pd.DataFrame, base_map: Union[Dict[str, Dict], BaseIndex]) -> Dict:
+    """
+    Analisa o BI contra a base e guarda o estado intermediário (lado do BI, validação por
+    assinatura, detalhes por linha e métricas), que update_analysis_state reaproveita.
+    """
+    index = as_base_index(base_map)
+    prep = prepare_bi_analysis(bi_df)
+    ev = _evaluate_signatures(prep, index, np.arange(len(prep["first"])))
+    details = np.empty(len(prep["sig"]), dtype=object)
+    _row_details(prep, ev, np.arange(len(details)), details)
+    return {"prep": prep, "index": index, "eval": ev, "details": details,
+            "metrics": _state_metrics(ev, prep["counts"])}
+
+
+def update_analysis_state(state: Dict, base_map: Union[Dict[str, Dict], BaseIndex]) -> Tuple[Dict, List[str]]:
+    """
+    Revalida uma análise já feita contra uma nova versão da base: só as assinaturas cujo
+    CFOP mudou (diff_base_indexes) são validadas de novo e só as linhas delas têm o detalhe
+    refeito. Retorna o novo estado (o anterior não é alterado) e os CFOPs alterados.
+    """
+    index = as_base_index(base_map)
+    changed = diff_base_indexes(state["index"], index)
+    if not changed:
+        return {**state, "index": index}, []
+
+    prep = state["prep"]
+    sel = np.flatnonzero(pd.Index(prep["cfop_key"][prep["first"]]).isin(changed))
+    ev = {c: arr.copy() for c, arr in state["eval"].items()}
+    details = state["details"]
+    if len(sel):
+        for c, arr in _evaluate_signatures(prep, index, sel).items():
+            ev[c][sel] = arr
+        details = details.copy()
+        _row_details(prep, ev, np.flatnonzero(np.isin(prep["sig"], sel)), details)
+
+    new_state = {"prep": prep, "index": index, "eval": ev, "details": details,
+                 "metrics": _state_metrics(ev, prep["counts"])}
+    return new_state, changed
+
+
+def analysis_frame(state: Dict, collapse: bool = False) -> pd.DataFrame:
+    """
+    Monta o Resultado da Validação a partir do estado da análise.
+    Com collapse=True devolve uma linha por (origem, assinatura), com a quantidade de
+    linhas do BI ("Qtd. Linhas") e os valores somados.
+    """
+    prep, ev = state["prep"], state["eval"]
+    sig = prep["sig"]
+    if len(sig) == 0:
+        return pd.DataFrame([]).reindex(columns=[])
+    sig_columns = [c for c in ev if c not in ("detalhe", "partes")]
+
+    if collapse:
+        group, group_first = _signatures([prep["origem"], sig])
+        group_sig = sig[group_first]
+        sums = {}
+        for k, _ in _VALUE_LABELS:
+            total = pd.to_numeric(pd.Series(prep["values"][k], dtype=object), errors="coerce").groupby(group).sum(min_count=1)
+            sums[k] = np.array([None if pd.isna(v) else round(float(v), 2) for v in total.to_numpy()], dtype=object)
+
+        group_details = ev["detalhe"][group_sig]
+        for g, s in enumerate(group_sig):
+            if ev["partes"][s] is not None:
+                group_details[g] = _detalhes(*ev["partes"][s], {k: sums[k][g] for k, _ in _VALUE_LABELS})
+
+        columns = {"origem": prep["origem"][group_first], "CFOP": prep["cfop_raw"][group_first]}
+        columns.update({c: ev[c][group_sig] for c in sig_columns})
+        columns["Qtd. Linhas"] = np.bincount(group)
+        columns["Detalhes"] = group_details
+        for k, label in _VALUE_LABELS:
+            columns[label] = sums[k]
+    else:
+        columns = {"origem": prep["origem"], "CFOP": prep["cfop_raw"]}
+        columns.update({c: ev[c][sig] for c in sig_columns})
+        columns["Detalhes"] = state["details"]
+        # Sempre incluir os valores do BI no Resultado da Validação
+        for k, label in _VALUE_LABELS:
+            columns[label] = prep["values"][k]
+
+    out_df = pd.DataFrame({c: v.tolist() for c, v in columns.items()})
 
     # Ordenar colunas
     col_order = [
-        "origem", "CFOP", "Nome (Base)", "Status", "Detalhes",
+        "origem", "CFOP", "Nome (Base)", "Status", "Qtd. Linhas", "Detalhes",
         "Esperado Contábil", "Encontrado Contábil","Valor Contábil",
         "Esperado ICMS", "Encontrado ICMS","Vl. ICMS",
         "Esperado ICMS Subst. Trib.", "Encontrado ICMS Subst. Trib.","Vl. ST",
@@ -187,12 +521,31 @@ def analyze_bi_against_base(bi_df: pd.DataFrame, base_map: Dict[str, Dict]) -> p
     return out_df
 
 
+def analyze_bi_against_base(bi_df: pd.DataFrame, base_map: Union[Dict[str, Dict], BaseIndex],
+                            collapse: bool = False) -> pd.DataFrame:
+    """
+    Analisa todo o BI contra a base CFOP (mesmo resultado de aplicar compare_row linha a linha).
+    O status só depende do CFOP, dos quatro códigos de lançamento e de quais valores são
+    diferentes de zero; as linhas são agrupadas por essa assinatura, cada assinatura é
+    validada uma única vez contra a base e o resultado é replicado para as suas linhas.
+    Os textos de detalhe só são montados para as linhas que não estão OK.
+
+    Com collapse=True devolve uma linha por (origem, assinatura), com a quantidade de
+    linhas do BI ("Qtd. Linhas") e os valores somados.
+    """
+    if len(bi_df) == 0:
+        return pd.DataFrame([]).reindex(columns=[])
+    return analysis_frame(build_analysis_state(bi_df, base_map), collapse)
+
+
 def calculate_analysis_metrics(result_df: pd.DataFrame) -> Dict[str, int]:
-    """Calcula métricas da análise CFOP."""
-    ok_count = int((result_df["Status"] == "OK").sum())
-    diff_count = int((result_df["Status"] == "❌ Código de lançamento incorreto").sum())
-    zero_count = int((result_df["Status"] == "🟡 Ausência de lançamento automático").sum())
-    notfound_count = int((result_df["Status"].str.contains("⚠️ CFOP não cadastrado", na=False)).sum())
+    """Calcula métricas da análise CFOP (em linhas do BI, também na saída agrupada)."""
+    # Na saída agrupada cada linha representa "Qtd. Linhas" linhas do BI
+    peso = result_df["Qtd. Linhas"] if "Qtd. Linhas" in result_df.columns else 1
+    ok_count = int(((result_df["Status"] == "OK") * peso).sum())
+    diff_count = int(((result_df["Status"] == "❌ Código de lançamento incorreto") * peso).sum())
+    zero_count = int(((result_df["Status"] == "🟡 Ausência de lançamento automático") * peso).sum())
+    notfound_count = int(((result_df["Status"].str.contains("⚠️ CFOP não cadastrado", na=False)) * peso).sum())
 
     return {
         "ok_count": ok_count,
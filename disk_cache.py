@@ -0,0 +1,230 @@
+"""
+Cache em disco endereçado por conteúdo.
+Guarda resultados intermediários (texto extraído de PDFs, tabelas já processadas) sob uma
+chave derivada dos bytes do arquivo e da versão do parser. O tamanho total é limitado e as
+entradas menos usadas recentemente são descartadas primeiro (LRU pelo mtime).
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import pandas as pd
+
+# Parquet é o formato compacto preferido para tabelas; sem pyarrow usa pickle comprimido
+try:
+    import pyarrow  # noqa: F401
+    _FRAME_EXT = ".parquet"
+except ImportError:  # pragma: no cover
+    _FRAME_EXT = ".pkl.gz"
+
+
+# =============================================================================
+# Configuração
+# =============================================================================
+CACHE_DIR = Path(os.environ.get("CONFERENCIA_CACHE_DIR")
+                 or Path(tempfile.gettempdir()) / "conferencia_cache")
+CACHE_MAX_BYTES = int(os.environ.get("CONFERENCIA_CACHE_MAX_MB", "256")) * 1024 * 1024
+CACHE_ENABLED = os.environ.get("CONFERENCIA_CACHE", "1") != "0"
+# Intervalo máximo (s) entre varreduras completas da pasta, para contar também o que outros
+# processos gravaram; entre varreduras o tamanho é estimado somando as gravações deste processo
+CACHE_SCAN_INTERVAL = 300
+# Ao passar do limite, descarta até esta fração dele: as próximas gravações têm folga e não
+# disparam uma nova varredura cada uma
+CACHE_EVICT_TO = 0.9
+
+_TMP_SUFFIX = ".tmp"
+_size_estimate: Optional[int] = None   # bytes na pasta (None = ainda não varrida)
+_last_scan = 0.0
+_size_lock = threading.Lock()
+
+
+# =============================================================================
+# Funções Auxiliares
+# =============================================================================
+def content_key(data: bytes, *parts: Any) -> str:
+    """Chave do cache: hash dos bytes do arquivo + partes extras (namespace, versão do parser...)."""
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+def _entry_path(key: str, ext: str) -> Path:
+    return CACHE_DIR / f"{key}{ext}"
+
+
+def _hit(path: Path) -> bool:
+    """Entrada existe? Se sim, marca como usada agora (LRU)."""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def _write_atomic(path: Path, write) -> None:
+    """Grava via arquivo temporário + os.replace, para leitores concorrentes nunca verem meio arquivo."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=_TMP_SUFFIX)
+    os.close(fd)
+    try:
+        write(tmp)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _account(size)
+
+
+def _exact_bytes(df: pd.DataFrame) -> Optional[bytes]:
+    """Serialização do DataFrame, ou None se a volta não reproduzir exatamente o original."""
+    buf = io.BytesIO()
+    if _FRAME_EXT == ".parquet":
+        df.to_parquet(buf)
+        back = pd.read_parquet(io.BytesIO(buf.getvalue()))
+    else:
+        df.to_pickle(buf, compression="gzip")
+        back = pd.read_pickle(io.BytesIO(buf.getvalue()), compression="gzip")
+    same = (
+        list(back.columns) == list(df.columns)
+        and back.dtypes.equals(df.dtypes)
+        and back.index.equals(df.index)
+        and back.equals(df)
+    )
+    return buf.getvalue() if same else None
+
+
+def _account(size: int) -> None:
+    """
+    Soma a gravação à estimativa do tamanho da pasta; só varre a pasta (e descarta entradas)
+    quando a estimativa passa de CACHE_MAX_BYTES, na primeira gravação ou a cada
+    CACHE_SCAN_INTERVAL segundos — não a cada gravação.
+    """
+    global _size_estimate
+    with _size_lock:
+        if _size_estimate is not None:
+            _size_estimate += size
+        if (_size_estimate is None or _size_estimate > CACHE_MAX_BYTES
+                or time.monotonic() - _last_scan > CACHE_SCAN_INTERVAL):
+            _evict()
+
+
+def _evict() -> None:
+    """
+    Varre a pasta e, se passar de CACHE_MAX_BYTES, remove as entradas menos usadas
+    recentemente até CACHE_EVICT_TO do limite.
+    """
+    global _size_estimate, _last_scan
+    entries = []
+    for p in CACHE_DIR.iterdir():
+        if p.name.endswith(_TMP_SUFFIX):   # gravação em andamento (deste ou de outro processo)
+            continue
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+
+    total = sum(size for _, size, _ in entries)
+    if total <= CACHE_MAX_BYTES:
+        entries = []
+    alvo = int(CACHE_MAX_BYTES * CACHE_EVICT_TO)
+    for _, size, p in sorted(entries, key=lambda e: e[0]):
+        if total <= alvo:
+            break
+        try:
+            p.unlink()
+            total -= size
+        except OSError:
+            pass
+    _size_estimate, _last_scan = total, time.monotonic()
+
+
+# =============================================================================
+# API do Cache
+# =============================================================================
+def load_frame(key: str) -> Optional[pd.DataFrame]:
+    """DataFrame guardado sob a chave, ou None (ausente, cache desativado ou ilegível)."""
+    if not CACHE_ENABLED:
+        return None
+    path = _entry_path(key, _FRAME_EXT)
+    if not _hit(path):
+        return None
+    try:
+        if _FRAME_EXT == ".parquet":
+            return pd.read_parquet(path)
+        return pd.read_pickle(path, compression="gzip")
+    except Exception:
+        return None
+
+
+def store_frame(key: str, df: pd.DataFrame, exact: bool = False) -> None:
+    """
+    Guarda o DataFrame; falhas de gravação apenas deixam de cachear.
+    Com exact=True só grava se a tabela voltar do disco idêntica (valores e dtypes), para que
+    uma leitura do cache nunca difira da leitura original (ex.: colunas object com tipos mistos).
+    """
+    if not CACHE_ENABLED:
+        return
+    try:
+        if exact:
+            data = _exact_bytes(df)
+            if data is not None:
+                _write_atomic(_entry_path(key, _FRAME_EXT), lambda tmp: Path(tmp).write_bytes(data))
+        elif _FRAME_EXT == ".parquet":
+            _write_atomic(_entry_path(key, _FRAME_EXT), lambda tmp: df.to_parquet(tmp))
+        else:
+            _write_atomic(_entry_path(key, _FRAME_EXT), lambda tmp: df.to_pickle(tmp, compression="gzip"))
+    except Exception:
+        pass
+
+
+def load_json(key: str) -> Optional[Any]:
+    """Objeto JSON (gzip) guardado sob a chave, ou None."""
+    if not CACHE_ENABLED:
+        return None
+    path = _entry_path(key, ".json.gz")
+    if not _hit(path):
+        return None
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as fh:
+            return json.load(fh)
+    except Exception:
+        return None
+
+
+def store_json(key: str, obj: Any) -> None:
+    """Guarda um objeto serializável em JSON comprimido; falhas apenas deixam de cachear."""
+    if not CACHE_ENABLED:
+        return
+
+    def write(tmp):
+        with gzip.open(tmp, "wt", encoding="utf-8") as fh:
+            json.dump(obj, fh, ensure_ascii=False)
+
+    try:
+        _write_atomic(_entry_path(key, ".json.gz"), write)
+    except Exception:
+        pass
+
+
+def clear_cache() -> None:
+    """Remove todas as entradas do cache."""
+    if not CACHE_DIR.exists():
+        return
+    for p in CACHE_DIR.iterdir():
+        try:
+            p.unlink()
+        except OSError:
+            pass
@@ -0,0 +1,192 @@
+"""
+Exportação para Excel (.xlsx) em modo streaming.
+As linhas são gravadas uma a uma em memória constante (cada linha é serializada ao ser
+escrita): XlsxWriter em modo constant_memory quando instalado (mais rápido), senão openpyxl
+em modo write-only. Os valores saem com formatos numéricos nativos do Excel em vez de
+textos pré-formatados. Várias tabelas podem sair como abas de um único arquivo; tabelas
+acima do limite de linhas do Excel continuam em abas "Nome (2)", "Nome (3)"...
+"""
+
+import io
+import re
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# XlsxWriter é opcional: sem ele a escrita usa o openpyxl (write-only)
+try:
+    import xlsxwriter
+except ImportError:  # pragma: no cover
+    xlsxwriter = None
+
+
+# =============================================================================
+# Constantes
+# =============================================================================
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Linhas de dados por aba (limite do Excel: 1.048.576 linhas, uma é o cabeçalho)
+EXCEL_MAX_ROWS = 1_048_575
+# Formatos nativos: colunas de ponto flutuante (valores em reais) e datas
+EXCEL_FLOAT_FORMAT = "#,##0.00"
+EXCEL_DATE_FORMAT = "dd/mm/yyyy"
+# Linhas usadas para estimar a largura das colunas
+_WIDTH_SAMPLE = 1000
+_MAX_WIDTH = 60
+
+_INVALID_SHEET_CHARS = re.compile(r"[\[\]:*?/\\]")
+
+
+# =============================================================================
+# Auxiliares
+# =============================================================================
+def sheet_title(name: str) -> str:
+    """Nome de aba válido no Excel (sem []:*?/\\ e com até 31 caracteres)."""
+    return _INVALID_SHEET_CHARS.sub(" ", str(name)).strip()[:31] or "Relatorio"
+
+
+def _column_values(s: pd.Series) -> np.ndarray:
+    """Valores da coluna como objetos Python, com None no lugar de NaN/NaT."""
+    return s.astype(object).where(s.notna(), None).to_numpy()
+
+
+def _column_widths(df: pd.DataFrame) -> List[float]:
+    sample = df.head(_WIDTH_SAMPLE)
+    widths = []
+    for c in df.columns:
+        n = sample[c].astype(str).str.len().max() if len(sample) else 0
+        widths.append(min(_MAX_WIDTH, max(len(str(c)), int(n or 0)) + 2))
+    return widths
+
+
+def _sheet_parts(name: str, df: pd.DataFrame) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """Divide o frame em abas de até EXCEL_MAX_ROWS linhas."""
+    title = sheet_title(name)
+    if len(df) <= EXCEL_MAX_ROWS:
+        yield title, df
+        return
+    for i, a in enumerate(range(0, len(df), EXCEL_MAX_ROWS)):
+        sufixo = f" ({i + 1})" if i else ""
+        yield title[:31 - len(sufixo)] + sufixo, df.iloc[a:a + EXCEL_MAX_ROWS]
+
+
+def _unique_titles(names: List[str]) -> List[str]:
+    """Evita abas com o mesmo nome (o Excel não distingue maiúsculas)."""
+    seen, out = set(), []
+    for name in names:
+        title, k = name, 2
+        while title.lower() in seen:
+            sufixo = f" ({k})"
+            title, k = name[:31 - len(sufixo)] + sufixo, k + 1
+        seen.add(title.lower())
+        out.append(title)
+    return out
+
+
+# =============================================================================
+# Escrita
+# =============================================================================
+def _write_sheet_xlsxwriter(wb, formats: Dict, title: str, df: pd.DataFrame) -> None:
+    ws = wb.add_worksheet(title)
+    ws.freeze_panes(1, 0)
+    for j, w in enumerate(_column_widths(df)):
+        ws.set_column(j, j, w)
+    ws.write_row(0, 0, [str(c) for c in df.columns], formats["header"])
+
+    # Um método de escrita por coluna (evita o despacho por tipo de ws.write a cada célula)
+    writers = []
+    for c in df.columns:
+        dtype = df[c].dtype
+        if pd.api.types.is_float_dtype(dtype):
+            writers.append((ws.write_number, formats["float"]))
+        elif pd.api.types.is_bool_dtype(dtype):
+            writers.append((ws.write_boolean, None))
+        elif pd.api.types.is_integer_dtype(dtype):
+            writers.append((ws.write_number, None))
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            writers.append((ws.write_datetime, formats["date"]))
+        else:
+            writers.append((ws.write, None))
+
+    columns = [_column_values(df[c]) for c in df.columns]
+    for i, row in enumerate(zip(*columns), 1):
+        for j, v in enumerate(row):
+            if v is not None:
+                write, fmt = writers[j]
+                write(i, j, v, fmt)
+
+
+def _write_sheet_openpyxl(wb, title: str, df: pd.DataFrame) -> None:
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+
+    ws = wb.create_sheet(title)
+    ws.freeze_panes = "A2"
+    for i, w in enumerate(_column_widths(df), 1):
+        ws.column_dimensions[get_column_letter(i)].width = w
+
+    bold = Font(bold=True)
+    header = []
+    for c in df.columns:
+        cell = WriteOnlyCell(ws, value=str(c))
+        cell.font = bold
+        header.append(cell)
+    ws.append(header)
+
+    # Colunas float/data (e de texto com valores "=...", que o openpyxl tomaria por fórmulas) usam
+    # uma célula-modelo: no modo write-only a linha é gravada ao ser acrescentada, então a
+    # mesma célula serve para todas as linhas
+    columns, templates = [], {}
+    for j, c in enumerate(df.columns):
+        values = _column_values(df[c])
+        columns.append(values)
+        if pd.api.types.is_float_dtype(df[c].dtype) or pd.api.types.is_datetime64_any_dtype(df[c].dtype):
+            cell = WriteOnlyCell(ws)
+            cell.number_format = (EXCEL_FLOAT_FORMAT if pd.api.types.is_float_dtype(df[c].dtype)
+                                  else EXCEL_DATE_FORMAT)
+            templates[j] = (cell, False)
+        elif any(isinstance(v, str) and v.startswith("=") for v in values):
+            templates[j] = (WriteOnlyCell(ws), True)
+
+    if not templates:
+        for row in zip(*columns):
+            ws.append(row)
+        return
+    for row in zip(*columns):
+        row = list(row)
+        for j, (cell, texto) in templates.items():
+            cell.value = row[j]
+            if texto and isinstance(row[j], str):
+                cell.data_type = "s"
+            row[j] = cell
+        ws.append(row)
+
+
+def write_excel_sheets(sheets: Dict[str, pd.DataFrame]) -> bytes:
+    """Grava os frames (nome da aba -> DataFrame) num único .xlsx, numa passada só."""
+    parts = [part for name, df in sheets.items() for part in _sheet_parts(name, df)] \
+        or [("Relatorio", pd.DataFrame())]
+    titles = _unique_titles([t for t, _ in parts])
+    buf = io.BytesIO()
+
+    if xlsxwriter is not None:
+        # Textos sempre como texto (nada de fórmulas/links a partir de "=..." ou "http...");
+        # ±inf (ex.: "inf" lido do BI) vira célula de erro em vez de interromper a exportação
+        wb = xlsxwriter.Workbook(buf, {"constant_memory": True, "strings_to_formulas": False,
+                                       "strings_to_urls": False, "remove_timezone": True,
+                                       "nan_inf_to_errors": True})
+        formats = {"header": wb.add_format({"bold": True}),
+                   "float": wb.add_format({"num_format": EXCEL_FLOAT_FORMAT}),
+                   "date": wb.add_format({"num_format": EXCEL_DATE_FORMAT})}
+        for title, (_, df) in zip(titles, parts):
+            _write_sheet_xlsxwriter(wb, formats, title, df)
+        wb.close()
+        return buf.getvalue()
+
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for title, (_, df) in zip(titles, parts):
+        _write_sheet_openpyxl(wb, title, df)
+    wb.save(buf)
+    return buf.getvalue()
@@ -0,0 +1,199 @@
+"""
+Regras de exclusão de linhas (notas canceladas, lixo do BI e serviços prestados).
+As regras são declaradas como dados (nome + condições sobre colunas), compiladas uma vez e
+aplicadas num único passe por DataFrame: cada condição distinta é avaliada uma só vez e o
+resultado traz a máscara das linhas mantidas e quantas linhas cada regra excluiu.
+Os conjuntos padrão podem ser substituídos por cliente via arquivo JSON (load_rules).
+"""
+
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from utils import clean_code_series
+
+
+# =============================================================================
+# Constantes - Códigos de Serviços Prestados
+# =============================================================================
+CODIGOS_SERVICOS_PRESTADOS = {
+    "00141", "00142", "00143", "00144", "80083", "80514",
+    "80535", "80107", "00000", "00406"
+}
+
+# Textos tratados como vazio na condição "vazio" (após strip/lower)
+_EMPTY_TEXT = ["nan", "none", "null"]
+
+
+# =============================================================================
+# Regras Padrão
+# =============================================================================
+# Cada regra: {"nome", "descricao", "condicoes": [...]}; a linha é excluída quando TODAS as
+# condições valem. Condição: {"op", "coluna" | "colunas", "valores"?, "limpas"?}
+#   - "vazio":        coluna vazia (NaN, None, "", espaços, "nan", "none", "null")
+#   - "codigo_vazio": código sem dígitos após clean_code_main; as colunas listadas em "limpas"
+#                     já vêm limpas dos carregadores (código vazio = ""), sem limpar de novo
+#   - "zerado":       todas as colunas presentes iguais a zero (NaN conta como zero)
+#   - "em":           valor da coluna está em "valores"
+# "coluna" pode ser uma lista de nomes alternativos (vale o primeiro presente no frame); se
+# nenhum estiver presente a condição é falsa e a regra não exclui nada.
+REGRAS_PADRAO: Dict[str, List[Dict]] = {
+    "bi": [
+        {
+            "nome": "cancelada",
+            "descricao": "Coluna 'Cancelada' vazia",
+            "condicoes": [{"op": "vazio", "coluna": "cancelada"}],
+        },
+        {
+            "nome": "lixo",
+            "descricao": "CFOP vazio e valores zerados",
+            "condicoes": [
+                {"op": "codigo_vazio", "coluna": ["CFOP", "cfop"], "limpas": ["cfop"]},
+                {"op": "zerado", "colunas": ["valor_contabil", "vl_icms", "vl_st", "vl_ipi",
+                                             "v_cont", "v_icms", "v_st", "v_ipi"]},
+            ],
+        },
+    ],
+    "servicos_prestados": [
+        {
+            "nome": "servicos_prestados",
+            "descricao": "Lançamentos de serviços prestados",
+            "condicoes": [{"op": "em", "coluna": "lancamento",
+                           "valores": sorted(CODIGOS_SERVICOS_PRESTADOS)}],
+        },
+    ],
+}
+
+_OPS = {"vazio", "codigo_vazio", "zerado", "em"}
+
+
+# =============================================================================
+# Configuração por Cliente
+# =============================================================================
+def _merge_rule_set(base: List[Dict], override: Union[List[Dict], Dict]) -> List[Dict]:
+    """Lista substitui o conjunto inteiro; {"remover": [nomes], "acrescentar": [regras]} ajusta o atual."""
+    if isinstance(override, list):
+        return override
+    fora = set(override.get("remover", []))
+    return [r for r in base if r.get("nome") not in fora] + list(override.get("acrescentar", []))
+
+
+def load_rules(path: Union[str, Path, None] = None, cliente: Optional[str] = None) -> Dict[str, List[Dict]]:
+    """
+    Conjuntos de regras a usar: os padrões, ajustados pela seção "padrao" do JSON e depois
+    pela seção "clientes" -> `cliente`, quando houver. Exemplo:
+    {"padrao": {"bi": [...]},
+     "clientes": {"00552": {"servicos_prestados": {"acrescentar": [...], "remover": [...]}}}}
+    """
+    regras = dict(REGRAS_PADRAO)
+    if path is None or not Path(path).exists():
+        return regras
+    with open(path, "r", encoding="utf-8") as f:
+        cfg = json.load(f)
+    secoes = [cfg.get("padrao", {})]
+    if cliente:
+        secoes.append(cfg.get("clientes", {}).get(str(cliente).strip(), {}))
+    for secao in secoes:
+        for nome, override in secao.items():
+            regras[nome] = _merge_rule_set(regras.get(nome, []), override)
+    for conjunto in regras.values():
+        compile_rules(conjunto)   # valida já na carga, com mensagem clara
+    return regras
+
+
+# =============================================================================
+# Compilação e Aplicação
+# =============================================================================
+def _as_list(v) -> List[str]:
+    return list(v) if isinstance(v, (list, tuple)) else [v]
+
+
+def compile_rules(regras: List[Dict], only: Optional[List[str]] = None) -> Tuple[Tuple, ...]:
+    """
+    Valida e compila as regras em tuplas (nome, chaves das condições). Condições iguais em
+    regras diferentes viram a mesma chave e são avaliadas uma só vez. `only` restringe às
+    regras com esses nomes.
+    """
+    compiled = []
+    for regra in regras:
+        nome = regra.get("nome")
+        if not nome or not regra.get("condicoes"):
+            raise ValueError(f"Regra de exclusão inválida (nome e condições são obrigatórios): {regra}")
+        if only is not None and nome not in only:
+            continue
+        keys = []
+        for cond in regra["condicoes"]:
+            op = cond.get("op")
+            if op not in _OPS:
+                raise ValueError(f"Regra '{nome}': operação desconhecida {op!r} (use {sorted(_OPS)})")
+            cols = tuple(_as_list(cond.get("colunas") or cond.get("coluna")))
+            if not cols or cols == (None,):
+                raise ValueError(f"Regra '{nome}': condição sem coluna: {cond}")
+            valores = tuple(str(v) for v in cond.get("valores", ())) if op == "em" else ()
+            limpas = tuple(_as_list(cond.get("limpas", ()))) if op == "codigo_vazio" else ()
+            keys.append((op, cols, valores, limpas))
+        compiled.append((nome, tuple(keys)))
+    return tuple(compiled)
+
+
+def _eval_condition(df: pd.DataFrame, key: Tuple) -> pd.Series:
+    op, cols, valores, limpas = key
+    if op == "zerado":
+        present = [c for c in cols if c in df.columns]
+        if not present:
+            return pd.Series(False, index=df.index)
+        return df[present].fillna(0).eq(0).all(axis=1)
+
+    col = next((c for c in cols if c in df.columns), None)
+    if col is None:
+        return pd.Series(False, index=df.index)
+    s = df[col]
+    if op == "vazio":
+        txt = s.astype(str)
+        return s.isna() | txt.str.strip().eq("") | txt.str.lower().isin(_EMPTY_TEXT)
+    if op == "codigo_vazio":
+        if col in limpas:   # CFOP já limpo pelo carregador (clean_code_series)
+            return s.fillna("").astype(str).eq("")
+        return clean_code_series(s).eq("")
+    return s.isin(valores)
+
+
+def apply_rules(df: pd.DataFrame, regras: List[Dict], only: Optional[List[str]] = None,
+                keep: Optional[pd.Series] = None) -> Tuple[pd.Series, Dict[str, int]]:
+    """
+    Um passe pelo frame: devolve a máscara das linhas mantidas e as exclusões por regra.
+    Uma linha que casa com várias regras conta só para a primeira (as contagens somam o
+    total excluído); `keep` traz linhas já excluídas antes, que não contam de novo.
+    """
+    keep = pd.Series(True, index=df.index) if keep is None else keep.copy()
+    counts: Dict[str, int] = {}
+    cache: Dict[Tuple, pd.Series] = {}
+    for nome, keys in compile_rules(regras, only):
+        hit = keep.copy()
+        for key in keys:
+            if key not in cache:
+                cache[key] = _eval_condition(df, key)
+            hit &= cache[key]
+        counts[nome] = counts.get(nome, 0) + int(hit.sum())
+        keep &= ~hit
+    return keep, counts
+
+
+def merge_counts(*counts: Dict[str, int]) -> Dict[str, int]:
+    """Soma contagens de exclusão (ex.: das abas Entrada e Saída)."""
+    total: Dict[str, int] = {}
+    for c in counts:
+        for nome, n in c.items():
+            total[nome] = total.get(nome, 0) + n
+    return total
+
+
+def exclude_rows(df: pd.DataFrame, regras: List[Dict],
+                 only: Optional[List[str]] = None) -> pd.DataFrame:
+    """Aplica as regras e devolve o frame filtrado (índice refeito), com as contagens em df.attrs["exclusoes"]."""
+    keep, counts = apply_rules(df, regras, only)
+    out = df.loc[keep].reset_index(drop=True)
+    out.attrs["exclusoes"] = merge_counts(df.attrs.get("exclusoes", {}), counts)
+    return out
@@ -0,0 +1,334 @@
+"""
+Relatório PDF de tabelas de comparação (Partes 2 e 3), pensado para tabelas grandes.
+Os números são formatados de forma vetorizada (padrão brasileiro) e as células são texto
+simples; só viram Paragraph (com quebra de linha) as que não cabem na largura da coluna.
+A tabela é montada em blocos do tamanho de uma página, em vez de uma única Table gigante
+que o reportlab precisaria redividir a cada página. Tabelas muito grandes podem ser
+renderizadas em faixas paralelas (processos) e reunidas com pypdf.
+"""
+
+import io
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+
+
+# =============================================================================
+# Constantes
+# =============================================================================
+# Colunas numéricas (Parte 2 e Parte 3): alinhadas à direita e formatadas como 1.234,56
+PDF_NUMERIC_COLS = ["Livro ICMS", "Livro ICMS ST", "Lote Contábil", "Diferença",
+                    "valor_bi", "valor_razao", "dif"]
+# Colunas coloridas (verde = OK, vermelho = divergência)
+PDF_COLOR_COLS = ["Status", "Diferença", "dif", "ok"]
+
+# Larguras das colunas em cm (demais colunas: PDF_DEFAULT_WIDTH_CM)
+PDF_COL_WIDTHS_CM = {
+    # Parte 3 (Livro ICMS)
+    "CFOP": 4.5,
+    "Lançamento": 2.2,
+    "Livro ICMS": 2.5,
+    "Livro ICMS ST": 2.5,
+    "Lote Contábil": 2.5,
+    # Parte 2 (BI x Razão)
+    "Código de Lançamento": 2.5,
+    "Valor BI": 3,
+    "Valor Razão": 3,
+    # Comuns
+    "Descrição": 7,
+    "Diferença": 3,
+    "Status": 2,
+}
+PDF_DEFAULT_WIDTH_CM = 2
+
+# A partir deste número de linhas as faixas são renderizadas num pool de processos
+PDF_PARALLEL_MIN_ROWS = 20000
+# Processos do pool (None = número de CPUs)
+PDF_MAX_WORKERS: Optional[int] = None
+
+_FONT_SIZE = 6.5
+_LEADING = 8
+_PAD = 3
+_GREEN = "#16A34A"
+_RED = "#DC2626"
+
+
+# =============================================================================
+# Preparação dos Dados (vetorizada)
+# =============================================================================
+def format_br_numbers(values: pd.Series) -> pd.Series:
+    """
+    Formata uma coluna como 1.234,56 sem apply por célula; vazios/não numéricos viram 0,00
+    e ±inf sai como "inf"/"-inf" (como no relatório antigo), nunca como número.
+    """
+    num = pd.to_numeric(values, errors="coerce").fillna(0).to_numpy(dtype="float64")
+    finito = np.isfinite(num)
+    cents = np.rint(np.abs(np.where(finito, num, 0)) * 100).astype(np.int64)
+    inteiro = pd.Series(cents // 100, index=values.index).astype(str)
+    inteiro = inteiro.str.replace(r"\B(?=(\d{3})+(?!\d))", ".", regex=True)
+    frac = pd.Series(cents % 100, index=values.index).astype(str).str.zfill(2)
+    sinal = np.where((num < 0) & (cents > 0), "-", "")
+    out = sinal + inteiro + "," + frac
+    if not finito.all():
+        out = out.where(finito, np.where(num > 0, "inf", "-inf"))
+    return out
+
+
+def _rows_ok(df: pd.DataFrame) -> np.ndarray:
+    """Linha OK: Status começando com "OK" (Parte 3) ou coluna ok verdadeira (Parte 2)."""
+    if "Status" in df.columns:
+        return df["Status"].fillna("").astype(str).str.startswith("OK").to_numpy(dtype=bool)
+    if "ok" in df.columns:
+        return df["ok"].fillna("").astype(str).str.lower().isin(["true", "1", "yes"]).to_numpy(dtype=bool)
+    return np.zeros(len(df), dtype=bool)
+
+
+def divergences_only(df: pd.DataFrame) -> pd.DataFrame:
+    """Só as linhas com divergência (as que não estão OK)."""
+    return df.loc[~_rows_ok(df)]
+
+
+def _prepare(df: pd.DataFrame, title: str) -> Dict:
+    """Textos das células, larguras e as células que precisam de quebra de linha."""
+    from reportlab.lib.units import cm
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    columns = [str(c) for c in df.columns]
+    widths = [PDF_COL_WIDTHS_CM.get(c, PDF_DEFAULT_WIDTH_CM) * cm for c in columns]
+    numeric_idx = [i for i, c in enumerate(columns) if c in PDF_NUMERIC_COLS]
+    color_idx = [i for i, c in enumerate(columns) if c in PDF_COLOR_COLS]
+
+    texts = []
+    wrap = np.zeros((len(df), len(columns)), dtype=bool)
+    for j, col in enumerate(df.columns):
+        s = df[col]
+        if j in numeric_idx:
+            txt = format_br_numbers(s)
+        else:
+            txt = s.astype(object).where(s.notna(), "").astype(str)
+        txt = txt.to_numpy(dtype=object)
+        texts.append(txt)
+
+        # Mede só os valores distintos que podem não caber (mais longos que o mínimo garantido)
+        font = "Helvetica-Bold" if j in color_idx else "Helvetica"
+        room = widths[j] - 2 * _PAD
+        lens = pd.Series(txt).str.len().to_numpy()
+        maybe = lens > int(room // _FONT_SIZE)
+        if maybe.any():
+            uniq = pd.unique(txt[maybe])
+            too_wide = {u for u in uniq if stringWidth(u, font, _FONT_SIZE) > room}
+            if too_wide:
+                wrap[:, j] = maybe & pd.Series(txt).isin(too_wide).to_numpy()
+
+    cells = np.column_stack(texts).tolist() if texts and len(df) else []
+    return {
+        "title": title,
+        "columns": columns,
+        "widths": widths,
+        "numeric_idx": numeric_idx,
+        "color_idx": color_idx,
+        "cells": cells,
+        "wrap": [tuple(np.flatnonzero(r)) for r in wrap] if wrap.any() else None,
+        "ok": _rows_ok(df).tolist(),
+    }
+
+
+# =============================================================================
+# Renderização
+# =============================================================================
+def _styles() -> Dict:
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+    from reportlab.lib.styles import ParagraphStyle
+
+    def ps(name, align, bold=False, color=None):
+        return ParagraphStyle(name, fontSize=_FONT_SIZE, leading=_LEADING, alignment=align,
+                              fontName="Helvetica-Bold" if bold else "Helvetica",
+                              textColor=colors.HexColor(color) if color else colors.black)
+
+    return {
+        "header": ParagraphStyle("HeaderStyle", fontSize=7, leading=9, alignment=TA_CENTER,
+                                 fontName="Helvetica-Bold", textColor=colors.whitesmoke),
+        # (numérica, colorida, ok) -> estilo das células com quebra de linha
+        (False, False, None): ps("Cell", TA_LEFT),
+        (True, False, None): ps("CellRight", TA_RIGHT),
+        (False, True, True): ps("CellGreen", TA_LEFT, True, _GREEN),
+        (False, True, False): ps("CellRed", TA_LEFT, True, _RED),
+        (True, True, True): ps("CellRightGreen", TA_RIGHT, True, _GREEN),
+        (True, True, False): ps("CellRightRed", TA_RIGHT, True, _RED),
+    }
+
+
+def _chunk_table(p: Dict, styles: Dict, start: int, stop: int, header: List):
+    """Table com as linhas [start, stop) e o cabeçalho; estilos por coluna e por faixa de linhas."""
+    from reportlab.lib import colors
+    from reportlab.platypus import Paragraph, Table, TableStyle
+
+    numeric, colored = set(p["numeric_idx"]), set(p["color_idx"])
+    data = [header]
+    for r in range(start, stop):
+        row = list(p["cells"][r])
+        if p["wrap"] is not None:
+            for j in p["wrap"][r]:
+                key = (j in numeric, j in colored, p["ok"][r] if j in colored else None)
+                row[j] = Paragraph(escape(row[j]), styles[key])
+        data.append(row)
+
+    grey = colors.HexColor("#F2F2F2")
+    cmds = [
+        # Cabeçalho
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#4472C4")),
+        ("VALIGN", (0, 0), (-1, 0), "MIDDLE"),
+        ("TOPPADDING", (0, 0), (-1, 0), 6),
+        ("BOTTOMPADDING", (0, 0), (-1, 0), 6),
+        # Corpo da tabela
+        ("FONTNAME", (0, 1), (-1, -1), "Helvetica"),
+        ("FONTSIZE", (0, 1), (-1, -1), _FONT_SIZE),
+        ("LEADING", (0, 1), (-1, -1), _LEADING),
+        ("VALIGN", (0, 1), (-1, -1), "TOP"),
+        ("TOPPADDING", (0, 1), (-1, -1), _PAD),
+        ("BOTTOMPADDING", (0, 1), (-1, -1), _PAD),
+        ("LEFTPADDING", (0, 1), (-1, -1), _PAD),
+        ("RIGHTPADDING", (0, 1), (-1, -1), _PAD),
+        # Grid
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+        # Linhas alternadas (a paridade segue a posição da linha no relatório inteiro)
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1),
+         [colors.white, grey] if (p.get("offset", 0) + start) % 2 == 0 else [grey, colors.white]),
+    ]
+    for j in p["numeric_idx"]:
+        cmds.append(("ALIGN", (j, 1), (j, -1), "RIGHT"))
+    for j in p["color_idx"]:
+        cmds.append(("FONTNAME", (j, 1), (j, -1), "Helvetica-Bold"))
+    # Cores por faixas contíguas de linhas OK / com divergência
+    r = start
+    while r < stop:
+        end = r
+        while end + 1 < stop and p["ok"][end + 1] == p["ok"][r]:
+            end += 1
+        cor = colors.HexColor(_GREEN if p["ok"][r] else _RED)
+        for j in p["color_idx"]:
+            cmds.append(("TEXTCOLOR", (j, r - start + 1), (j, end - start + 1), cor))
+        r = end + 1
+
+    table = Table(data, colWidths=p["widths"], repeatRows=1)
+    table.setStyle(TableStyle(cmds))
+    return table
+
+
+def _row_height_floor(p: Dict, r: int) -> float:
+    """Altura mínima estimada da linha (a real pode ser maior; o excesso é aparado no split)."""
+    lines = 1
+    if p["wrap"] is not None:
+        for j in p["wrap"][r]:
+            room = p["widths"][j] - 2 * _PAD
+            lines = max(lines, int(len(p["cells"][r][j]) * _FONT_SIZE * 0.5 // room) + 1)
+    return lines * _LEADING + 2 * _PAD
+
+
+def _render(p: Dict) -> bytes:
+    """Renderiza um PDF com as linhas de `p`, uma Table por página."""
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.units import cm
+    from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate
+
+    buf = io.BytesIO()
+    # Ajustar margens para caber mais conteúdo
+    doc = SimpleDocTemplate(buf, pagesize=landscape(A4), title=p["title"],
+                            topMargin=0.8*cm, bottomMargin=0.8*cm,
+                            leftMargin=0.5*cm, rightMargin=0.5*cm)
+    avail_w, avail_h = doc.width - 12, doc.height - 12   # padding padrão do Frame (6 pt por lado)
+    styles = _styles()
+    header = [Paragraph(escape(c), styles["header"]) for c in p["columns"]]
+    header_h = 30
+
+    elements = []
+    n = len(p["cells"])
+    start = 0
+    while start < n or not elements:
+        # Estima o bloco pela altura mínima das linhas, com folga; o split do reportlab apara
+        # o excesso, então cada página sai tão cheia quanto numa Table única
+        stop, used = start, header_h
+        while stop < n and used + _row_height_floor(p, stop) <= avail_h:
+            used += _row_height_floor(p, stop)
+            stop += 1
+        stop = min(n, stop + max(4, (stop - start) // 4))
+        table = _chunk_table(p, styles, start, stop, header)
+        _, h = table.wrap(avail_w, avail_h)
+        if h > avail_h and stop - start > 1:
+            parts = table.split(avail_w, avail_h)
+            fitted = len(parts[0]._cellvalues) - 1 if parts else 0
+            if fitted >= 1:
+                table, stop = parts[0], start + fitted
+        if elements:
+            elements.append(PageBreak())
+        elements.append(table)
+        start = stop
+
+    doc.build(elements)
+    return buf.getvalue()
+
+
+def _segment(p: Dict, start: int, stop: int) -> Dict:
+    """Recorte [start, stop) dos dados preparados (para uma faixa paralela)."""
+    seg = dict(p, offset=start)
+    seg["cells"] = p["cells"][start:stop]
+    seg["ok"] = p["ok"][start:stop]
+    seg["wrap"] = p["wrap"][start:stop] if p["wrap"] is not None else None
+    return seg
+
+
+def _stitch(parts: List[bytes]) -> bytes:
+    """Junta os PDFs das faixas, na ordem, num único documento."""
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        from PyPDF2 import PdfReader, PdfWriter  # type: ignore
+    writer = PdfWriter()
+    for data in parts:
+        for page in PdfReader(io.BytesIO(data)).pages:
+            writer.add_page(page)
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def render_table_pdf(df: pd.DataFrame, title: str = "Relatório", divergencias: bool = False,
+                     parallel: Optional[bool] = None) -> bytes:
+    """
+    PDF (A4 paisagem) da tabela, com cabeçalho repetido em cada página, números no padrão
+    brasileiro e Status/Diferença em verde (OK) ou vermelho (divergência).
+    `divergencias=True` mantém só as linhas que não estão OK. `parallel` (padrão: a partir de
+    PDF_PARALLEL_MIN_ROWS linhas) divide as linhas em faixas renderizadas em processos e
+    reunidas com pypdf; cada faixa começa numa página nova.
+    """
+    if divergencias:
+        df = divergences_only(df)
+    p = _prepare(df, title)
+    n = len(p["cells"])
+    workers = min(PDF_MAX_WORKERS or os.cpu_count() or 1, max(n, 1))
+    if parallel is None:
+        parallel = n >= PDF_PARALLEL_MIN_ROWS
+    if parallel and workers >= 2:
+        step = -(-n // workers)
+        segs = [_segment(p, a, min(a + step, n)) for a in range(0, n, step)]
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as ex:
+                return _stitch(list(ex.map(_render, segs)))
+        except Exception:
+            pass  # pool ou pypdf indisponível: segue na renderização sequencial
+    return _render(p)
+
+
+if __name__ == "__main__":
+    # Verificação rápida da formatação: python pdf_report.py
+    amostra = pd.Series([1234567.891, -1000, 0.004, np.nan, "", "abc", np.inf, -np.inf])
+    esperado = ["1.234.567,89", "-1.000,00", "0,00", "0,00", "0,00", "0,00", "inf", "-inf"]
+    obtido = format_br_numbers(amostra).tolist()
+    assert obtido == esperado, obtido
+    print("format_br_numbers ok:", obtido)
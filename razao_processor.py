@@ -3,71 +3,264 @@ Módulo para processamento de arquivos de Razão (TXT).
 Responsável por ler, limpar e processar dados de razão contábil.
 """
 
+import io
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import pandas as pd
-import numpy as np
-from typing import Dict, List, Optional, Tuple
-from utils import clean_code_main, to_number_br_main, extract_desc_before_first_digit_main
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+from utils import (
+    clean_code_series, to_cents_br_series, extract_desc_before_first_digit_main,
+    cents_to_reais, CENTS_DTYPE
+)
+from exclusion_rules import REGRAS_PADRAO, apply_rules
+from exclusion_rules import CODIGOS_SERVICOS_PRESTADOS  # noqa: F401 (mantido importável daqui)
 
 
 # =============================================================================
-# Constantes - Códigos de Serviços Prestados
+# Funções de Processamento de Razão
 # =============================================================================
-CODIGOS_SERVICOS_PRESTADOS = {
-    "00141", "00142", "00143", "00144", "80083", "80514",
-    "80535", "80107", "00000", "00406"
-}
+# Colunas do lote Alterdata usadas pela conferência: código, valor e histórico
+RAZAO_USECOLS = [1, 3, 7]
+# Lote Alterdata: separador ',', campos com vírgula entre aspas duplas ("1.234,56"),
+# aspas internas escapadas por duplicação ("")
+_RAZAO_CSV_OPTS = dict(sep=",", header=None, dtype=str, quotechar='"', doublequote=True)
+# Tamanho dos blocos da leitura em streaming (linhas para o pandas, bytes para o pyarrow)
+RAZAO_CHUNK_ROWS = 200_000
+RAZAO_BLOCK_BYTES = 16 << 20
+# Volume total a partir do qual consolidate_razao_files lê os TXT num pool de processos
+RAZAO_PARALLEL_MIN_BYTES = 64 << 20
+
+
+# Tokens tratados como nulos pelo pandas.read_csv (padrão documentado), replicados no leitor pyarrow
+_CSV_NA_TOKENS = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+
+def _iter_razao_pyarrow(fh) -> Iterator[pd.DataFrame]:
+    """
+    Leitura em blocos via pyarrow.csv com projeção e todas as colunas como texto.
+    (O engine="pyarrow" do pandas infere tipos antes de aplicar dtype=str e perderia zeros à esquerda.)
+    """
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    names = [f"f{i}" for i in RAZAO_USECOLS]
+    reader = pa_csv.open_csv(
+        fh,
+        read_options=pa_csv.ReadOptions(autogenerate_column_names=True, block_size=RAZAO_BLOCK_BYTES),
+        parse_options=pa_csv.ParseOptions(delimiter=",", quote_char='"', double_quote=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=names,
+            column_types={n: pa.string() for n in names},
+            null_values=_CSV_NA_TOKENS,
+            strings_can_be_null=True,
+        ),
+    )
+    for batch in reader:
+        yield pa.Table.from_batches([batch]).to_pandas().set_axis(["cod", "valor", "hist"], axis=1)
+
+
+def _iter_razao_c(fh) -> Iterator[pd.DataFrame]:
+    """Leitura em blocos via engine C do pandas com projeção de colunas (tolera campos extras no fim da linha)."""
+    with pd.read_csv(fh, engine="c", usecols=RAZAO_USECOLS, chunksize=RAZAO_CHUNK_ROWS,
+                     **_RAZAO_CSV_OPTS) as reader:
+        for chunk in reader:
+            yield chunk[RAZAO_USECOLS].set_axis(["cod", "valor", "hist"], axis=1)
+
+
+def _iter_razao_python(fh) -> Iterator[pd.DataFrame]:
+    """Leitura em blocos via engine python (todas as colunas); 'hist' só existe se houver 8+ colunas."""
+    with pd.read_csv(fh, engine="python", chunksize=RAZAO_CHUNK_ROWS, **_RAZAO_CSV_OPTS) as reader:
+        for chunk in reader:
+            cols = {"cod": chunk.iloc[:, 1], "valor": chunk.iloc[:, 3]}
+            if chunk.shape[1] >= 8:
+                cols["hist"] = chunk.iloc[:, 7]
+            yield pd.DataFrame(cols)
+
+
+def _razao_readers() -> List[Tuple[str, Callable[[BinaryIO], Iterator[pd.DataFrame]]]]:
+    """Leitores disponíveis, na ordem de preferência; o python é o caminho de último recurso."""
+    readers = []
+    try:
+        import pyarrow.csv  # noqa: F401
+        readers.append(("pyarrow", _iter_razao_pyarrow))
+    except ImportError:
+        pass
+    readers.append(("c", _iter_razao_c))
+    readers.append(("python", _iter_razao_python))
+    return readers
+
+
+@contextmanager
+def _open_source(file):
+    """Abre o TXT (caminho ou file-like) para leitura binária desde o início, sem copiá-lo."""
+    if hasattr(file, "read"):
+        try:
+            file.seek(0)
+        except Exception:
+            pass
+        try:
+            yield file
+        finally:
+            try:
+                file.seek(0)
+            except Exception:
+                pass
+    else:
+        with open(file, "rb") as fh:
+            yield fh
+
+
+def _register_first_descriptions(cod: pd.Series, hist: pd.Series, desc: Dict[str, str]) -> None:
+    """
+    Registra em `desc` a primeira descrição não vazia dos códigos que ainda não têm uma.
+    Extrai primeiro só a 1ª linha de cada código pendente; as demais linhas do bloco
+    são examinadas apenas para os códigos que continuaram sem descrição.
+    """
+    pend = ~cod.isin(list(desc))
+    if not pend.any():
+        return
+    cod, hist = cod[pend], hist[pend]
+
+    first = ~cod.duplicated()
+    for c, d in zip(cod[first], hist[first].map(extract_desc_before_first_digit_main)):
+        if len(str(d)) > 0:
+            desc[c] = d
+
+    rest = ~first & ~cod.isin(list(desc))
+    if rest.any():
+        for c, d in zip(cod[rest], hist[rest].map(extract_desc_before_first_digit_main)):
+            if c not in desc and len(str(d)) > 0:
+                desc[c] = d
+
+
+def _aggregate_razao_chunks(chunks: Iterator[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Agrega os blocos (cod, valor, hist) mantendo só a soma corrente e a primeira descrição
+    por lançamento: a memória fica proporcional aos códigos distintos, não às linhas.
+    """
+    soma = pd.Series(dtype=CENTS_DTYPE)
+    desc: Dict[str, str] = {}
+    for chunk in chunks:
+        cod = clean_code_series(chunk["cod"])
+        keep = (cod != "").to_numpy()
+        cod = cod[keep]
+        val = to_cents_br_series(chunk["valor"])[keep]
+        part = val.groupby(cod.to_numpy(), sort=False).sum()
+        soma = pd.concat([soma, part]).groupby(level=0, sort=False).sum()
+        if "hist" in chunk.columns:
+            _register_first_descriptions(cod, chunk["hist"][keep], desc)
+
+    soma = soma.sort_index().rename_axis("lancamento").reset_index(name="valor_razao")
+    desc1 = pd.DataFrame(list(desc.items()), columns=["lancamento", "descricao"])
+    return soma.merge(desc1, on="lancamento", how="left")
 
 
-# =============================================================================
-# Funções de Processamento de Razão
-# =============================================================================
 def read_razao_txt(file) -> pd.DataFrame:
-    """Lê arquivo TXT de razão e processa os dados."""
-    df = pd.read_csv(file, sep=",", header=None, engine="python", dtype=str)
-    cod = df.iloc[:, 1].map(clean_code_main)
-    val = df.iloc[:, 3].map(to_number_br_main)
-    desc = df.iloc[:, 7].map(extract_desc_before_first_digit_main) if df.shape[1] >= 8 else ""
-
-    out = pd.DataFrame({
-        "lancamento": cod,
-        "valor_razao": val,
-        "descricao": desc
-    })
-    out = out[out["lancamento"] != ""]
-
-    soma = out.groupby("lancamento", as_index=False)["valor_razao"].sum()
-    desc1 = (out[out["descricao"].astype(str).str.len() > 0]
-                .drop_duplicates(subset=["lancamento"], keep="first")[["lancamento", "descricao"]])
-    razao_agg = soma.merge(desc1, on="lancamento", how="left")
+    """
+    Lê arquivo TXT de razão em blocos e agrega por lançamento (valor_razao em centavos).
+    Usa pyarrow/C com projeção das colunas 1, 3 e 7; se a leitura rápida falhar (ex.: menos de
+    8 colunas ou linhas com número irregular de campos), recomeça com o engine python.
+    O engine de leitura utilizado fica em `attrs["engine"]` do resultado.
+    """
+    readers = _razao_readers()
+    for i, (engine, reader) in enumerate(readers):
+        try:
+            with _open_source(file) as fh:
+                razao_agg = _aggregate_razao_chunks(reader(fh))
+            break
+        except Exception:
+            if i == len(readers) - 1:
+                raise
+    razao_agg.attrs["engine"] = engine
     return razao_agg
 
 
-def consolidate_razao_files(razao_files: List) -> pd.DataFrame:
-    """Consolida múltiplos arquivos TXT de razão."""
+def _source_size(f) -> int:
+    """Tamanho em bytes de um TXT (caminho ou file-like), sem lê-lo."""
+    if isinstance(f, (str, os.PathLike)):
+        return os.path.getsize(f)
+    if getattr(f, "size", None) is not None:
+        return int(f.size)
+    if hasattr(f, "getbuffer"):
+        with f.getbuffer() as mv:
+            return mv.nbytes
+    return 0
+
+
+def _source_payload(f):
+    """Conteúdo enviado aos processos do pool: o caminho ou os bytes do upload."""
+    if isinstance(f, (str, os.PathLike)):
+        return f
+    if hasattr(f, "getvalue"):
+        return f.getvalue()
+    with _open_source(f) as fh:
+        return fh.read()
+
+
+def _read_razao_partial(source) -> Tuple[Optional[pd.DataFrame], str, Optional[str]]:
+    """
+    Lê um TXT e devolve (agregado por lançamento, engine, erro).
+    Roda também nos processos do pool, por isso não propaga exceções.
+    """
+    try:
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        rz = read_razao_txt(source)
+        return rz, rz.attrs.get("engine", ""), None
+    except Exception as e:
+        return None, "", str(e)
+
+
+def _read_partials_parallel(razao_files: List, max_workers: Optional[int]) -> Optional[List]:
+    """Lê os TXT num pool de processos; None se o pool não puder ser usado (recai na leitura serial)."""
+    workers = min(max_workers or os.cpu_count() or 1, len(razao_files))
+    if workers < 2:
+        return None
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as ex:
+            return list(ex.map(_read_razao_partial, [_source_payload(f) for f in razao_files]))
+    except Exception:
+        return None
+
+
+def consolidate_razao_files(razao_files: List, max_workers: Optional[int] = None) -> pd.DataFrame:
+    """
+    Consolida múltiplos arquivos TXT de razão (engine de leitura por arquivo em `attrs["engines"]`).
+    Com 2+ arquivos somando RAZAO_PARALLEL_MIN_BYTES ou mais, os arquivos são lidos em paralelo
+    num pool de processos (max_workers=1 força a leitura serial). Cada arquivo devolve seu agregado
+    por lançamento e a consolidação é uma única redução sobre esses parciais.
+    """
     if not razao_files:
         return pd.DataFrame(columns=["lancamento", "valor_razao", "descricao"])
 
-    razoes = []
-    for f in razao_files:
-        try:
-            rz = read_razao_txt(f)
-            rz["arquivo"] = f.name
-            razoes.append(rz)
-        except Exception as e:
-            raise ValueError(f"Erro lendo TXT {f.name}: {e}")
+    results = None
+    if (len(razao_files) > 1 and max_workers != 1
+            and sum(_source_size(f) for f in razao_files) >= RAZAO_PARALLEL_MIN_BYTES):
+        results = _read_partials_parallel(razao_files, max_workers)
+    if results is None:
+        results = [_read_razao_partial(f) for f in razao_files]
 
-    if not razoes:
-        return pd.DataFrame(columns=["lancamento", "valor_razao", "descricao"])
+    partials = []
+    engines = {}
+    for f, (rz, engine, err) in zip(razao_files, results):
+        name = getattr(f, "name", str(f))
+        if err is not None:
+            raise ValueError(f"Erro lendo TXT {name}: {err}")
+        engines[name] = engine
+        partials.append(rz)
 
+    # Soma por lançamento e 1ª descrição não nula (na ordem dos arquivos) numa só passada
     razao_total = (
-        pd.concat(razoes, ignore_index=True)
-          .groupby("lancamento", as_index=False)["valor_razao"].sum()
-          .merge(
-              pd.concat(razoes, ignore_index=True)[["lancamento", "descricao"]]
-                .dropna().drop_duplicates("lancamento"),
-              on="lancamento", how="left"
-          )
+        pd.concat(partials, ignore_index=True)
+          .groupby("lancamento", as_index=False)
+          .agg(valor_razao=("valor_razao", "sum"), descricao=("descricao", "first"))
     )
+    razao_total.attrs["engines"] = engines
     return razao_total
 
 
@@ -75,12 +268,17 @@ def consolidate_razao_files(razao_files: List) -> pd.DataFrame:
 # Funções de Comparação BI vs Razão
 # =============================================================================
 def compare_bi_vs_razao(bi: pd.DataFrame, razao: pd.DataFrame) -> pd.DataFrame:
-    """Compara dados do BI com dados do Razão."""
+    """
+    Compara dados do BI com dados do Razão.
+    Entradas em centavos (int64): 'ok' é igualdade inteira exata; a saída traz os valores em reais.
+    """
     comp = bi.merge(razao, on="lancamento", how="outer")
-    comp["valor_bi"] = comp["valor_bi"].fillna(0.0)
-    comp["valor_razao"] = comp["valor_razao"].fillna(0.0)
+    comp["valor_bi"] = comp["valor_bi"].fillna(0).astype(CENTS_DTYPE)
+    comp["valor_razao"] = comp["valor_razao"].fillna(0).astype(CENTS_DTYPE)
     comp["dif"] = comp["valor_bi"] - comp["valor_razao"]
-    comp["ok"] = np.isclose(comp["dif"], 0.0, atol=0.01)
+    comp["ok"] = comp["dif"].eq(0)
+    for c in ["valor_bi", "valor_razao", "dif"]:
+        comp[c] = cents_to_reais(comp[c])
 
     if "descricao" not in comp.columns:
         comp["descricao"] = ""
@@ -112,12 +310,14 @@ def is_comparison_perfect(metrics: Dict[str, int]) -> bool:
 # =============================================================================
 # Funções para Filtrar Serviços Prestados
 # =============================================================================
-def filter_servicos_prestados(razao_total: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+def filter_servicos_prestados(razao_total: pd.DataFrame,
+                              regras: Optional[List[Dict]] = None) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     Separa lançamentos de serviços prestados do razão principal.
 
     Args:
         razao_total: DataFrame com dados do razão consolidado
+        regras: conjunto de regras "servicos_prestados" (None = padrão de exclusion_rules)
 
     Returns:
         tuple: (razao_sem_servicos, razao_servicos)
@@ -127,15 +327,18 @@ def filter_servicos_prestados(razao_total: pd.DataFrame) -> tuple[pd.DataFrame,
     if razao_total.empty:
         return razao_total, pd.DataFrame(columns=razao_total.columns)
 
-    # Criar máscara para identificar serviços prestados
-    mask_servicos = razao_total["lancamento"].isin(CODIGOS_SERVICOS_PRESTADOS)
+    # Máscara dos serviços prestados pelas regras de exclusão (um passe)
+    keep, counts = apply_rules(razao_total, REGRAS_PADRAO["servicos_prestados"] if regras is None else regras)
+    mask_servicos = ~keep
 
     # Separar em dois DataFrames
     razao_servicos = razao_total[mask_servicos].copy()
     razao_sem_servicos = razao_total[~mask_servicos].copy()
+    razao_sem_servicos.attrs["exclusoes"] = counts
 
-    # Renomear e reordenar colunas para exibição
+    # Renomear e reordenar colunas para exibição (valores em reais)
     if not razao_servicos.empty:
+        razao_servicos["valor_razao"] = cents_to_reais(razao_servicos["valor_razao"])
         razao_servicos = razao_servicos.rename(columns={
             "lancamento": "Lançamento",
             "descricao": "Descrição",
@@ -7,137 +7,141 @@ import io
 import os
 import re
 import csv
+import codecs
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Optional, Tuple
-from utils import clean_code_main, to_number_br_main, format_brazilian_number
+from typing import Dict, List, Optional, Tuple, Union
+from utils import (
+    clean_code_main, clean_code_series, decimal_to_cents, format_brazilian_number,
+    cents_to_reais, CENTS_DTYPE
+)
 from sn_pdf import (
-    parse_livro_icms_pdf_entradas,
-    parse_livro_icms_pdf_saidas,
+    parse_livro_icms_pdf_entradas_saidas,
     parse_livro_icms_st_pdf,
 )
+from cfop_analyzer import BaseIndex, as_base_index
+from exclusion_rules import REGRAS_PADRAO, apply_rules
+from exclusion_rules import CODIGOS_SERVICOS_PRESTADOS  # noqa: F401 (mantido importável daqui)
 
 
 # =============================================================================
-# Constantes - Códigos de Serviços Prestados
+# Funções de Processamento de PDF
 # =============================================================================
-CODIGOS_SERVICOS_PRESTADOS = {
-    "00141", "00142", "00143", "00144", "80083", "80514",
-    "80535", "80107", "00000", "00406"
-}
+def _empty_lanc_tot() -> pd.DataFrame:
+    return pd.DataFrame({"lancamento": pd.Series(dtype=object), "valor": pd.Series(dtype=CENTS_DTYPE)})
 
 
-# =============================================================================
-# Funções de Processamento de PDF
-# =============================================================================
-def process_icms_pdf(pdf_file, base_map: Dict[str, Dict]) -> Tuple[pd.DataFrame, pd.DataFrame, List[str], Dict]:
-    """Processa PDF de ICMS (Entradas + Saídas)."""
+def _map_cfop_lancamentos(df: pd.DataFrame, pares: List[Tuple[str, str]], lanc_table: pd.DataFrame,
+                          skip_zero: bool = False) -> Tuple[pd.DataFrame, List[str], Dict]:
+    """
+    Distribui os valores por CFOP nos lançamentos da base: merge com a base em forma de
+    tabela, melt para (lancamento, valor, cfop) e um único groupby que dá os totais por
+    lançamento e a composição (CFOPs) de cada um.
+    `pares` liga cada código da base (contabil, icms, icms_subst...) à coluna de valor em centavos.
+    Retorna (totais, CFOPs sem nenhum dos códigos, {lançamento: {CFOPs}}).
+    """
+    cfop = clean_code_series(df["CFOP"]).to_numpy(dtype=object)
+    codes = pd.DataFrame({"CFOP": cfop}).merge(lanc_table, on="CFOP", how="left")
+
+    lanc_cols = {key: codes[key].fillna("").to_numpy(dtype=object) for key, _ in pares}
+    sem_codigo = np.logical_and.reduce([lanc_cols[key] == "" for key, _ in pares])
+    cfop_sem_mapa = cfop[sem_codigo].tolist()
+
+    # Formato longo na mesma ordem de antes: linha a linha, código a código
+    n = len(cfop)
+    long = pd.concat([
+        pd.DataFrame({
+            "ordem": np.arange(n) * len(pares) + j,
+            "lancamento": lanc_cols[key],
+            "valor": df[col].to_numpy().astype(CENTS_DTYPE),
+            "cfop": cfop,
+        })
+        for j, (key, col) in enumerate(pares)
+    ], ignore_index=True).sort_values("ordem", kind="stable")
+
+    keep = long["lancamento"] != ""
+    if skip_zero:
+        keep &= long["valor"] != 0
+    long = long[keep]
+    if long.empty:
+        return _empty_lanc_tot(), cfop_sem_mapa, {}
+
+    grouped = long.groupby("lancamento", sort=False).agg(valor=("valor", "sum"), cfops=("cfop", "unique"))
+    lanc_tot = grouped["valor"].astype(CENTS_DTYPE).sort_index().reset_index()
+    comp_map = {lanc: set(cfops) for lanc, cfops in grouped["cfops"].items()}
+    return lanc_tot, cfop_sem_mapa, comp_map
+
+def process_icms_pdf(pdf_file, base_map: Union[Dict[str, Dict], BaseIndex]) -> Tuple[pd.DataFrame, pd.DataFrame, List[str], Dict]:
+    """Processa PDF de ICMS (Entradas + Saídas). Valores por lançamento em centavos (int64)."""
     if pdf_file is None:
         return pd.DataFrame(), pd.DataFrame(), [], {}
 
     try:
-        df_ent = parse_livro_icms_pdf_entradas(pdf_file, keep_numeric=True)
-        df_sai = parse_livro_icms_pdf_saidas(pdf_file, keep_numeric=True)
+        df_ent, df_sai = parse_livro_icms_pdf_entradas_saidas(pdf_file, keep_numeric=True)
     except Exception as e:
         raise ValueError(f"Falha ao ler o PDF (ICMS): {e}")
 
     # Combina E+S numéricos por CFOP
-    e_num = (df_ent[["CFOP","Valor Contábil (num)","Imposto Creditado (num)"]]
-             .rename(columns={"Valor Contábil (num)":"vc_num",
-                              "Imposto Creditado (num)":"icms_num"})
-             if not df_ent.empty else pd.DataFrame(columns=["CFOP","vc_num","icms_num"]))
+    e_num = (df_ent[["CFOP","Valor Contábil (centavos)","Imposto Creditado (centavos)"]]
+             .rename(columns={"Valor Contábil (centavos)":"vc_cents",
+                              "Imposto Creditado (centavos)":"icms_cents"})
+             if not df_ent.empty else pd.DataFrame(columns=["CFOP","vc_cents","icms_cents"]))
 
-    s_num = (df_sai[["CFOP","Valor Contábil (num)","Imposto Debitado (num)"]]
-             .rename(columns={"Valor Contábil (num)":"vc_num",
-                              "Imposto Debitado (num)":"icms_num"})
-             if not df_sai.empty else pd.DataFrame(columns=["CFOP","vc_num","icms_num"]))
+    s_num = (df_sai[["CFOP","Valor Contábil (centavos)","Imposto Debitado (centavos)"]]
+             .rename(columns={"Valor Contábil (centavos)":"vc_cents",
+                              "Imposto Debitado (centavos)":"icms_cents"})
+             if not df_sai.empty else pd.DataFrame(columns=["CFOP","vc_cents","icms_cents"]))
 
     # Agregado de Imposto Debitado (somente SAÍDAS) para o LOG
-    s_deb_agg = (df_sai[["CFOP","Imposto Debitado (num)"]]
-                 .rename(columns={"Imposto Debitado (num)":"imposto_debitado_num"})
-                 .groupby("CFOP", as_index=False)["imposto_debitado_num"].sum()
-                 if not df_sai.empty else pd.DataFrame(columns=["CFOP","imposto_debitado_num"]))
+    s_deb_agg = (df_sai[["CFOP","Imposto Debitado (centavos)"]]
+                 .rename(columns={"Imposto Debitado (centavos)":"imposto_debitado_cents"})
+                 .groupby("CFOP", as_index=False)["imposto_debitado_cents"].sum()
+                 if not df_sai.empty else pd.DataFrame(columns=["CFOP","imposto_debitado_cents"]))
 
     both = pd.concat([e_num, s_num], ignore_index=True)
 
     if both.empty:
         return pd.DataFrame(), pd.DataFrame(), [], {}
 
-    # Soma E+S por CFOP
-    both = both.groupby("CFOP", as_index=False)[["vc_num","icms_num"]].sum()
+    # Soma E+S por CFOP (centavos exatos)
+    both = both.groupby("CFOP", as_index=False)[["vc_cents","icms_cents"]].sum()
+    both[["vc_cents","icms_cents"]] = both[["vc_cents","icms_cents"]].astype(CENTS_DTYPE)
 
     # LOG: Contábil (E+S) vs Imposto Debitado (S)
     log_df = (both.merge(s_deb_agg, on="CFOP", how="left")
-                    .fillna({"imposto_debitado_num": 0.0}))
-    log_df["Valor Contábil"] = log_df["vc_num"].map(format_brazilian_number)
-    log_df["Imposto Debitado"] = log_df["imposto_debitado_num"].map(format_brazilian_number)
-
-    # Saída normal do pipeline
-    df_pdf_extr = both.assign(
-        **{
-            "Valor Contábil": both["vc_num"].map(format_brazilian_number),
-            "Imposto Creditado": both["icms_num"].map(format_brazilian_number),
-        }
-    )[["CFOP","Valor Contábil","Imposto Creditado"]].copy()
+                    .fillna({"imposto_debitado_cents": 0}))
+    log_df["imposto_debitado_cents"] = log_df["imposto_debitado_cents"].astype(CENTS_DTYPE)
+    log_df["Valor Contábil"] = cents_to_reais(log_df["vc_cents"]).map(format_brazilian_number)
+    log_df["Imposto Debitado"] = cents_to_reais(log_df["imposto_debitado_cents"]).map(format_brazilian_number)
 
     # Mapeia CFOP → lançamentos via base
-    pdf_lanc_tot = pd.DataFrame(columns=["lancamento","valor"])
+    pdf_lanc_tot = _empty_lanc_tot()
     comp_map = {}
     cfop_sem_mapa = []
 
-    if not both.empty and base_map:
-        rows = []
-        for _, r in both.iterrows():
-            cfop = clean_code_main(r["CFOP"])
-            mapa = base_map.get(cfop) or {}
-            lc = clean_code_main(mapa.get("contabil") or "")
-            li = clean_code_main(mapa.get("icms") or "")
-            if lc:
-                rows.append({"lancamento": lc, "valor": float(r["vc_num"])})
-                comp_map.setdefault(lc, set()).add(cfop)
-            if li:
-                rows.append({"lancamento": li, "valor": float(r["icms_num"])})
-                comp_map.setdefault(li, set()).add(cfop)
-            if not lc and not li:
-                cfop_sem_mapa.append(cfop)
-
-        if rows:
-            pdf_lanc_tot = pd.DataFrame(rows).groupby("lancamento", as_index=False)["valor"].sum()
+    index = as_base_index(base_map)
+    if not both.empty and index.lanc:
+        pdf_lanc_tot, cfop_sem_mapa, comp_map = _map_cfop_lancamentos(
+            both, [("contabil", "vc_cents"), ("icms", "icms_cents")], index.lanc_table
+        )
 
     return pdf_lanc_tot, log_df, cfop_sem_mapa, comp_map
 
 
-def process_icms_st_pdf(pdf_file_st, base_map: Dict[str, Dict]) -> Tuple[pd.DataFrame, List[str], Dict]:
-    """Processa PDF de ICMS ST."""
-    if pdf_file_st is None or not base_map:
+def process_icms_st_pdf(pdf_file_st, base_map: Union[Dict[str, Dict], BaseIndex]) -> Tuple[pd.DataFrame, List[str], Dict]:
+    """Processa PDF de ICMS ST. Valores por lançamento em centavos (int64)."""
+    index = as_base_index(base_map)
+    if pdf_file_st is None or not index.lanc:
         return pd.DataFrame(columns=["lancamento","valor"]), [], {}
 
     try:
         df_st = parse_livro_icms_st_pdf(pdf_file_st, keep_numeric=True)
-        df_st["total_st_num"] = df_st.get("total_st_num", 0.0)
-
-        rows_st = []
-        cfop_st_sem_mapa = []
-        comp_map_st = {}
-
-        for _, r in df_st.iterrows():
-            cf = clean_code_main(r["CFOP"])
-            mapa = base_map.get(cf) or {}
-            lanc_st = clean_code_main(mapa.get("icms_subst") or "")
-            if lanc_st:
-                val = float(r["total_st_num"])
-                if val != 0.0:
-                    rows_st.append({"lancamento": lanc_st, "valor": val})
-                    comp_map_st.setdefault(lanc_st, set()).add(cf)
-            else:
-                cfop_st_sem_mapa.append(cf)
-
-        if rows_st:
-            st_lanc_tot = pd.DataFrame(rows_st).groupby("lancamento", as_index=False)["valor"].sum()
-        else:
-            st_lanc_tot = pd.DataFrame(columns=["lancamento","valor"])
-
-        return st_lanc_tot, cfop_st_sem_mapa, comp_map_st
+        df_st["total_st_cents"] = df_st.get("total_st_cents", 0)
+
+        # Só valores diferentes de zero entram no total; CFOP sem icms_subst vai para a lista
+        return _map_cfop_lancamentos(df_st, [("icms_subst", "total_st_cents")], index.lanc_table,
+                                     skip_zero=True)
 
     except Exception as e:
         raise ValueError(f"Falha ao ler o PDF de ICMS ST: {e}")
@@ -146,65 +150,79 @@ def process_icms_st_pdf(pdf_file_st, base_map: Dict[str, Dict]) -> Tuple[pd.Data
 # =============================================================================
 # Funções de Processamento de TXT
 # =============================================================================
-def parse_txt_lancamento_valor_desc(txt_file) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    """
-    Retorna:
-      - df_val : lancamento | valor
-      - df_desc: lancamento | descricao
-    Lê CSV/TXT com delimitador ',', ';', '\t' ou '|', respeitando aspas.
-    """
-    def _read_bytes(f):
-        if f is None:
-            return b""
-        if hasattr(f, "read"):
-            b = f.read()
+# Tamanho dos blocos lidos do TXT na validação de encoding
+TXT_CHUNK_BYTES = 1 << 20
+
+
+@contextmanager
+def _open_txt_source(f):
+    """Abre o TXT (caminho, bytes ou file-like) para leitura binária desde o início; None se não houver fonte."""
+    if f is None:
+        yield None
+    elif hasattr(f, "read"):
+        try:
+            f.seek(0)
+        except Exception:
+            pass
+        try:
+            yield f
+        finally:
             try:
                 f.seek(0)
             except Exception:
                 pass
-            return b
-        if isinstance(f, (bytes, bytearray)):
-            return bytes(f)
-        if isinstance(f, str) and os.path.exists(f):
-            with open(f, "rb") as fh:
-                return fh.read()
-        return b""
-
-    raw = _read_bytes(txt_file)
-    if not raw:
-        return (pd.DataFrame(columns=["lancamento","valor"]),
-                pd.DataFrame(columns=["lancamento","descricao"]))
-
-    text = None
-    for enc in ("utf-8-sig","utf-8","latin-1","cp1252"):
-        try:
-            text = raw.decode(enc)
-            break
-        except Exception:
-            continue
-    if text is None:
-        return (pd.DataFrame(columns=["lancamento","valor"]),
-                pd.DataFrame(columns=["lancamento","descricao"]))
+    elif isinstance(f, (bytes, bytearray)):
+        yield io.BytesIO(f)
+    elif isinstance(f, str) and os.path.exists(f):
+        with open(f, "rb") as fh:
+            yield fh
+    else:
+        yield None
 
-    sample = text[:2000]
+
+def _detect_txt_encoding(fh) -> Optional[str]:
+    """
+    Valida o arquivo como UTF-8 em blocos (sem montar a string inteira); recai em latin-1.
+    Retorna None para arquivo vazio.
+    """
+    dec = codecs.getincrementaldecoder("utf-8")()
+    empty = True
     try:
-        dialect = csv.Sniffer().sniff(sample, delimiters=[",",";","\t","|"])
-        delim = dialect.delimiter
-    except Exception:
-        delim = ";" if sample.count(";") > sample.count(",") else ","
+        while True:
+            block = fh.read(TXT_CHUNK_BYTES)
+            if not block:
+                break
+            empty = False
+            dec.decode(block)
+        dec.decode(b"", final=True)
+        enc = "utf-8-sig"
+    except UnicodeDecodeError:
+        enc = "latin-1"
+    return None if empty else enc
 
-    reader = csv.reader(io.StringIO(text), delimiter=delim, quotechar='"', skipinitialspace=True)
 
-    def br_to_float(s: str) -> float:
+def parse_txt_lancamento_valor_desc(txt_file) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Retorna:
+      - df_val : lancamento | valor (centavos, int64)
+      - df_desc: lancamento | descricao (a mais longa de cada lançamento)
+    Lê CSV/TXT com delimitador ',', ';', '\t' ou '|', respeitando aspas.
+    A leitura é em streaming: mantém só a soma corrente e a descrição por lançamento,
+    então a memória fica proporcional aos códigos distintos, não às linhas.
+    """
+    empty = (pd.DataFrame(columns=["lancamento","valor"]),
+             pd.DataFrame(columns=["lancamento","descricao"]))
+
+    def br_to_cents(s: str) -> int:
         if s is None:
-            return 0.0
+            return 0
         s = str(s).strip().strip('"').strip()
         neg = s.startswith("(") and s.endswith(")")
         if neg:
             s = s[1:-1]
         s = s.replace(".", "").replace("\u00A0", "").replace(" ", "").replace(",", ".")
         m = re.search(r"[-+]?\d+(?:\.\d+)?", s)
-        v = float(m.group(0)) if m else 0.0
+        v = decimal_to_cents(m.group(0)) if m else 0
         return -v if neg and v > 0 else v
 
     def only_text_until_first_digit(s: str) -> str:
@@ -216,29 +234,54 @@ def parse_txt_lancamento_valor_desc(txt_file) -> Tuple[pd.DataFrame, pd.DataFram
         head = head.replace(";", " ").strip(" -–—:•\t").strip()
         return " ".join(head.split())
 
-    vals, descs = [], []
-    for row in reader:
-        if not row or len(row) < 8:
-            continue
-        lanc = clean_code_main(row[1])     # coluna 2
-        if lanc == "":
-            continue
-        val = br_to_float(row[3])    # coluna 4
-        vals.append({"lancamento": lanc, "valor": float(val)})
-
-        desc = only_text_until_first_digit(row[7])  # coluna 8
-        if desc:
-            descs.append({"lancamento": lanc, "descricao": desc})
-
-    if vals:
-        df_val = pd.DataFrame(vals).groupby("lancamento", as_index=False)["valor"].sum()
+    sums: Dict[str, int] = {}
+    descs: Dict[str, str] = {}
+    codes: Dict[str, str] = {}
+    with _open_txt_source(txt_file) as fh:
+        if fh is None:
+            return empty
+        enc = _detect_txt_encoding(fh)
+        if enc is None:
+            return empty
+        fh.seek(0)
+
+        text = io.TextIOWrapper(fh, encoding=enc, newline="\n")
+        try:
+            sample = text.read(2000)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=[",",";","\t","|"])
+                delim = dialect.delimiter
+            except Exception:
+                delim = ";" if sample.count(";") > sample.count(",") else ","
+            text.seek(0)
+
+            reader = csv.reader(text, delimiter=delim, quotechar='"', skipinitialspace=True)
+            for row in reader:
+                if not row or len(row) < 8:
+                    continue
+                lanc = codes.get(row[1])
+                if lanc is None:
+                    lanc = codes[row[1]] = clean_code_main(row[1])     # coluna 2
+                if lanc == "":
+                    continue
+                sums[lanc] = sums.get(lanc, 0) + br_to_cents(row[3])    # coluna 4
+
+                desc = only_text_until_first_digit(row[7])  # coluna 8
+                if desc and len(desc) > len(descs.get(lanc, "")):
+                    descs[lanc] = desc
+        finally:
+            text.detach()   # não fecha o arquivo de origem
+
+    if sums:
+        df_val = (pd.DataFrame({"lancamento": list(sums),
+                                "valor": pd.Series(list(sums.values()), dtype=CENTS_DTYPE)})
+                  .sort_values("lancamento", ignore_index=True))
     else:
-        df_val = pd.DataFrame(columns=["lancamento","valor"])
+        df_val = pd.DataFrame({"lancamento": pd.Series(dtype=object), "valor": pd.Series(dtype=CENTS_DTYPE)})
 
     if descs:
-        df_desc = (pd.DataFrame(descs)
-                   .sort_values(["lancamento", "descricao"], key=lambda s: s.str.len(), ascending=False)
-                   .drop_duplicates("lancamento"))
+        df_desc = (pd.DataFrame(list(descs.items()), columns=["lancamento", "descricao"])
+                   .sort_values(["lancamento", "descricao"], key=lambda s: s.str.len(), ascending=False))
     else:
         df_desc = pd.DataFrame(columns=["lancamento","descricao"])
 
@@ -251,7 +294,10 @@ def parse_txt_lancamento_valor_desc(txt_file) -> Tuple[pd.DataFrame, pd.DataFram
 def compare_simples_nacional(pdf_icms: pd.DataFrame, pdf_icms_st: pd.DataFrame,
                            txt_lanc_tot: pd.DataFrame, txt_desc: pd.DataFrame,
                            comp_map_union: Dict) -> pd.DataFrame:
-    """Compara dados do Livro de ICMS x Lote Contábil: PDF (ICMS + ST) vs TXT."""
+    """
+    Compara dados do Livro de ICMS x Lote Contábil: PDF (ICMS + ST) vs TXT.
+    Entradas em centavos (int64); o relatório devolvido traz os valores em reais.
+    """
     # Composição por lançamento
     comp_cfop_union = (
         pd.DataFrame([{"lancamento": k, "cfops": ", ".join(sorted(v))} for k, v in comp_map_union.items()])
@@ -269,24 +315,29 @@ def compare_simples_nacional(pdf_icms: pd.DataFrame, pdf_icms_st: pd.DataFrame,
     comp = pd.merge(comp, comp_cfop_union, on="lancamento", how="left")
     comp = pd.merge(comp, txt_desc, on="lancamento", how="left")
 
+    # Valores em centavos: comparação por igualdade inteira exata
     for c in ["Livro ICMS","Livro ICMS ST","Lote Contábil"]:
         if c in comp.columns:
-            comp[c] = comp[c].fillna(0.0).astype(float)
+            comp[c] = comp[c].fillna(0).astype(CENTS_DTYPE)
 
-    comp["Diferença"] = comp["Lote Contábil"] - (comp["Livro ICMS"].fillna(0.0) + comp["Livro ICMS ST"].fillna(0.0))
+    livro = comp["Livro ICMS"] + comp["Livro ICMS ST"]
+    comp["Diferença"] = comp["Lote Contábil"] - livro
 
-    tol = 0.01
     comp["Status"] = np.where(
-        comp["Diferença"].abs() <= tol, "OK ✅",
+        comp["Diferença"] == 0, "OK ✅",
         np.where(
-            ((comp["Livro ICMS"].fillna(0)+comp["Livro ICMS ST"].fillna(0)) > 0) & (comp["Lote Contábil"] == 0), "Ausente no TXT",
+            (livro > 0) & (comp["Lote Contábil"] == 0), "Ausente no TXT",
             np.where(
-                ((comp["Livro ICMS"].fillna(0)+comp["Livro ICMS ST"].fillna(0)) == 0) & (comp["Lote Contábil"] > 0), "Extra no TXT",
+                (livro == 0) & (comp["Lote Contábil"] > 0), "Extra no TXT",
                 "Diferente ❌"
             )
         )
     )
 
+    # Relatório em reais
+    for c in ["Livro ICMS","Livro ICMS ST","Lote Contábil","Diferença"]:
+        comp[c] = cents_to_reais(comp[c])
+
     comp.rename(columns={"lancamento": "Lançamento",
                          "cfops": "CFOP",
                          "descricao": "Descrição"}, inplace=True)
@@ -323,13 +374,15 @@ def is_simples_nacional_perfect(metrics: Dict[str, int]) -> bool:
 # =============================================================================
 # Funções para Filtrar Serviços Prestados
 # =============================================================================
-def filter_servicos_prestados_txt(txt_lanc_tot: pd.DataFrame, txt_desc: pd.DataFrame = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+def filter_servicos_prestados_txt(txt_lanc_tot: pd.DataFrame, txt_desc: pd.DataFrame = None,
+                                  regras: Optional[List[Dict]] = None) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     Separa lançamentos de serviços prestados do TXT principal.
 
     Args:
         txt_lanc_tot: DataFrame com dados do TXT consolidado
         txt_desc: DataFrame com descrições dos lançamentos (opcional)
+        regras: conjunto de regras "servicos_prestados" (None = padrão de exclusion_rules)
 
     Returns:
         tuple: (txt_sem_servicos, txt_servicos)
@@ -339,17 +392,23 @@ def filter_servicos_prestados_txt(txt_lanc_tot: pd.DataFrame, txt_desc: pd.DataF
     if txt_lanc_tot.empty:
         return txt_lanc_tot, pd.DataFrame(columns=txt_lanc_tot.columns)
 
-    # Criar máscara para identificar serviços prestados
-    mask_servicos = txt_lanc_tot["lancamento"].isin(CODIGOS_SERVICOS_PRESTADOS)
+    # Máscara dos serviços prestados pelas regras de exclusão (um passe)
+    keep, counts = apply_rules(txt_lanc_tot, REGRAS_PADRAO["servicos_prestados"] if regras is None else regras)
+    mask_servicos = ~keep
 
     # Separar em dois DataFrames
     txt_servicos = txt_lanc_tot[mask_servicos].copy()
     txt_sem_servicos = txt_lanc_tot[~mask_servicos].copy()
+    txt_sem_servicos.attrs["exclusoes"] = counts
 
     # Adicionar descrição se fornecida
     if txt_desc is not None and not txt_desc.empty and not txt_servicos.empty:
         txt_servicos = txt_servicos.merge(txt_desc, on="lancamento", how="left")
 
+    # Tabela de exibição em reais
+    if not txt_servicos.empty and "valor" in txt_servicos.columns:
+        txt_servicos["valor"] = cents_to_reais(txt_servicos["valor"])
+
     # Renomear e reordenar colunas para exibição
     if not txt_servicos.empty:
         txt_servicos = txt_servicos.rename(columns={
@@ -1,19 +1,46 @@
 # sn_pdf.py
 from __future__ import annotations
 import io
+import os
 import re
 import unicodedata
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
 import pandas as pd
 
 # Leitor de PDF robusto: pypdf preferido; cai para PyPDF2 se necessário
 try:
     from pypdf import PdfReader
+    from pypdf import __version__ as _PDF_LIB_VERSION
 except Exception:  # pragma: no cover
     from PyPDF2 import PdfReader  # type: ignore
+    from PyPDF2 import __version__ as _PDF_LIB_VERSION  # type: ignore
+
+from disk_cache import content_key, load_frame, store_frame, load_json, store_json
+
+# Versões que compõem as chaves do cache em disco (junto com o hash do PDF):
+# incrementar SN_PDF_PARSER_VERSION ao mudar a varredura/agregação das tabelas e
+# _PAGE_TEXT_VERSION ao mudar o texto guardado por página
+SN_PDF_PARSER_VERSION = "1"
+_PAGE_TEXT_VERSION = "2"
 
 # Padrão de número no formato BR: 1.234,56
 _SN_NUM = r'(?:\d{1,3}(?:\.\d{3})*|\d+),\d{2}'
 
+# Tokenizador das linhas do livro (padrões compilados uma única vez)
+_NUM_RE = re.compile(_SN_NUM)
+_GLUED_RE = re.compile(fr'({_SN_NUM})(?={_SN_NUM})')
+_CFOP_LINE_RE = re.compile(r"^\s*(\d{4})\b(.*)$")
+
+# Colunas numéricas do livro: float (compat) e centavos exatos (int64)
+_NUM_COLS = ["base_num", "imposto_num", "isentas_num", "outras_num", "contab_num"]
+_CENTS_COLS = ["base_cents", "imposto_cents", "isentas_cents", "outras_cents", "contab_cents"]
+_LIVRO_COLS = ["bloco", "CFOP", "Imposto", "Valor Contábil"] + _NUM_COLS + _CENTS_COLS
+_ST_COLS = ["CFOP", "Imposto Creditado ST", "Imposto Debitado ST",
+            "creditado_st_num", "debitado_st_num", "total_st_num",
+            "creditado_st_cents", "debitado_st_cents", "total_st_cents"]
+
 
 # ------------------------ Helpers ------------------------
 def _norm(s: str) -> str:
@@ -26,12 +53,25 @@ def _norm(s: str) -> str:
 def _split_glued_amounts(txt: str) -> str:
     """Insere espaço quando 2 valores monetários ficam colados (ex.: '22.813,2681.823,08')."""
     while True:
-        new = re.sub(fr'({_SN_NUM})(?={_SN_NUM})', r'\1 ', txt)
+        new = _GLUED_RE.sub(r'\1 ', txt)
         if new == txt:
             return new
         txt = new
 
 
+def _block_header(line: str) -> str | None:
+    """
+    "Entradas"/"Saídas" se a linha for cabeçalho de bloco, senão None.
+    Linhas ASCII dispensam a normalização NFKD de _norm (o resultado é o mesmo).
+    """
+    n = line.lower().replace(" ", "") if line.isascii() else _norm(line)
+    if "entradas" in n:
+        return "Entradas"
+    if "saida" in n:  # "saida" ou "saidas"
+        return "Saídas"
+    return None
+
+
 def _to_number_br(s: str | None) -> float:
     """Converte número BR para float (aceita parênteses como negativo)."""
     if s is None:
@@ -48,127 +88,218 @@ def _to_number_br(s: str | None) -> float:
     return -v if neg else v
 
 
+def _to_cents_br(s: str | None) -> int:
+    """Converte número BR (sempre com 2 casas no livro) para centavos inteiros."""
+    if s is None:
+        return 0
+    s = str(s).strip()
+    neg = s.startswith("(") and s.endswith(")")
+    if neg:
+        s = s[1:-1]
+    s = s.replace(".", "").replace("\u00A0", "").replace(" ", "").replace(",", "")
+    try:
+        v = int(s)
+    except Exception:
+        v = 0
+    return -v if neg else v
+
+
 def _fmt_br(v: float) -> str:
     """Formata float no padrão BR."""
     return f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
 
 
-def _open_reader(file_or_bytes) -> PdfReader:
-    """Aceita UploadedFile/bytes/caminho e devolve um PdfReader."""
+def _read_pdf_bytes(file_or_bytes) -> bytes:
+    """Aceita UploadedFile/bytes/caminho e devolve o conteúdo do PDF."""
     if isinstance(file_or_bytes, (bytes, bytearray)):
-        return PdfReader(io.BytesIO(file_or_bytes))
+        return bytes(file_or_bytes)
     if hasattr(file_or_bytes, "read"):
         raw = file_or_bytes.read()
         try:
             file_or_bytes.seek(0)
         except Exception:
             pass
-        return PdfReader(io.BytesIO(raw))
-    return PdfReader(file_or_bytes)
+        return raw
+    with open(file_or_bytes, "rb") as fh:
+        return fh.read()
 
 
-# ------------------------ API principal ------------------------
-def parse_livro_icms_pdf(
-    file_or_bytes,
-    bloco: str | None = None,
-    keep_numeric: bool = True,
-) -> pd.DataFrame:
+# ------------------------ Varredura do livro (compartilhada) ------------------------
+# A partir deste número de páginas a extração de texto é distribuída num pool de processos
+PDF_PARALLEL_MIN_PAGES = 40
+# Processos do pool (None = número de CPUs)
+PDF_MAX_WORKERS: int | None = None
+
+
+def _page_text(page) -> str:
+    """Texto bruto de uma página (os valores colados são separados na varredura das linhas)."""
+    return page.extract_text() or ""
+
+
+# PdfReader de cada processo do pool: os bytes do PDF chegam uma vez por processo (initializer)
+# e são lidos uma só vez; as tarefas enviam apenas a faixa de páginas
+_WORKER_READER = None
+
+
+def _init_page_worker(data: bytes) -> None:
+    global _WORKER_READER
+    _WORKER_READER = PdfReader(io.BytesIO(data))
+
+
+def _extract_page_range(start: int, stop: int) -> list[str]:
+    """Extrai as páginas [start, stop) — executado nos processos do pool."""
+    return [_page_text(_WORKER_READER.pages[i]) for i in range(start, stop)]
+
+
+def _extract_page_texts(data: bytes) -> list[str]:
     """
-    Lê ENTRADAS e SAÍDAS (ou só um bloco) e agrega por CFOP dentro do bloco.
-    Agora captura TODAS as 5 colunas do livro:
+    Extrai o texto de cada página uma única vez, na ordem do documento.
+    PDFs com PDF_PARALLEL_MIN_PAGES+ páginas são divididos em faixas contíguas extraídas em
+    paralelo; as faixas são reunidas na ordem original, então o resultado é idêntico ao sequencial.
+    """
+    reader = PdfReader(io.BytesIO(data))
+    n_pages = len(reader.pages)
+    workers = min(PDF_MAX_WORKERS or os.cpu_count() or 1, n_pages)
+
+    if n_pages >= PDF_PARALLEL_MIN_PAGES and workers >= 2:
+        # ~4 faixas por processo para equilibrar páginas mais densas
+        step = max(1, -(-n_pages // (workers * 4)))
+        starts = list(range(0, n_pages, step))
+        stops = [min(a + step, n_pages) for a in starts]
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"),
+                                     initializer=_init_page_worker, initargs=(data,)) as ex:
+                parts = list(ex.map(_extract_page_range, starts, stops))
+            return [txt for part in parts for txt in part]
+        except Exception:
+            pass  # pool indisponível: segue na extração sequencial
 
-      1) base_num      -> Base de Cálculo
-      2) imposto_num   -> Imposto (Creditado/Debitado)
-      3) isentas_num   -> Isentas ou não tributadas
-      4) outras_num    -> Outras
-      5) contab_num    -> Contábeis
+    return [_page_text(page) for page in reader.pages]
 
-    Retorna, por padrão, as colunas texto 'Imposto' e 'Valor Contábil' (compat)
-    e, se keep_numeric=True, as 5 colunas numéricas acima (somadas).
+
+def _cached_page_texts(data: bytes) -> list[str]:
+    """Texto por página, reaproveitado do cache em disco quando o mesmo PDF já foi extraído."""
+    key = content_key(data, "pages", _PAGE_TEXT_VERSION, _PDF_LIB_VERSION)
+    texts = load_json(key)
+    if texts is None:
+        texts = _extract_page_texts(data)
+        store_json(key, texts)
+    return texts
+
+
+def _scan_livro_lines(page_texts: Iterable[str]) -> Iterator[tuple[str, str, list[str]]]:
+    """
+    Percorre as linhas das páginas acompanhando o bloco corrente ("Entradas"/"Saídas",
+    definido pelas linhas de cabeçalho) e emite (bloco, CFOP, valores BR da linha).
+    Usado pelo livro de ICMS e pelo livro de ICMS ST.
+    Uma varredura por linha com padrões compilados; a separação de valores colados
+    (_split_glued_amounts) só roda nas linhas de CFOP em que há valores colados.
     """
-    reader = _open_reader(file_or_bytes)
-    rows: list[dict] = []
     current_block: str | None = None
-
-    for page in reader.pages:
-        txt = page.extract_text() or ""
+    for txt in page_texts:
         if not txt:
             continue
-        txt = _split_glued_amounts(txt)
-
         for line in txt.splitlines():
             line = line.strip()
             if not line:
                 continue
 
-            n = _norm(line)
-            if "entradas" in n:
-                current_block = "Entradas"
-                continue
-            if "saidas" in n or "saida" in n:
-                current_block = "Saídas"
+            header = _block_header(line)
+            if header is not None:
+                current_block = header
                 continue
             if current_block is None:
                 continue
 
-            m = re.match(r"^\s*(\d{4})\b(.*)$", line)
+            m = _CFOP_LINE_RE.match(line)
             if not m:
                 continue
+            if _GLUED_RE.search(line):
+                m = _CFOP_LINE_RE.match(_split_glued_amounts(line))
 
-            cfop, tail = m.group(1), m.group(2)
-            nums = re.findall(_SN_NUM, tail)
-            if len(nums) < 5:
-                continue
+            nums = _NUM_RE.findall(m.group(2))
+            if nums:
+                yield current_block, m.group(1), nums
+
+
+# ------------------------ API principal ------------------------
+def _livro_table(data: bytes) -> pd.DataFrame:
+    """Livro agregado por (bloco, CFOP) com todas as colunas; cacheado em disco pelo conteúdo do PDF."""
+    key = content_key(data, "livro", SN_PDF_PARSER_VERSION, _PDF_LIB_VERSION)
+    agg = load_frame(key)
+    if agg is not None:
+        return agg
+
+    rows: list[dict] = []
+    for current_block, cfop, nums in _scan_livro_lines(_cached_page_texts(data)):
+        if len(nums) < 5:
+            continue
 
-            # Ordem do livro (ambos blocos):
-            # 1) Base  2) Imposto  3) Isentas  4) Outras  5) Contábeis
-            base_str, imp_str, isen_str, outr_str, cont_str = nums[:5]
-            base_num  = _to_number_br(base_str)
-            imp_num   = _to_number_br(imp_str)
-            isen_num  = _to_number_br(isen_str)
-            outr_num  = _to_number_br(outr_str)
-            cont_num  = _to_number_br(cont_str)
-
-            rows.append(
-                {
-                    "bloco": current_block,
-                    "CFOP": cfop,
-                    "Imposto": imp_str,           # compat (texto)
-                    "Valor Contábil": cont_str,   # compat (texto)
-                    "base_num": base_num,
-                    "imposto_num": imp_num,
-                    "isentas_num": isen_num,
-                    "outras_num": outr_num,
-                    "contab_num": cont_num,
-                }
-            )
+        # Ordem do livro (ambos blocos):
+        # 1) Base  2) Imposto  3) Isentas  4) Outras  5) Contábeis
+        base_str, imp_str, isen_str, outr_str, cont_str = nums[:5]
+
+        rows.append(
+            {
+                "bloco": current_block,
+                "CFOP": cfop,
+                "Imposto": imp_str,           # compat (texto)
+                "Valor Contábil": cont_str,   # compat (texto)
+                "base_cents": _to_cents_br(base_str),
+                "imposto_cents": _to_cents_br(imp_str),
+                "isentas_cents": _to_cents_br(isen_str),
+                "outras_cents": _to_cents_br(outr_str),
+                "contab_cents": _to_cents_br(cont_str),
+            }
+        )
 
     if not rows:
-        cols = ["bloco", "CFOP", "Imposto", "Valor Contábil"]
-        if keep_numeric:
-            cols += ["base_num", "imposto_num", "isentas_num", "outras_num", "contab_num"]
-        return pd.DataFrame(columns=cols)
+        agg = pd.DataFrame(columns=_LIVRO_COLS)
+    else:
+        df = pd.DataFrame(rows)
 
-    df = pd.DataFrame(rows)
+        # Soma exata em centavos; as colunas *_num (float) derivam dela
+        agg = df.groupby(["bloco", "CFOP"], as_index=False)[_CENTS_COLS].sum()
+        for num_col, cents_col in zip(_NUM_COLS, _CENTS_COLS):
+            agg[num_col] = agg[cents_col] / 100
+        # Campos texto (compat): mantém "Imposto" e "Valor Contábil" como antes
+        agg["Imposto"] = agg["imposto_num"].map(_fmt_br)
+        agg["Valor Contábil"] = agg["contab_num"].map(_fmt_br)
+        agg = agg[_LIVRO_COLS].sort_values(["bloco", "CFOP"]).reset_index(drop=True)
 
-    agg = (
-        df.groupby(["bloco", "CFOP"], as_index=False)[
-            ["base_num", "imposto_num", "isentas_num", "outras_num", "contab_num"]
-        ].sum()
-    )
-    # Campos texto (compat): mantém "Imposto" e "Valor Contábil" como antes
-    agg["Imposto"] = agg["imposto_num"].map(_fmt_br)
-    agg["Valor Contábil"] = agg["contab_num"].map(_fmt_br)
+    store_frame(key, agg)
+    return agg
+
+
+def parse_livro_icms_pdf(
+    file_or_bytes,
+    bloco: str | None = None,
+    keep_numeric: bool = True,
+) -> pd.DataFrame:
+    """
+    Lê ENTRADAS e SAÍDAS (ou só um bloco) e agrega por CFOP dentro do bloco.
+    Agora captura TODAS as 5 colunas do livro:
+
+      1) base_num      -> Base de Cálculo
+      2) imposto_num   -> Imposto (Creditado/Debitado)
+      3) isentas_num   -> Isentas ou não tributadas
+      4) outras_num    -> Outras
+      5) contab_num    -> Contábeis
+
+    Retorna, por padrão, as colunas texto 'Imposto' e 'Valor Contábil' (compat)
+    e, se keep_numeric=True, as 5 colunas numéricas acima (somadas) e as mesmas
+    5 em centavos inteiros (base_cents, imposto_cents, ...).
+    O texto extraído e a tabela agregada ficam no cache em disco (chave: hash do PDF + versão).
+    """
+    agg = _livro_table(_read_pdf_bytes(file_or_bytes))
 
     if bloco is not None:
-        agg = agg[agg["bloco"].eq(bloco)].copy()
+        agg = agg[agg["bloco"].eq(bloco)]
 
     cols = ["bloco", "CFOP", "Imposto", "Valor Contábil"]
     if keep_numeric:
-        cols += ["base_num", "imposto_num", "isentas_num", "outras_num", "contab_num"]
-
-    sort_cols = ["bloco", "CFOP"] if "bloco" in agg.columns else ["CFOP"]
-    return agg[cols].sort_values(sort_cols).reset_index(drop=True)
+        cols += _NUM_COLS + _CENTS_COLS
+    return agg[cols].reset_index(drop=True)
 
 
 # ------------------------ ICMS ST ------------------------
@@ -181,79 +312,68 @@ def parse_livro_icms_st_pdf(file_or_bytes, keep_numeric: bool = True) -> pd.Data
       CFOP | Imposto Creditado ST | Imposto Debitado ST (strings BR)
       + numéricas (se keep_numeric=True):
         creditado_st_num, debitado_st_num, total_st_num (= creditado + debitado)
+        e os equivalentes exatos em centavos (*_st_cents)
+    O texto extraído e a tabela agregada ficam no cache em disco (chave: hash do PDF + versão).
     """
-    reader = _open_reader(file_or_bytes)
-    credit = {}  # cfop -> soma créditos (entradas)
-    debit  = {}  # cfop -> soma débitos (saídas)
-    current_block: str | None = None
+    table = _st_table(_read_pdf_bytes(file_or_bytes))
+    cols = _ST_COLS if keep_numeric else _ST_COLS[:3]
+    return table[cols].copy()
 
-    for page in reader.pages:
-        txt = page.extract_text() or ""
-        if not txt:
-            continue
-        txt = _split_glued_amounts(txt)
-
-        for line in txt.splitlines():
-            line = line.strip()
-            if not line:
-                continue
 
-            n = _norm(line)
-            if "entradas" in n:
-                current_block = "Entradas"; continue
-            if "saidas" in n or "saida" in n:
-                current_block = "Saídas";   continue
-            if current_block is None:
-                continue
+def _st_table(data: bytes) -> pd.DataFrame:
+    """Livro ST agregado por CFOP com todas as colunas; cacheado em disco pelo conteúdo do PDF."""
+    key = content_key(data, "livro_st", SN_PDF_PARSER_VERSION, _PDF_LIB_VERSION)
+    table = load_frame(key)
+    if table is not None:
+        return table
 
-            m = re.match(r"^\s*(\d{4})\b(.*)$", line)
-            if not m:
-                continue
-
-            cfop, tail = m.group(1), m.group(2)
-            nums = re.findall(_SN_NUM, tail)
-            if not nums:
-                continue
+    credit = {}  # cfop -> soma créditos (entradas)
+    debit  = {}  # cfop -> soma débitos (saídas)
 
-            if current_block == "Entradas":
-                # 2º número = Imposto Creditado
-                if len(nums) >= 2:
-                    credit[cfop] = credit.get(cfop, 0.0) + _to_number_br(nums[1])
-            else:  # Saídas
-                # 3º número = Imposto Debitado (há uma coluna "Operações c/ Débito" entre eles)
-                if len(nums) >= 3:
-                    debit[cfop]  = debit.get(cfop, 0.0)  + _to_number_br(nums[2])
+    for current_block, cfop, nums in _scan_livro_lines(_cached_page_texts(data)):
+        if current_block == "Entradas":
+            # 2º número = Imposto Creditado
+            if len(nums) >= 2:
+                credit[cfop] = credit.get(cfop, 0) + _to_cents_br(nums[1])
+        else:  # Saídas
+            # 3º número = Imposto Debitado (há uma coluna "Operações c/ Débito" entre eles)
+            if len(nums) >= 3:
+                debit[cfop]  = debit.get(cfop, 0)  + _to_cents_br(nums[2])
 
-    import pandas as pd
     all_cfops = sorted(set(credit) | set(debit))
     rows = []
     for c in all_cfops:
-        cnum = float(credit.get(c, 0.0))
-        dnum = float(debit.get(c, 0.0))
+        ccents = int(credit.get(c, 0))
+        dcents = int(debit.get(c, 0))
         rows.append({
             "CFOP": c,
-            "creditado_st_num": cnum,
-            "debitado_st_num": dnum,
-            "Imposto Creditado ST": _fmt_br(cnum),
-            "Imposto Debitado ST": _fmt_br(dnum),
-            "total_st_num": cnum + dnum,
+            "creditado_st_num": ccents / 100,
+            "debitado_st_num": dcents / 100,
+            "Imposto Creditado ST": _fmt_br(ccents / 100),
+            "Imposto Debitado ST": _fmt_br(dcents / 100),
+            "total_st_num": (ccents + dcents) / 100,
+            "creditado_st_cents": ccents,
+            "debitado_st_cents": dcents,
+            "total_st_cents": ccents + dcents,
         })
-    cols = ["CFOP", "Imposto Creditado ST", "Imposto Debitado ST"]
-    if keep_numeric:
-        cols += ["creditado_st_num", "debitado_st_num", "total_st_num"]
-    return pd.DataFrame(rows, columns=cols)
+    table = pd.DataFrame(rows, columns=_ST_COLS)
+    store_frame(key, table)
+    return table
 
 
 # ------------------------ Wrappers de compatibilidade ------------------------
-def parse_livro_icms_pdf_entradas(file_or_bytes, keep_numeric: bool = True) -> pd.DataFrame:
-    df = parse_livro_icms_pdf(file_or_bytes, bloco="Entradas", keep_numeric=True)
+def _entradas_from_livro(livro: pd.DataFrame, keep_numeric: bool = True) -> pd.DataFrame:
+    """Formata o bloco ENTRADAS de um livro já agregado (saída de parse_livro_icms_pdf)."""
+    df = livro[livro["bloco"].eq("Entradas")].reset_index(drop=True)
     out = df[["CFOP", "Valor Contábil", "Imposto",
-              "imposto_num", "contab_num"]].copy()
+              "imposto_num", "contab_num", "imposto_cents", "contab_cents"]].copy()
     out.rename(
         columns={
             "Imposto": "Imposto Creditado",
             "imposto_num": "Imposto Creditado (num)",
             "contab_num": "Valor Contábil (num)",
+            "imposto_cents": "Imposto Creditado (centavos)",
+            "contab_cents": "Valor Contábil (centavos)",
         },
         inplace=True,
     )
@@ -262,13 +382,16 @@ def parse_livro_icms_pdf_entradas(file_or_bytes, keep_numeric: bool = True) -> p
     return out
 
 
-def parse_livro_icms_pdf_saidas(file_or_bytes, keep_numeric: bool = True) -> pd.DataFrame:
-    df = parse_livro_icms_pdf(file_or_bytes, bloco="Saídas", keep_numeric=True)
-    out = df[["CFOP", "base_num", "isentas_num"]].copy()
+def _saidas_from_livro(livro: pd.DataFrame, keep_numeric: bool = True) -> pd.DataFrame:
+    """Formata o bloco SAÍDAS de um livro já agregado (saída de parse_livro_icms_pdf)."""
+    df = livro[livro["bloco"].eq("Saídas")].reset_index(drop=True)
+    out = df[["CFOP", "base_num", "isentas_num", "base_cents", "isentas_cents"]].copy()
     out.rename(
         columns={
             "base_num": "Valor Contábil (num)",
             "isentas_num": "Imposto Debitado (num)",
+            "base_cents": "Valor Contábil (centavos)",
+            "isentas_cents": "Imposto Debitado (centavos)",
         },
         inplace=True,
     )
@@ -279,6 +402,26 @@ def parse_livro_icms_pdf_saidas(file_or_bytes, keep_numeric: bool = True) -> pd.
     # ordena & organiza colunas
     cols = ["CFOP", "Valor Contábil", "Imposto Debitado"]
     if keep_numeric:
-        cols += ["Valor Contábil (num)", "Imposto Debitado (num)"]
+        cols += ["Valor Contábil (num)", "Imposto Debitado (num)",
+                 "Valor Contábil (centavos)", "Imposto Debitado (centavos)"]
     out = out[cols].sort_values("CFOP").reset_index(drop=True)
     return out
+
+
+def parse_livro_icms_pdf_entradas_saidas(
+    file_or_bytes, keep_numeric: bool = True
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    ENTRADAS e SAÍDAS a partir de uma única leitura do PDF.
+    Mesmo resultado de parse_livro_icms_pdf_entradas + parse_livro_icms_pdf_saidas.
+    """
+    livro = parse_livro_icms_pdf(file_or_bytes, keep_numeric=True)
+    return _entradas_from_livro(livro, keep_numeric), _saidas_from_livro(livro, keep_numeric)
+
+
+def parse_livro_icms_pdf_entradas(file_or_bytes, keep_numeric: bool = True) -> pd.DataFrame:
+    return _entradas_from_livro(parse_livro_icms_pdf(file_or_bytes, bloco="Entradas"), keep_numeric)
+
+
+def parse_livro_icms_pdf_saidas(file_or_bytes, keep_numeric: bool = True) -> pd.DataFrame:
+    return _saidas_from_livro(parse_livro_icms_pdf(file_or_bytes, bloco="Saídas"), keep_numeric)
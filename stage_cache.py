@@ -0,0 +1,119 @@
+"""
+Memoização das etapas do app (DAG de nós).
+Cada etapa (carregar BI, agregar, ler Razão, ler Livro, comparar, métricas) vira um nó cuja
+chave é o hash das entradas (conteúdo dos arquivos enviados, parâmetros) e das chaves dos
+nós de que depende. Numa reexecução do script Streamlit só rodam os nós cujas chaves
+mudaram; os demais devolvem o resultado guardado. O armazenamento é por sessão (um dict,
+em st.session_state) e mantém só o último resultado de cada nó.
+"""
+
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple
+
+import pandas as pd
+
+
+# Hash do conteúdo dos arquivos enviados, por (nome, tamanho, file_id): evita refazer o
+# sha256 de arquivos grandes a cada reexecução (o file_id muda a cada novo upload)
+_FILE_DIGESTS: Dict[Tuple, str] = {}
+_FILE_DIGESTS_MAX = 256
+_FILE_DIGESTS_LOCK = threading.Lock()
+
+
+# =============================================================================
+# Chaves
+# =============================================================================
+def _file_digest(f) -> str:
+    ident = (getattr(f, "name", None), getattr(f, "size", None), getattr(f, "file_id", None))
+    if ident[2] is not None:
+        with _FILE_DIGESTS_LOCK:
+            if ident in _FILE_DIGESTS:
+                return _FILE_DIGESTS[ident]
+    digest = hashlib.sha256(f.getvalue()).hexdigest()
+    if ident[2] is not None:
+        with _FILE_DIGESTS_LOCK:
+            if len(_FILE_DIGESTS) >= _FILE_DIGESTS_MAX:
+                _FILE_DIGESTS.pop(next(iter(_FILE_DIGESTS)))
+            _FILE_DIGESTS[ident] = digest
+    return digest
+
+
+def _feed(h, obj: Any) -> None:
+    if obj is None:
+        h.update(b"N")
+    elif hasattr(obj, "getvalue"):                      # arquivo enviado (UploadedFile/BytesIO)
+        h.update(b"F" + str(getattr(obj, "name", "")).encode("utf-8") + b"\0")
+        h.update(_file_digest(obj).encode("ascii"))
+    elif isinstance(getattr(obj, "digest", None), str):  # BaseIndex: hash do JSON da base
+        h.update(b"B" + obj.digest.encode("ascii"))
+    elif isinstance(obj, (bytes, bytearray)):
+        h.update(b"Y" + hashlib.sha256(obj).digest())
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for x in obj:
+            _feed(h, x)
+        h.update(b"]")
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for k in sorted(obj, key=repr):
+            _feed(h, k)
+            _feed(h, obj[k])
+        h.update(b"}")
+    else:
+        h.update(b"R" + repr(obj).encode("utf-8") + b"\0")
+
+
+def input_key(*parts: Any) -> str:
+    """Chave das entradas: arquivos pelo conteúdo, BaseIndex pelo digest, coleções recursivamente, o resto por repr."""
+    h = hashlib.sha256()
+    _feed(h, parts)
+    return h.hexdigest()
+
+
+# =============================================================================
+# Execução dos Nós
+# =============================================================================
+def new_run(store: Dict) -> Dict:
+    """Início de uma execução do script: zera as estatísticas (os resultados ficam)."""
+    store.setdefault("nodes", {})
+    store["stats"] = []
+    return store
+
+
+def run_node(store: Dict, name: str, deps: Tuple, fn: Callable, *args, **kwargs) -> Tuple[Any, str]:
+    """
+    Executa `fn(*args, **kwargs)` só se a chave do nó (nome + `deps`) mudou desde a última
+    vez; senão devolve o resultado guardado. `deps` deve trazer tudo de que o resultado
+    depende: arquivos, parâmetros e as chaves dos nós anteriores. Retorna (resultado, chave).
+    Erros não são guardados (o nó roda de novo na próxima execução).
+    O resultado guardado é compartilhado entre execuções: não deve ser alterado no lugar.
+    """
+    key = input_key(name, deps)
+    t0 = time.perf_counter()
+    entry = store["nodes"].get(name)
+    if entry is not None and entry[0] == key:
+        store["stats"].append({"nó": name, "status": "hit", "ms": (time.perf_counter() - t0) * 1000, "chave": key[:12]})
+        return entry[1], key
+    try:
+        value = fn(*args, **kwargs)
+    except Exception:
+        store["stats"].append({"nó": name, "status": "erro", "ms": (time.perf_counter() - t0) * 1000, "chave": key[:12]})
+        store["nodes"].pop(name, None)
+        raise
+    store["nodes"][name] = (key, value)
+    store["stats"].append({"nó": name, "status": "miss", "ms": (time.perf_counter() - t0) * 1000, "chave": key[:12]})
+    return value, key
+
+
+def stats_frame(store: Dict) -> pd.DataFrame:
+    """Estatísticas da execução atual: nó, hit/miss/erro, tempo (ms) e início da chave."""
+    df = pd.DataFrame(store.get("stats", []), columns=["nó", "status", "ms", "chave"])
+    df["ms"] = df["ms"].astype(float).round(1)
+    return df
+
+
+def node_ran(store: Dict, name: str) -> bool:
+    """O nó foi executado (miss) nesta execução do script?"""
+    return any(s["nó"] == name and s["status"] == "miss" for s in store.get("stats", []))
@@ -3,10 +3,24 @@ Módulo de componentes de interface do usuário.
 Responsável por elementos visuais, KPIs e animações do Streamlit.
 """
 
+import hashlib
+import threading
+from collections import OrderedDict
+
 import streamlit as st
 import pandas as pd
 import numpy as np
-from typing import Any
+from typing import Any, Callable, Optional, Tuple
+
+from excel_report import XLSX_MIME, sheet_title, write_excel_sheets
+from pdf_report import render_table_pdf
+
+
+# Arquivos de download já gerados, por (hash do frame, formato, nome): gerar de novo o mesmo
+# relatório (outra reexecução, outro clique) não custa nada. Limitado em bytes (LRU).
+_EXPORTS: "OrderedDict[Tuple, Tuple[bytes, str, str]]" = OrderedDict()
+_EXPORTS_MAX_BYTES = 128 * 1024 * 1024
+_EXPORTS_LOCK = threading.Lock()
 
 
 # =============================================================================
@@ -253,329 +267,212 @@ def show_success_message(message: str) -> None:
     trigger_fireworks()
 
 
+def show_read_diagnostics(df: Optional[pd.DataFrame]) -> None:
+    """Mostra formato, engine e tempo de leitura (df.attrs["leitura"]) e as exclusões por regra, se houver."""
+    leitura = df.attrs.get("leitura") if df is not None else None
+    if leitura:
+        origem = " (cache em disco)" if leitura.get("cache") else ""
+        st.caption(f"Leitura: formato {leitura['formato']} via {leitura['engine']}{origem} "
+                   f"em {leitura['segundos']:.2f}s")
+    exclusoes = df.attrs.get("exclusoes") if df is not None else None
+    if exclusoes:
+        st.caption("Linhas excluídas por regra: " + " · ".join(f"{n} {q}" for n, q in exclusoes.items()))
+
+
+def show_stage_stats(stats: pd.DataFrame) -> None:
+    """Mostra hit/miss e tempo de cada etapa memoizada (stage_cache.stats_frame) desta execução."""
+    if stats.empty:
+        st.caption("Nenhuma etapa executada.")
+        return
+    hits = int(stats["status"].eq("hit").sum())
+    st.caption(f"{hits} de {len(stats)} etapas reaproveitadas • {stats['ms'].sum():.0f} ms no total")
+    st.dataframe(stats, use_container_width=True, hide_index=True)
+
+
 # =============================================================================
 # Filtros e Controles
 # =============================================================================
-def create_status_filters(result_df: pd.DataFrame) -> tuple:
+def create_status_filters(result_df: pd.DataFrame, key_prefix: str = "") -> tuple:
     """Cria filtros de status e origem."""
     status_filter = st.multiselect(
         "Filtrar por Status",
-        options=sorted(result_df["Status"].dropna().unique().tolist())
+        options=sorted(result_df["Status"].dropna().unique().tolist()),
+        key=f"{key_prefix}_status_filter"
     )
 
     origem_filter = []
     if "origem" in result_df.columns:
         origem_filter = st.multiselect(
             "Filtrar por Origem",
-            options=sorted(result_df["origem"].dropna().unique().tolist())
+            options=sorted(result_df["origem"].dropna().unique().tolist()),
+            key=f"{key_prefix}_origem_filter"
         )
 
     return status_filter, origem_filter
 
 
 def apply_filters(df: pd.DataFrame, status_filter: list, origem_filter: list) -> pd.DataFrame:
-    """Aplica filtros ao DataFrame."""
-    filtered = df.copy()
+    """Aplica filtros ao DataFrame (uma máscara só; sem filtros devolve o próprio frame, sem cópia)."""
+    if not status_filter and not (origem_filter and "origem" in df.columns):
+        return df
+    mask = np.ones(len(df), dtype=bool)
     if status_filter:
-        filtered = filtered[filtered["Status"].isin(status_filter)]
+        mask &= df["Status"].isin(status_filter).to_numpy()
     if origem_filter and "origem" in df.columns:
-        filtered = filtered[filtered["origem"].isin(origem_filter)]
-    return filtered
+        mask &= df["origem"].isin(origem_filter).to_numpy()
+    return df[mask]
 
 
 # =============================================================================
-# Funções de Download
+# Fragmentos (reexecução parcial)
 # =============================================================================
-def create_download_buttons(df: pd.DataFrame, base_filename: str) -> None:
-    """Cria botões de download para CSV e Excel."""
-    col1, col2 = st.columns(2)
+# Filtros, tabelas e downloads rodam como st.fragment: interagir com eles reexecuta só o
+# próprio fragmento, com os frames já calculados passados como argumento, e não as 3 abas.
+@st.fragment
+def filtered_result_fragment(result_df: pd.DataFrame, base_filename: str, key_prefix: str = "") -> None:
+    """Filtros de status/origem, tabela filtrada e downloads do resultado."""
+    status_filter, origem_filter = create_status_filters(result_df, key_prefix)
+    filtered = apply_filters(result_df, status_filter, origem_filter)
+    if status_filter or origem_filter:
+        st.caption(f"{len(filtered)} de {len(result_df)} linhas")
 
-    with col1:
-        csv_bytes = df.to_csv(index=False).encode("utf-8-sig")
-        st.download_button(
-            f"Baixar {base_filename} (.csv)",
-            data=csv_bytes,
-            file_name=f"{base_filename.lower().replace(' ', '_')}.csv",
-            mime="text/csv"
-        )
+    st.dataframe(filtered, use_container_width=True)
+    create_download_buttons(filtered, base_filename, key_prefix=key_prefix)
 
-    with col2:
-        excel_bytes, excel_name, excel_mime = make_excel_bytes(df, base_filename)
-        st.download_button(
-            f"Baixar {base_filename} (Excel)",
-            data=excel_bytes,
-            file_name=excel_name,
-            mime=excel_mime
-        )
 
+@st.fragment
+def comparison_table_fragment(comp: pd.DataFrame, base_filename: str = "Comparação", key_prefix: str = "",
+                              height: int = 420, table_key: Optional[str] = None) -> None:
+    """Tabela de comparação colorida e seus downloads (Excel e PDF)."""
+    styled = format_comparison_table(comp)
+    st.dataframe(styled, use_container_width=True, height=height, key=table_key)
+    create_comparison_download_buttons(comp, base_filename, key_prefix=key_prefix)
 
-def make_excel_bytes(df: pd.DataFrame, sheet_name: str = "Relatorio") -> tuple:
-    """Gera bytes do Excel para download."""
-    import io
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlwt") as writer:
-            df.to_excel(writer, index=False, sheet_name=sheet_name)
-        return buf.getvalue(), f"{sheet_name.lower().replace(' ','_')}.xls", "application/vnd.ms-excel"
-    except Exception:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name=sheet_name)
-        return (buf.getvalue(), f"{sheet_name.lower().replace(' ','_')}.xlsx",
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-
-def make_pdf_bytes(df: pd.DataFrame, title: str = "Relatório") -> bytes:
-    """Gera bytes do PDF para download."""
-    from reportlab.lib import colors
-    from reportlab.lib.pagesizes import A4, landscape
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.units import cm
-    from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
-    import io
-
-    buf = io.BytesIO()
-    # Ajustar margens para caber mais conteúdo
-    doc = SimpleDocTemplate(
-        buf,
-        pagesize=landscape(A4),
-        topMargin=0.8*cm,
-        bottomMargin=0.8*cm,
-        leftMargin=0.5*cm,
-        rightMargin=0.5*cm
-    )
-    elements = []
 
-    # Preparar dados da tabela - formatar números
-    df_formatted = df.copy()
+# =============================================================================
+# Funções de Download
+# =============================================================================
+def frame_digest(df: pd.DataFrame) -> str:
+    """Hash do conteúdo do DataFrame (colunas, tipos e valores, sem o índice)."""
+    h = hashlib.sha256()
+    h.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode("utf-8"))
+    try:
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    except TypeError:   # células não hasheáveis (listas, dicts...)
+        h.update(df.to_csv(index=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _export_cached(key: Tuple) -> Optional[Tuple[bytes, str, str]]:
+    with _EXPORTS_LOCK:
+        item = _EXPORTS.get(key)
+        if item is not None:
+            _EXPORTS.move_to_end(key)
+        return item
+
+
+def _export_store(key: Tuple, item: Tuple[bytes, str, str]) -> None:
+    with _EXPORTS_LOCK:
+        _EXPORTS[key] = item
+        _EXPORTS.move_to_end(key)
+        total = sum(len(v[0]) for v in _EXPORTS.values())
+        while total > _EXPORTS_MAX_BYTES and len(_EXPORTS) > 1:
+            _, old = _EXPORTS.popitem(last=False)
+            total -= len(old[0])
+
+
+def lazy_download_button(df: Optional[pd.DataFrame], fmt: str, build: Callable[[], Tuple[bytes, str, str]],
+                         label: str, key: str, name: str = "", error_hint: str = "",
+                         digest: Optional[str] = None) -> None:
+    """
+    Botão de download gerado sob demanda: o arquivo só é montado quando o usuário pede
+    ("Gerar ...") e fica memoizado por (hash do frame, formato, nome). Se já foi gerado,
+    mostra direto o botão de download. `build()` devolve (bytes, nome do arquivo, mime);
+    `digest` evita recalcular o hash do frame quando vários botões usam o mesmo.
+    """
+    cache_key = (digest or frame_digest(df), fmt, name)
+    item = _export_cached(cache_key)
+    if item is None:
+        if not st.button(label.replace("Baixar", "Gerar", 1), key=f"{key}_gerar"):
+            return
+        try:
+            with st.spinner(f"Gerando {fmt.upper()}..."):
+                item = build()
+        except Exception as e:
+            st.error(f"Erro ao gerar {fmt.upper()}: {e}.{' ' + error_hint if error_hint else ''}")
+            return
+        _export_store(cache_key, item)
 
-    # Colunas numéricas que precisam de formatação (Parte 2 e Parte 3)
-    numeric_cols = ["Livro ICMS", "Livro ICMS ST", "Lote Contábil", "Diferença",
-                    "valor_bi", "valor_razao", "dif"]
-    for col in numeric_cols:
-        if col in df_formatted.columns:
-            df_formatted[col] = df_formatted[col].apply(
-                lambda x: f"{float(x):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-                if pd.notna(x) and x != "" else "0,00"
-            )
+    data, file_name, mime = item
+    st.download_button(label, data=data, file_name=file_name, mime=mime, key=key)
 
-    # Substituir valores NaN por string vazia
-    df_formatted = df_formatted.fillna("")
-
-    # Calcular largura disponível
-    available_width = landscape(A4)[0] - 1*cm
-
-    # Definir larguras das colunas em cm (mais controle)
-    col_widths_mapping = {
-        # Parte 3 (Livro ICMS)
-        "CFOP": 4.5*cm,
-        "Lançamento": 2.2*cm,
-        "Descrição": 6*cm,
-        "Livro ICMS": 2.5*cm,
-        "Livro ICMS ST": 2.5*cm,
-        "Lote Contábil": 2.5*cm,
-        "Diferença": 2.2*cm,
-        "Status": 2*cm,
-        # Parte 2 (BI x Razão)
-        "Código de Lançamento": 2.5*cm,
-        "Descrição": 7*cm,
-        "Valor BI": 3*cm,
-        "Valor Razão": 3*cm,
-        "Diferença": 3*cm,
-        "Status": 2*cm
-    }
-
-    col_widths = [col_widths_mapping.get(col, 2*cm) for col in df_formatted.columns]
-
-    # Estilos para Paragraph
-    styles = getSampleStyleSheet()
-
-    header_style = ParagraphStyle(
-        'HeaderStyle',
-        parent=styles['Normal'],
-        fontSize=7,
-        alignment=TA_CENTER,
-        textColor=colors.whitesmoke,
-        fontName='Helvetica-Bold',
-        leading=9
-    )
 
-    cell_style = ParagraphStyle(
-        'CellStyle',
-        parent=styles['Normal'],
-        fontSize=6.5,
-        alignment=TA_LEFT,
-        fontName='Helvetica',
-        leading=8
-    )
+def create_download_buttons(df: pd.DataFrame, base_filename: str, key_prefix: str = "") -> None:
+    """Cria botões de download para CSV e Excel (gerados sob demanda)."""
+    digest = frame_digest(df)
+    col1, col2 = st.columns(2)
 
-    cell_style_right = ParagraphStyle(
-        'CellStyleRight',
-        parent=styles['Normal'],
-        fontSize=6.5,
-        alignment=TA_RIGHT,
-        fontName='Helvetica',
-        leading=8
-    )
+    with col1:
+        lazy_download_button(
+            df, "csv",
+            lambda: (df.to_csv(index=False).encode("utf-8-sig"),
+                     f"{base_filename.lower().replace(' ', '_')}.csv", "text/csv"),
+            f"Baixar {base_filename} (.csv)", key=f"{key_prefix}_csv_download", name=base_filename,
+            digest=digest
+        )
 
-    # Construir dados da tabela com Paragraphs para quebra de linha
-    data = []
-
-    # Cabeçalho
-    header_row = [Paragraph(str(col), header_style) for col in df_formatted.columns]
-    data.append(header_row)
-
-    # Colunas numéricas (índices podem variar, vamos identificar por nome)
-    numeric_col_indices = [i for i, col in enumerate(df_formatted.columns)
-                          if col in numeric_cols]
-
-    # Estilos para células OK (verde) e com erro (vermelho)
-    cell_style_green = ParagraphStyle(
-        'CellStyleGreen',
-        parent=styles['Normal'],
-        fontSize=6.5,
-        alignment=TA_LEFT,
-        fontName='Helvetica-Bold',
-        leading=8,
-        textColor=colors.HexColor('#16A34A')  # Verde
-    )
+    with col2:
+        lazy_download_button(
+            df, "excel", lambda: make_excel_bytes(df, base_filename),
+            f"Baixar {base_filename} (Excel)", key=f"{key_prefix}_excel_download", name=base_filename,
+            digest=digest
+        )
 
-    cell_style_red = ParagraphStyle(
-        'CellStyleRed',
-        parent=styles['Normal'],
-        fontSize=6.5,
-        alignment=TA_LEFT,
-        fontName='Helvetica-Bold',
-        leading=8,
-        textColor=colors.HexColor('#DC2626')  # Vermelho
-    )
 
-    cell_style_right_green = ParagraphStyle(
-        'CellStyleRightGreen',
-        parent=styles['Normal'],
-        fontSize=6.5,
-        alignment=TA_RIGHT,
-        fontName='Helvetica-Bold',
-        leading=8,
-        textColor=colors.HexColor('#16A34A')  # Verde
+def make_excel_bytes(df: pd.DataFrame, sheet_name: str = "Relatorio") -> tuple:
+    """Gera bytes do Excel (.xlsx em streaming, excel_report) para download."""
+    return (write_excel_sheets({sheet_name: df}),
+            f"{sheet_name.lower().replace(' ','_')}.xlsx", XLSX_MIME)
+
+
+def create_workbook_download_button(sheets: dict, base_filename: str, key: str) -> None:
+    """Um único .xlsx com cada tabela (nome da aba -> DataFrame) numa aba, gerado sob demanda."""
+    digest = hashlib.sha256("".join(
+        sheet_title(n) + frame_digest(df) for n, df in sheets.items()).encode("utf-8")).hexdigest()
+    lazy_download_button(
+        None, "excel_abas",
+        lambda: (write_excel_sheets(sheets), f"{base_filename.lower().replace(' ', '_')}.xlsx", XLSX_MIME),
+        f"Baixar {base_filename} (Excel)", key=key, name=base_filename, digest=digest
     )
 
-    cell_style_right_red = ParagraphStyle(
-        'CellStyleRightRed',
-        parent=styles['Normal'],
-        fontSize=6.5,
-        alignment=TA_RIGHT,
-        fontName='Helvetica-Bold',
-        leading=8,
-        textColor=colors.HexColor('#DC2626')  # Vermelho
-    )
 
-    # Identificar índices das colunas de Status e Diferença/dif/ok
-    status_col_idx = None
-    diff_col_idx = None
-    ok_col_idx = None
-
-    for i, col in enumerate(df_formatted.columns):
-        if col == "Status":
-            status_col_idx = i
-        elif col in ["Diferença", "dif"]:
-            diff_col_idx = i
-        elif col == "ok":
-            ok_col_idx = i
-
-    # Corpo
-    for _, row in df_formatted.iterrows():
-        row_data = []
-
-        # Determinar se a linha está OK ou tem erro
-        is_ok = False
-        if status_col_idx is not None:
-            # Parte 3: Verificar coluna Status
-            is_ok = str(row.iloc[status_col_idx]).startswith("OK")
-        elif ok_col_idx is not None:
-            # Parte 2: Verificar coluna ok
-            is_ok = str(row.iloc[ok_col_idx]).lower() in ["true", "1", "yes"]
-
-        for i, (col_name, value) in enumerate(zip(df_formatted.columns, row)):
-            # Determinar o estilo baseado na coluna e no status
-            should_color = (i == status_col_idx or i == diff_col_idx or i == ok_col_idx)
-
-            if should_color:
-                # Aplicar cor verde ou vermelha
-                if is_ok:
-                    style = cell_style_right_green if i in numeric_col_indices else cell_style_green
-                else:
-                    style = cell_style_right_red if i in numeric_col_indices else cell_style_red
-            else:
-                # Estilo normal
-                style = cell_style_right if i in numeric_col_indices else cell_style
-
-            row_data.append(Paragraph(str(value), style))
-
-        data.append(row_data)
-
-    # Criar tabela
-    table = Table(data, colWidths=col_widths, repeatRows=1)
-
-    # Estilo da tabela
-    table.setStyle(TableStyle([
-        # Cabeçalho
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, 0), 'MIDDLE'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 7),
-        ('TOPPADDING', (0, 0), (-1, 0), 6),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
-
-        # Corpo da tabela
-        ('VALIGN', (0, 1), (-1, -1), 'TOP'),
-        ('TOPPADDING', (0, 1), (-1, -1), 3),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 3),
-        ('LEFTPADDING', (0, 1), (-1, -1), 3),
-        ('RIGHTPADDING', (0, 1), (-1, -1), 3),
-
-        # Grid
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-
-        # Linhas alternadas
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
-    ]))
-
-    elements.append(table)
-    doc.build(elements)
-
-    return buf.getvalue()
+def make_pdf_bytes(df: pd.DataFrame, title: str = "Relatório", divergencias: bool = False) -> bytes:
+    """Gera bytes do PDF para download (pdf_report.render_table_pdf; `divergencias` = só linhas não OK)."""
+    return render_table_pdf(df, title, divergencias=divergencias)
 
 
 def create_comparison_download_buttons(df: pd.DataFrame, base_filename: str = "Comparação", key_prefix: str = "") -> None:
-    """Cria apenas 2 botões de download: Excel e PDF para comparação."""
+    """Cria apenas 2 botões de download: Excel e PDF para comparação (gerados sob demanda)."""
+    digest = frame_digest(df)
     col1, col2 = st.columns(2)
 
     with col1:
-        excel_bytes, excel_name, excel_mime = make_excel_bytes(df, base_filename)
-        st.download_button(
-            "Baixar comparação (Excel)",
-            data=excel_bytes,
-            file_name=excel_name,
-            mime=excel_mime,
-            key=f"{key_prefix}_excel_download"
+        lazy_download_button(
+            df, "excel", lambda: make_excel_bytes(df, base_filename),
+            "Baixar comparação (Excel)", key=f"{key_prefix}_excel_download", name=base_filename,
+            digest=digest
         )
 
     with col2:
-        try:
-            pdf_bytes = make_pdf_bytes(df, base_filename)
-            st.download_button(
-                "Baixar comparação (PDF)",
-                data=pdf_bytes,
-                file_name=f"{base_filename.lower().replace(' ', '_')}.pdf",
-                mime="application/pdf",
-                key=f"{key_prefix}_pdf_download"
-            )
-        except Exception as e:
-            st.error(f"Erro ao gerar PDF: {e}. Instale reportlab: pip install reportlab")
+        divergencias = st.checkbox("PDF só com divergências", value=False, key=f"{key_prefix}_pdf_divergencias")
+        sufixo = "_divergencias" if divergencias else ""
+        lazy_download_button(
+            df, "pdf_divergencias" if divergencias else "pdf",
+            lambda: (make_pdf_bytes(df, base_filename, divergencias=divergencias),
+                     f"{base_filename.lower().replace(' ', '_')}{sufixo}.pdf", "application/pdf"),
+            "Baixar comparação (PDF)", key=f"{key_prefix}_pdf_download", name=base_filename,
+            error_hint="Instale reportlab: pip install reportlab", digest=digest
+        )
 
 
 # =============================================================================
@@ -3,7 +3,15 @@ import pandas as pd
 import numpy as np
 import re
 import unicodedata
-from typing import Dict, Tuple, Optional
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+from typing import Callable, Dict, List, Tuple, Optional
+
+# pyarrow é opcional: acelera as operações de string do pandas quando disponível
+try:
+    import pyarrow  # noqa: F401
+    _STR_DTYPE = "string[pyarrow]"
+except Exception:  # pragma: no cover
+    _STR_DTYPE = object
 
 BI_COLS = {
     "valor_contabil": ["valor contabil", "valor_contabil", "vl contabil", "vl. contabil", "valor", "vl"],
@@ -244,12 +252,52 @@ def clean_code_main(x: str) -> str:
     return s
 
 
+def map_distinct(series: pd.Series, func, na_value=None) -> np.ndarray:
+    """
+    Aplica `func` uma única vez por valor distinto e remapeia o resultado para as linhas
+    (array object). Fatoriza por tipo para não fundir 1, 1.0 e True; nulos recebem `na_value`.
+    """
+    s = series if isinstance(series, pd.Series) else pd.Series(series, dtype=object)
+    out = np.full(len(s), na_value, dtype=object)
+    if s.empty:
+        return out
+
+    values = s.to_numpy()
+    kind_codes, kinds = pd.factorize(s.map(type).to_numpy())
+    for k in range(len(kinds)):
+        mask = kind_codes == k
+        codes, uniques = pd.factorize(values[mask], use_na_sentinel=True)
+        mapped = np.empty(len(uniques) + 1, dtype=object)
+        mapped[:-1] = [func(u) for u in uniques]
+        mapped[-1] = na_value
+        out[mask] = mapped[codes]
+    return out
+
+
+def clean_code_series(series: pd.Series) -> pd.Series:
+    """
+    Versão colunar de clean_code_main: fatoriza a coluna, limpa cada valor distinto
+    uma única vez e remapeia o resultado para as linhas.
+    """
+    s = series if isinstance(series, pd.Series) else pd.Series(series)
+    out = map_distinct(s, clean_code_main, "")
+    if s.empty:
+        return pd.Series(out, index=s.index, dtype=object, name=s.name)
+    return pd.Series(out, index=s.index, name=s.name)
+
+
 def is_empty_code_main(x: str) -> bool:
     """Verifica se um código está vazio ou zerado."""
     s = clean_code_main(x)
     return s == "" or set(s) == {"0"}
 
 
+def is_empty_code_series(codes: pd.Series) -> pd.Series:
+    """Versão colunar de is_empty_code_main para códigos já limpos por clean_code_series."""
+    s = codes.fillna("").astype(str)
+    return s.eq("") | s.str.fullmatch(r"0+").fillna(False).astype(bool)
+
+
 def to_number_br_main(v) -> float:
     """Converte valores em formato brasileiro para float."""
     if v is None:
@@ -268,6 +316,181 @@ def to_number_br_main(v) -> float:
     return -val if neg else val
 
 
+# Corpo numérico já canonizado ("1234.56", "-0.5", "12."), aceito diretamente por float()
+_CANON_NUM_RE = r"[+-]?(?:\d+\.?\d*|\.\d+)"
+
+
+def _br_canonical_strings(txt: pd.Series) -> Tuple[pd.Series, pd.Series, pd.Series]:
+    """
+    Converte uma coluna de textos BR ("1.234,56", "(1.234,56)") para a forma canônica
+    ("1234.56") com operações de string do pandas.
+    Retorna (canon, neg, fast): `fast` marca as células cujo canon é válido.
+    """
+    t = txt.str.strip()
+    canon = t.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+    neg = (canon.str.startswith("(") & canon.str.endswith(")")).fillna(False).astype(bool)
+    if neg.any():
+        canon = canon.where(~neg, canon.str[1:-1])
+    fast = canon.str.fullmatch(_CANON_NUM_RE).fillna(False).astype(bool)
+    return canon, neg, fast
+
+
+def _parse_br_column(series: pd.Series, dtype: str, fast_values, scalar, from_numeric) -> pd.Series:
+    """
+    Esqueleto comum dos conversores colunares de valores BR.
+    Textos no padrão comum passam por `fast_values(canon, neg)`; números já tipados
+    por `from_numeric`; o restante cai em `scalar`, uma vez por valor distinto.
+    """
+    s = series if isinstance(series, pd.Series) else pd.Series(series)
+    if pd.api.types.is_bool_dtype(s) or pd.api.types.is_numeric_dtype(s):
+        num = s.astype("float64").fillna(0.0).to_numpy()
+        return pd.Series(from_numeric(num), index=s.index, dtype=dtype, name=s.name)
+
+    vals = s.to_numpy(dtype=object)
+    out = np.zeros(len(vals), dtype=dtype)
+    is_str = s.map(type).eq(str).to_numpy()
+
+    # Células já numéricas (ex.: Excel lido sem dtype=str)
+    other = ~is_str & s.notna().to_numpy()
+    if other.any():
+        num = pd.to_numeric(pd.Series(vals[other]), errors="coerce").to_numpy(dtype="float64")
+        odd = np.isnan(num)
+        res = np.zeros(len(num), dtype=dtype)
+        res[~odd] = from_numeric(num[~odd])
+        if odd.any():
+            res[odd] = [scalar(v) for v in vals[other][odd]]
+        out[other] = res
+
+    if is_str.any():
+        txt = pd.Series(vals[is_str], dtype=_STR_DTYPE)
+        canon, neg, fast = _br_canonical_strings(txt)
+        fast_np = fast.to_numpy()
+        res = np.zeros(len(txt), dtype=dtype)
+        if fast_np.any():
+            res[fast_np] = fast_values(canon[fast], neg.to_numpy()[fast_np])
+        if not fast_np.all():
+            rest = vals[is_str][~fast_np]
+            lut = {u: scalar(u) for u in pd.unique(rest)}
+            res[~fast_np] = [lut[u] for u in rest]
+        out[is_str] = res
+
+    return pd.Series(out, index=s.index, dtype=dtype, name=s.name)
+
+
+def _fast_floats(canon: pd.Series, neg: np.ndarray) -> np.ndarray:
+    val = canon.astype("float64").to_numpy()
+    return np.where(neg, -val, val)
+
+
+def to_number_br_series(series: pd.Series) -> pd.Series:
+    """
+    Versão vetorizada de to_number_br_main/safe_to_number para uma coluna inteira.
+    Textos seguem o formato brasileiro; números já tipados e vazios seguem safe_to_number.
+    Células fora do padrão comum caem no conversor escalar (uma vez por valor distinto).
+    """
+    return _parse_br_column(series, "float64", _fast_floats, to_number_br_main, lambda num: num)
+
+
+# =============================================================================
+# Valores monetários em centavos (int64)
+# =============================================================================
+CENTS_DTYPE = "int64"
+
+
+def decimal_to_cents(canon: str) -> int:
+    """Converte número canônico ("-1234.565") em centavos, arredondando meio-para-par (NBR 5891)."""
+    try:
+        d = Decimal(canon)
+    except InvalidOperation:
+        raise ValueError(f"could not convert string to cents: {canon!r}")
+    if not d.is_finite():
+        return 0
+    return int(d.scaleb(2).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def reais_to_cents(v) -> int:
+    """Converte um valor em reais (float) para centavos inteiros."""
+    if v is None or pd.isna(v):
+        return 0
+    f = float(v)
+    return int(round(f * 100)) if np.isfinite(f) else 0
+
+
+def to_cents_br_main(v) -> int:
+    """Converte valor no formato brasileiro para centavos (int), com a leitura de to_number_br_main."""
+    if v is None:
+        return 0
+    if not isinstance(v, str):
+        if pd.isna(v):
+            return 0
+        if isinstance(v, (int, float)):
+            return reais_to_cents(v)
+    s = str(v).strip()
+    if s == "" or norm_text_main(s) in EMPTY_TOKENS_MAIN:
+        return 0
+    neg = s.startswith("(") and s.endswith(")")
+    if neg:
+        s = s[1:-1]
+    s = s.replace(".", "").replace(",", ".")
+    try:
+        cents = decimal_to_cents(s)
+    except ValueError:
+        cents = decimal_to_cents(re.sub(r"[^0-9\.\-]", "", s) or "0")
+    return -cents if neg else cents
+
+
+def _fast_cents(canon: pd.Series, neg: np.ndarray) -> np.ndarray:
+    """Centavos exatos a partir de strings canônicas, sem passar por float."""
+    sign = canon.str.startswith("-").to_numpy(dtype=bool)
+    body = canon.str.lstrip("+-")
+    parts = body.str.partition(".")
+    # Inteiros longos demais para int64 seguem pelo caminho Decimal
+    huge = (parts[0].str.len() > 16).to_numpy(dtype=bool)
+    int_part = parts[0].where((parts[0].str.len() > 0) & ~huge, "0")
+    frac = parts[2]
+    cents = (int_part.astype("int64").to_numpy() * 100
+             + frac.str[:2].str.pad(2, side="right", fillchar="0").astype("int64").to_numpy())
+    # Arredondamento meio-para-par das casas além do centavo
+    rest = frac.str[2:]
+    first = rest.str[:1]
+    tail = rest.str[1:].str.contains("[1-9]", regex=True).to_numpy(dtype=bool)
+    gt_half = first.isin(list("6789")).to_numpy(dtype=bool)
+    is_half = first.eq("5").to_numpy(dtype=bool)
+    cents = cents + (gt_half | (is_half & (tail | (cents % 2 == 1))))
+    cents = np.where(sign, -cents, cents)
+    if huge.any():
+        cents[huge] = [decimal_to_cents(c) for c in canon.to_numpy()[huge]]
+    return np.where(neg, -cents, cents)
+
+
+def _floats_to_cents(num: np.ndarray) -> np.ndarray:
+    return np.where(np.isfinite(num), np.rint(num * 100), 0).astype(CENTS_DTYPE)
+
+
+def to_cents_br_series(series: pd.Series) -> pd.Series:
+    """
+    Como to_number_br_series, mas devolve centavos exatos em int64.
+    Textos BR são convertidos por dígitos (sem float); números já tipados são arredondados ao centavo.
+    """
+    return _parse_br_column(series, CENTS_DTYPE, _fast_cents, to_cents_br_main, _floats_to_cents)
+
+
+def cents_to_reais(cents):
+    """Converte centavos (int64) em reais (float) para exibição e relatórios."""
+    if isinstance(cents, (pd.Series, np.ndarray)):
+        return cents.astype("float64") / 100
+    return int(cents) / 100
+
+
+def cents_columns_to_reais(df: pd.DataFrame, cols: list) -> pd.DataFrame:
+    """Devolve cópia do DataFrame com as colunas em centavos convertidas para reais."""
+    out = df.copy()
+    for c in cols:
+        if c in out.columns:
+            out[c] = cents_to_reais(pd.to_numeric(out[c], errors="coerce").fillna(0).astype(CENTS_DTYPE))
+    return out
+
+
 def extract_desc_before_first_digit_main(s: str) -> str:
     """Extrai descrição até o primeiro dígito encontrado."""
     if s is None:
@@ -279,15 +502,48 @@ def extract_desc_before_first_digit_main(s: str) -> str:
     return part.strip(" -–—•|:;/,.").strip()
 
 
+def excel_sheet_width_bound(xls: pd.ExcelFile, sheet_name: str) -> Optional[int]:
+    """
+    Limite superior das colunas que a aba terá ao ser lida, sem ler as células: ncols do
+    xlrd ou a dimensão gravada no .xlsx (openpyxl). None quando o arquivo não informa.
+    """
+    try:
+        book = xls.book
+        if hasattr(book, "sheet_by_name"):
+            return int(book.sheet_by_name(sheet_name).ncols)
+        n = book[sheet_name].max_column
+        return int(n) if n else None
+    except Exception:
+        return None
+
+
+def widest_sheet(sheets: List[str], bound: Callable[[str], Optional[int]],
+                 parse: Callable[[str], pd.DataFrame]) -> Tuple[Optional[str], Optional[pd.DataFrame]]:
+    """
+    A aba com mais colunas lidas (a primeira, em caso de empate), como se todas fossem lidas:
+    as abas são visitadas em ordem decrescente de `bound` e a busca para quando nenhuma das
+    restantes pode superar a melhor já lida. Abas sem limite conhecido são sempre lidas.
+    """
+    limites = [bound(sh) for sh in sheets]
+    limites = [float("inf") if b is None else b for b in limites]
+    best_i, best_w, best_df = None, -1, None
+    for i in sorted(range(len(sheets)), key=lambda k: -limites[k]):
+        if limites[i] < best_w:
+            break
+        if limites[i] == best_w and i > best_i:
+            continue
+        df = parse(sheets[i])
+        w = df.shape[1]
+        if w > best_w or (w == best_w and i < best_i):
+            best_i, best_w, best_df = i, w, df
+    return (sheets[best_i], best_df) if best_i is not None else (None, None)
+
+
 def read_excel_best_main(file) -> pd.DataFrame:
-    """Lê a planilha Excel com mais colunas (melhor estrutura)."""
+    """Lê a planilha Excel com mais colunas (melhor estrutura), lendo só as abas que podem sê-la."""
     xls = pd.ExcelFile(file)
-    best_df, best_cols = None, -1
-    for sh in xls.sheet_names:
-        df = xls.parse(sh)
-        if df.shape[1] > best_cols:
-            best_df, best_cols = df, df.shape[1]
-    return best_df if best_df is not None else pd.DataFrame()
+    _, df = widest_sheet(xls.sheet_names, lambda sh: excel_sheet_width_bound(xls, sh), xls.parse)
+    return df if df is not None else pd.DataFrame()
 
 
 def format_brazilian_number(x: float) -> str: